@@ -1,3 +1,10 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'created_at', 'finished_at')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('created_at', 'started_at', 'finished_at')
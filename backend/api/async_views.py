@@ -0,0 +1,265 @@
+"""Native async versions of the long-lived endpoints, for ASGI deployments.
+
+Under ASGI, Django runs a sync view on a thread of its own, so every slow
+download or idle progress stream ties up a thread for as long as the client
+stays connected. These views await instead: ffmpeg and ffprobe run as asyncio
+subprocesses, yt-dlp (which can only block) runs on the bounded
+``ytdl_executor``, and responses are async iterators. ``urls.py`` serves them
+when ``ASYNC_VIEWS`` is set, which ``asgi.py`` does by default.
+
+Uploads, captions, batches and jobs keep their sync views; their responses
+are still streamed chunk by chunk under ASGI (see ``streaming_content``).
+"""
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from .audio_stream import AsyncAudioStream, plan_stream
+from .metadata import get_video_info
+from .models import Job
+from .pipelines import fetch_media, trim_video_async, download_name, download_scratch_bytes
+from .progress import ProgressReporter, Subscription, broker, request_key, sse, KEY_RE
+from .scheduler import SchedulerBusy
+from .scratch import ScratchFull, allocate_async, release
+from .streaming import stream_file, remove_dir
+from .tracing import bind
+from .uploads import resolve_input, input_digest, edit_scratch_bytes, UploadNotFound
+from .views import (info_pool, describe_url, video_summary, download_params, wants_audio_stream,
+                    parse_urls, parse_bool, is_uuid, stream_poll, job_event)
+
+logger = logging.getLogger(__name__)
+
+# yt-dlp only blocks; this bounds how many extractions and downloads run at once
+ytdl_executor = ThreadPoolExecutor(max_workers=settings.YTDL_WORKERS, thread_name_prefix='ytdl')
+
+
+async def in_ytdl_executor(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(ytdl_executor, bind(fn, *args))
+
+
+def error_response(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+def busy_response(e):
+    response = JsonResponse({'error': str(e), 'retry_after': e.retry_after}, status=503)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def request_data(request):
+    """JSON body or form fields, like DRF's ``request.data``."""
+    if request.content_type == 'application/json':
+        data = json.loads(request.body or b'{}')
+        if not isinstance(data, dict):
+            raise ValueError('Expected a JSON object')
+        return data
+    return request.POST
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAPIView(View):
+    """Async view with DRF's ``request.data``, CSRF exempt like the APIViews it stands in for"""
+    # Edit views reserve their whole scratch space before an upload spools into it
+    edits = False
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            if self.edits and request.content_type.startswith('multipart/'):
+                request.scratch_dir = await allocate_async(edit_scratch_bytes(request))
+            # Form parsing may spool uploads to disk
+            request.data = await sync_to_async(request_data, thread_sensitive=False)(request)
+        except BaseException as e:
+            # The view won't run to free the scratch space
+            if getattr(request, 'scratch_dir', None):
+                release(request.scratch_dir)
+            if isinstance(e, SchedulerBusy):
+                return busy_response(e)
+            if isinstance(e, ValueError):
+                return error_response(f'Malformed request: {e}')
+            raise
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncVideoInfoView(AsyncAPIView):
+    """Async ``VideoInfoView``"""
+    async def post(self, request):
+        url = request.data.get('url')
+        if not url:
+            return error_response('URL is required')
+        try:
+            return JsonResponse(video_summary(await in_ytdl_executor(get_video_info, url)))
+        except Exception as e:
+            return error_response(str(e))
+
+
+class AsyncBulkVideoInfoView(AsyncAPIView):
+    """Async ``BulkVideoInfoView``"""
+    async def post(self, request):
+        urls = parse_urls(request.data)
+        if not urls:
+            return error_response('At least one URL is required')
+        if len(urls) > settings.INFO_MAX_URLS:
+            return error_response(f'At most {settings.INFO_MAX_URLS} URLs can be looked up at once')
+
+        futures = [info_pool.submit(bind(describe_url, url)) for url in urls]
+        if not parse_bool(request.data.get('stream', False)):
+            return JsonResponse({'results': await asyncio.gather(*map(asyncio.wrap_future, futures))})
+
+        async def indexed(i, future):
+            return dict(index=i, **await asyncio.wrap_future(future))
+
+        async def lines():
+            try:
+                for result in asyncio.as_completed([indexed(i, f) for i, f in enumerate(futures)]):
+                    yield json.dumps(await result) + '\n'
+            finally:
+                # Lookups that haven't started are not needed by a client that left
+                for future in futures:
+                    future.cancel()
+
+        response = StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class AsyncDownloadVideoView(AsyncAPIView):
+    """Async ``DownloadVideoView``"""
+    async def post(self, request):
+        import yt_dlp
+        try:
+            params = download_params(request.data)
+        except ValueError as e:
+            return error_response(str(e))
+
+        progress = ProgressReporter(request_key(request))
+        if wants_audio_stream(request.data, params):
+            try:
+                response = await self.stream_audio(params['url'], params['audio_format'], progress)
+            except SchedulerBusy as e:
+                progress.finish('failed')
+                return busy_response(e)
+            if response is not None:
+                return response
+
+        temp_dir = None
+        handed_off = False
+        try:
+            size = await in_ytdl_executor(download_scratch_bytes, params['url'], params['format_id'],
+                                          params['audio_only'], params['captions'], params['audio_format'])
+            temp_dir = await allocate_async(size)
+            filename, safe_filename, content_type = await in_ytdl_executor(
+                fetch_media, params['url'], params['format_id'], params['audio_only'], temp_dir,
+                params['section'], params['captions'], progress, params['audio_format'])
+            response = stream_file(request, filename, safe_filename, content_type,
+                                   cleanup=remove_dir(temp_dir))
+            handed_off = True
+            return response
+        except SchedulerBusy as e:
+            return busy_response(e)
+        except yt_dlp.utils.DownloadError as e:
+            if 'Requested format is not available' in str(e):
+                return error_response('This format is unavailable. Try another format.')
+            return error_response(f'YouTube error: {e}')
+        except Exception as e:
+            return error_response(f'Server error: {e}', status=500)
+        finally:
+            progress.finish('done' if handed_off else 'failed')
+            if temp_dir is not None and not handed_off:
+                release(temp_dir)
+
+    async def stream_audio(self, url, audio_format, progress):
+        """Async ``stream_audio()``: the converted audio, or None to download instead."""
+        try:
+            info = await in_ytdl_executor(get_video_info, url)
+            planned = plan_stream(info, audio_format)
+            if planned is None:
+                return None
+            stream = AsyncAudioStream(*planned, progress=progress)
+            await stream.start()
+        except SchedulerBusy:
+            raise
+        except Exception:
+            logger.warning('Could not stream audio of %s, downloading it instead', url, exc_info=True)
+            return None
+        response = StreamingHttpResponse(stream, content_type=stream.content_type)
+        response['Content-Disposition'] = f'attachment; filename="{download_name(info, stream.ext)}"'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class AsyncTrimVideoView(AsyncAPIView):
+    """Async ``TrimVideoView``"""
+    edits = True
+
+    async def post(self, request):
+        try:
+            temp_dir = (getattr(request, 'scratch_dir', None)
+                        or await allocate_async(edit_scratch_bytes(request)))
+        except ScratchFull as e:
+            return busy_response(e)
+        handed_off = False
+        progress = ProgressReporter(request_key(request))
+        try:
+            input_path, name = await sync_to_async(resolve_input, thread_sensitive=False)(request, temp_dir)
+            start = float(request.data.get('start', 0))
+            end = float(request.data.get('end', 10))
+            if start >= end:
+                return error_response('End time must be after start time')
+
+            # Hashing reads the whole input
+            digest = await sync_to_async(input_digest, thread_sensitive=False)(request, input_path)
+            output_path = await trim_video_async(input_path, start, end, temp_dir, progress, digest)
+            response = stream_file(request, output_path, f'trimmed_{name}', 'video/mp4',
+                                   cleanup=remove_dir(temp_dir))
+            handed_off = True
+            return response
+        except UploadNotFound as e:
+            return error_response(str(e), status=404)
+        except SchedulerBusy as e:
+            return busy_response(e)
+        except Exception as e:
+            return error_response(str(e), status=500)
+        finally:
+            progress.finish('done' if handed_off else 'failed')
+            if not handed_off:
+                release(temp_dir)
+
+
+class AsyncProgressStreamView(View):
+    """Async ``ProgressStreamView``: idle subscribers cost a coroutine, not a thread"""
+    async def get(self, request, key):
+        if not KEY_RE.match(key):
+            return HttpResponse(status=404)
+        response = StreamingHttpResponse(self.events(key), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def events(self, key):
+        channel = broker.channel(key)
+        job = await Job.objects.filter(pk=key).afirst() if is_uuid(key) else None
+        subscription = Subscription(stream_poll(job))
+        yield 'retry: 2000\n\n'
+        while not subscription.expired:
+            event, seq, done = await channel.wait_async(subscription.seq, subscription.poll)
+            if seq == subscription.seq and job is not None:
+                await job.arefresh_from_db(fields=['status', 'progress'])
+                event, done = job_event(job)
+            text = subscription.update(event, seq, done)
+            if text:
+                yield text
+            if done:
+                return
+            # Coalesce bursts of updates into a few events per second
+            await asyncio.sleep(settings.PROGRESS_MIN_INTERVAL)
+        yield sse('timeout', {})
@@ -0,0 +1,253 @@
+"""Audio downloads piped through ffmpeg straight into the response.
+
+The regular path downloads the source to disk, converts it into a second
+file and only then starts sending. Here the source is fetched in ranged
+chunks and written to ffmpeg's stdin while ffmpeg's stdout is the response
+body, so the first bytes go out within seconds and nothing touches the disk.
+Each stage blocks on the next one, so a slow client slows the fetch down
+instead of piling data up in memory. The output length isn't known up
+front, so the response is chunked and can't serve Range requests.
+
+As the client sets the pace, streams run in ``stream_scheduler``'s slots
+(``AUDIO_STREAM_SLOTS``), not in the encode slots edits need.
+"""
+import logging
+import threading
+from contextlib import ExitStack
+
+from django.conf import settings
+
+from .ffmpeg_runner import piped, piped_async, error
+from .formats import content_type, DEFAULT_AUDIO_FORMAT
+from .metrics import Counter
+from .pipelines import is_streamable_mp4
+from .scheduler import COPY, ENCODE, stream_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Output name -> container, encoder and the source codecs it can hold as is
+OUTPUTS = {
+    'mp3': {'format': 'mp3', 'codec': 'libmp3lame', 'copies': ('mp3',)},
+    'opus': {'format': 'ogg', 'codec': 'libopus', 'copies': ('opus',)},
+    # Fragmented, so nothing has to wait for a moov box at the end
+    'm4a': {'format': 'mp4', 'codec': 'aac', 'copies': ('mp4a', 'aac'),
+            'movflags': 'empty_moov+default_base_moof', 'frag_duration': 1000000},
+}
+# Sources fetched here in ranges and fed to stdin
+FED_PROTOCOLS = ('http', 'https')
+# Sources ffmpeg reads itself
+READ_PROTOCOLS = ('m3u8', 'm3u8_native')
+# Enough of an MP4 to see whether moov comes before mdat
+HEAD_SIZE = 64 * 1024
+
+streams_started = Counter('audio_streams', 'Audio downloads piped through ffmpeg without temp files')
+
+
+# Codecs implied by the extension when the extractor doesn't name one
+EXT_CODECS = {'m4a': 'mp4a', 'mp3': 'mp3', 'opus': 'opus'}
+
+
+def _copies(output, source):
+    codec = source.get('acodec') or EXT_CODECS.get(source.get('ext'), '')
+    return codec.startswith(OUTPUTS[output]['copies'])
+
+
+def plan_stream(info, audio_format=None):
+    """Pick the source format and output for streaming audio from ``info``.
+
+    Returns ``(source, output, copy)``, or None when no audio-only format can
+    be piped. ``best`` keeps the source codec whenever an output can hold it.
+    """
+    sources = [f for f in info.get('formats') or []
+               if f.get('url') and f.get('vcodec') == 'none' and f.get('acodec') != 'none'
+               and f.get('protocol', 'https') in FED_PROTOCOLS + READ_PROTOCOLS]
+    if not sources:
+        return None
+    bitrate = lambda f: f.get('abr') or f.get('tbr') or 0
+    if audio_format == 'best':
+        source = max(sources, key=bitrate)
+        output = next((name for name in OUTPUTS if _copies(name, source)), 'opus')
+    else:
+        output = audio_format or DEFAULT_AUDIO_FORMAT
+        # A source the output can hold as is beats a better one that needs encoding
+        source = max(sources, key=lambda f: (_copies(output, f), bitrate(f)))
+    return source, output, _copies(output, source)
+
+
+def _url_input(source):
+    import ffmpeg
+    headers = source.get('http_headers')
+    if headers:
+        return ffmpeg.input(source['url'], headers=''.join(f'{k}: {v}\r\n' for k, v in headers.items()))
+    return ffmpeg.input(source['url'])
+
+
+def _output(stream, output, copy):
+    import ffmpeg
+    spec = OUTPUTS[output]
+    options = {'acodec': 'copy' if copy else spec['codec'], 'format': spec['format']}
+    if not copy:
+        options['audio_bitrate'] = settings.AUDIO_STREAM_BITRATE
+    options.update((key, spec[key]) for key in ('movflags', 'frag_duration') if key in spec)
+    return ffmpeg.output(stream.audio, 'pipe:1', **options)
+
+
+class AudioStream:
+    """Iterator over ffmpeg's output for a ``StreamingHttpResponse``.
+
+    The first chunk is read up front, so a source ffmpeg can't handle raises
+    ``ffmpeg.Error`` before any response is sent. Django calls ``close()``
+    when the response ends or the client goes away; that stops the fetch and
+    ffmpeg and frees the stream slot.
+    """
+
+    def __init__(self, source, output, copy, progress=None):
+        import ffmpeg
+        self.ext = output
+        self.content_type = content_type(output, audio_only=True)
+        self.progress = progress
+        self._source = source
+        self._stop = threading.Event()
+        self._stack = ExitStack()
+        headers = source.get('http_headers') or {}
+        fed = source.get('protocol', 'https') in FED_PROTOCOLS
+        self._head = b''
+        if fed and source.get('ext') in ('mp4', 'm4a'):
+            self._head = self._fetch_head(headers)
+            # A pipe can't seek to a moov box at the end; ffmpeg's HTTP input can
+            fed = is_streamable_mp4(self._head)
+        stream = ffmpeg.input('pipe:0') if fed else _url_input(source)
+
+        try:
+            self.proc = self._stack.enter_context(
+                piped(_output(stream, output, copy), priority=COPY if copy else ENCODE, stdin=fed,
+                      pool=stream_scheduler))
+            if fed:
+                threading.Thread(target=self._feed, args=(headers,), daemon=True).start()
+            self._first = self.proc.stdout.read1(settings.STREAM_CHUNK_SIZE)
+            if not self._first:
+                self.proc.wait()
+                raise error(self.proc)
+        except BaseException:
+            self.close()
+            raise
+        streams_started.inc()
+
+    def _fetch_head(self, headers):
+        import requests
+        with requests.get(self._source['url'], headers=dict(headers, Range=f'bytes=0-{HEAD_SIZE - 1}'),
+                          stream=True, timeout=30) as response:
+            response.raise_for_status()
+            return response.raw.read(HEAD_SIZE)
+
+    def _feed(self, headers):
+        import requests
+        url = self._source['url']
+        total = self._source.get('filesize') or self._source.get('filesize_approx')
+        position = len(self._head)
+        try:
+            self.proc.stdin.write(self._head)
+            with requests.Session() as session:
+                while not self._stop.is_set():
+                    # Servers like YouTube throttle long single requests, not short ranges
+                    end = position + settings.AUDIO_STREAM_RANGE_SIZE - 1
+                    with session.get(url, headers=dict(headers, Range=f'bytes={position}-{end}'),
+                                     stream=True, timeout=30) as response:
+                        if response.status_code == 416:
+                            break
+                        response.raise_for_status()
+                        for data in response.iter_content(64 * 1024):
+                            if self._stop.is_set():
+                                return
+                            self.proc.stdin.write(data)
+                            position += len(data)
+                            if self.progress:
+                                self.progress('download', downloaded_bytes=position, total_bytes=total,
+                                              percent=round(100 * position / total, 1) if total else None)
+                    # A 200 is the whole file; a short range is the end of it
+                    if response.status_code != 206 or position <= end:
+                        break
+        except requests.RequestException as e:
+            if not self._stop.is_set():
+                logger.warning('Audio source fetch failed: %s', e)
+        except (ValueError, OSError):
+            # ffmpeg stopped reading: it failed, or the response was closed
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first:
+            chunk, self._first = self._first, b''
+            return chunk
+        chunk = self.proc.stdout.read1(settings.STREAM_CHUNK_SIZE)
+        if not chunk:
+            if self.proc.wait() != 0:
+                logger.warning('Streamed audio ended early: %s',
+                               b''.join(self.proc.stderr_lines[-3:]).decode(errors='replace'))
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        self._stop.set()
+        stack, self._stack = self._stack, ExitStack()
+        stack.close()
+        if self.progress:
+            finished = getattr(self, 'proc', None) is not None and self.proc.returncode == 0
+            self.progress.finish('done' if finished else 'failed')
+            self.progress = None
+
+
+class AsyncAudioStream:
+    """``AudioStream`` for the async views.
+
+    ffmpeg fetches the source over HTTP itself and its output is read through
+    asyncio, so a stream costs a subprocess but no thread. Call ``start()``
+    first; it reads the first chunk, raising ``ffmpeg.Error`` the same way.
+    """
+
+    def __init__(self, source, output, copy, progress=None):
+        self.ext = output
+        self.content_type = content_type(output, audio_only=True)
+        self.progress = progress
+        self._spec = _output(_url_input(source), output, copy)
+        self._priority = COPY if copy else ENCODE
+
+    async def start(self):
+        self._chunks = self._read()
+        try:
+            self._first = await anext(self._chunks)
+        except StopAsyncIteration:
+            # _read() raises before ending empty; this is only for safety
+            import ffmpeg
+            raise ffmpeg.Error('ffmpeg', b'', b'no output')
+        streams_started.inc()
+
+    async def __aiter__(self):
+        yield self._first
+        async for chunk in self._chunks:
+            yield chunk
+
+    async def _read(self):
+        finished = False
+        try:
+            async with piped_async(self._spec, priority=self._priority, pool=stream_scheduler) as proc:
+                sent = False
+                while chunk := await proc.stdout.read(settings.STREAM_CHUNK_SIZE):
+                    sent = True
+                    yield chunk
+                if await proc.wait() != 0:
+                    if not sent:
+                        raise error(proc)
+                    logger.warning('Streamed audio ended early: %s',
+                                   b''.join(proc.stderr_lines[-3:]).decode(errors='replace'))
+                finished = proc.returncode == 0
+        finally:
+            if self.progress:
+                self.progress.finish('done' if finished else 'failed')
@@ -0,0 +1,139 @@
+"""Batch and playlist downloads streamed back as one ZIP.
+
+Items download on a bounded pool and each one is written into the archive as
+soon as it finishes, so the client starts receiving data after the first
+download rather than the last. The archive is produced on the fly: zipfile
+writes into a sink that is drained into the response after every chunk, and
+each item's files are deleted once they are in the archive, so neither the
+archive nor more than a pool's worth of downloads is ever kept around.
+Items that fail are listed in ``manifest.json`` instead of aborting the batch.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+
+from .metadata import playlist_entries
+from .pipelines import fetch_media
+from .scratch import release
+from .tracing import bind
+
+logger = logging.getLogger(__name__)
+
+
+class ZipSink:
+    """Write-only file object collecting zipfile output until it is drained."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _entries(url, limit):
+    try:
+        entries = playlist_entries(url, limit)
+    except Exception:
+        logger.warning('Could not list %s as a playlist', url, exc_info=True)
+        entries = None
+    return entries if entries is not None else [url]
+
+
+def expand_urls(urls, limit):
+    """Replace playlist URLs with their entries, keeping the order.
+
+    Returns at most ``limit + 1`` URLs, so callers can tell the batch is too big.
+    A URL that can't be expanded is kept as is and fails as an item later.
+    """
+    with ThreadPoolExecutor(max_workers=settings.BATCH_WORKERS) as pool:
+        listed = pool.map(lambda url: _entries(url, limit + 1), urls[:limit + 1])
+        return [url for entries in listed for url in entries][:limit + 1]
+
+
+def stream_batch(urls, format_id, audio_only, work_dir, progress=None, audio_format=None):
+    """Yield a ZIP archive of the downloads of ``urls`` plus a manifest.
+
+    ``work_dir`` is removed when the generator finishes or is closed.
+    """
+    sink = ZipSink()
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+    pool = ThreadPoolExecutor(max_workers=settings.BATCH_WORKERS, thread_name_prefix='batch')
+    items = iter(enumerate(urls, 1))
+    pending = {}
+    manifest = []
+    completed = False
+
+    def submit_next():
+        # Only as many downloads as workers are in flight, so finished items
+        # waiting for a slow client never pile up on disk
+        for index, url in items:
+            item_dir = os.path.join(work_dir, f'{index:04d}')
+            os.makedirs(item_dir)
+            future = pool.submit(bind(fetch_media, url, format_id, audio_only, item_dir,
+                                      audio_format=audio_format))
+            pending[future] = (index, url, item_dir)
+            return
+
+    try:
+        for _ in range(settings.BATCH_WORKERS):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, url, item_dir = pending.pop(future)
+                entry = {'index': index, 'url': url}
+                try:
+                    path, filename, _ = future.result()
+                except Exception as e:
+                    entry.update(status='failed', error=str(e))
+                else:
+                    entry.update(status='ok', file=f'{index:03d} - {filename}', size=os.path.getsize(path))
+                    info = zipfile.ZipInfo(entry['file'], date_time=time.localtime()[:6])
+                    info.file_size = entry['size']
+                    with open(path, 'rb') as src, archive.open(info, 'w') as dst:
+                        while chunk := src.read(settings.STREAM_CHUNK_SIZE):
+                            dst.write(chunk)
+                            yield sink.drain()
+                shutil.rmtree(item_dir, ignore_errors=True)
+                manifest.append(entry)
+                submit_next()
+                if progress:
+                    progress('batch', completed=len(manifest), total=len(urls),
+                             failed=sum(1 for e in manifest if e['status'] == 'failed'))
+            data = sink.drain()
+            if data:
+                yield data
+
+        manifest.sort(key=lambda e: e['index'])
+        archive.writestr(zipfile.ZipInfo('manifest.json', date_time=time.localtime()[:6]),
+                         json.dumps({'items': manifest}, indent=2))
+        archive.close()
+        yield sink.drain()
+        completed = True
+    finally:
+        if progress:
+            progress.finish('done' if completed else 'failed')
+        if pending:
+            # The client went away; let running downloads finish before their dirs go
+            pool.shutdown(wait=False, cancel_futures=True)
+            threading.Thread(target=lambda: (pool.shutdown(wait=True), release(work_dir)),
+                             daemon=True).start()
+        else:
+            pool.shutdown(wait=False)
+            release(work_dir)
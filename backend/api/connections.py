@@ -0,0 +1,59 @@
+"""Per-host cap on the connections downloads open.
+
+Every yt-dlp download fetches fragments over several connections at once,
+and a host seeing too many of them from one client starts throttling all
+of them. Downloads ask ``host_connections`` for as many connections as
+they would like (``YTDL_CONCURRENT_FRAGMENTS``) and get what the host has
+left under ``DOWNLOAD_HOST_CONNECTIONS``, waiting for at least one, so
+under load each download runs with fewer fragments in flight instead of
+the host slowing everything down.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from .metrics import Gauge, Histogram
+
+open_connections = Gauge('download_connections', description='Connections granted to downloads per host',
+                         labels=('host',))
+connection_wait = Histogram('download_connection_wait_seconds',
+                            'Time downloads waited for a connection to their host')
+
+
+def host_of(url):
+    return (urlsplit(url or '').hostname or '').lower()
+
+
+class HostConnections:
+    def __init__(self, limit):
+        self.limit = limit
+        self._used = {}
+        self._changed = threading.Condition()
+
+    @contextmanager
+    def acquire(self, host, wanted):
+        """Hold between 1 and ``wanted`` connections to ``host`` for the block,
+        which gets how many it was granted."""
+        started = time.perf_counter()
+        with self._changed:
+            while self.limit and self._used.get(host, 0) >= self.limit:
+                self._changed.wait()
+            granted = min(wanted, self.limit - self._used.get(host, 0)) if self.limit else wanted
+            self._used[host] = self._used.get(host, 0) + granted
+        connection_wait.observe(time.perf_counter() - started)
+        open_connections.inc(granted, host=host)
+        try:
+            yield granted
+        finally:
+            open_connections.dec(granted, host=host)
+            with self._changed:
+                self._used[host] -= granted
+                if not self._used[host]:
+                    del self._used[host]
+                self._changed.notify_all()
+
+
+host_connections = HostConnections(settings.DOWNLOAD_HOST_CONNECTIONS)
@@ -0,0 +1,303 @@
+"""Run ffmpeg-python graphs while reporting ``-progress`` output.
+
+ffmpeg-python is imported on first use, so processes that never run ffmpeg
+(management commands, health checks) don't load it.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from functools import lru_cache
+
+from django.conf import settings
+
+from .scheduler import scheduler, ENCODE
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+DURATION_RE = re.compile(rb'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def _install_locations():
+    """Usual places for an ffmpeg binary, checked before PATH."""
+    if os.name == 'nt':
+        return [
+            settings.BASE_DIR / 'ffmpeg' / 'bin' / 'ffmpeg.exe',
+            'C:\\ffmpeg\\bin\\ffmpeg.exe',
+            'C:\\Program Files\\ffmpeg\\bin\\ffmpeg.exe',
+            'C:\\Program Files (x86)\\ffmpeg\\bin\\ffmpeg.exe',
+        ]
+    return [
+        '/usr/bin/ffmpeg',
+        '/usr/local/bin/ffmpeg',
+        '/opt/homebrew/bin/ffmpeg',
+        settings.BASE_DIR / 'ffmpeg' / 'ffmpeg',
+    ]
+
+
+@lru_cache(maxsize=None)
+def ffmpeg_path():
+    """The ffmpeg binary: ``FFMPEG_PATH`` if set, else the first usual install
+    location that exists, else ``ffmpeg`` from PATH. Looked up once per process."""
+    path = settings.FFMPEG_PATH
+    if not path:
+        path = next((str(p) for p in _install_locations() if os.path.exists(p)), None)
+    if not path:
+        path = 'ffmpeg.exe' if os.name == 'nt' else 'ffmpeg'
+        logger.warning('Using %s from the system PATH', path)
+    logger.info('Using FFmpeg at %s', path)
+    return path
+
+
+@lru_cache(maxsize=None)
+def ffprobe_path():
+    """The ffprobe next to ``ffmpeg_path()``, else ``ffprobe`` from PATH."""
+    directory, name = os.path.split(ffmpeg_path())
+    path = os.path.join(directory, name.replace('ffmpeg', 'ffprobe'))
+    if directory and os.path.exists(path):
+        return path
+    return shutil.which('ffprobe') or 'ffprobe'
+
+
+@lru_cache(maxsize=None)
+def ffmpeg_version():
+    """First line of ``ffmpeg -version``, run once. Raises ``OSError`` when the
+    binary is missing and ``CalledProcessError`` when it fails."""
+    result = subprocess.run([ffmpeg_path(), '-version'], capture_output=True, text=True,
+                            timeout=5, check=True)
+    return result.stdout.split('\n')[0]
+
+
+def _seconds(match):
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def _number(value):
+    try:
+        return float(value.rstrip('x'))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _progress_line(raw, fields, progress, stage, total):
+    """Collect one ``-progress`` line into ``fields``, reporting at each block's
+    end. Returns the output time reached when a block ends, else None."""
+    key, _, value = raw.decode('utf-8', errors='ignore').strip().partition('=')
+    if key != 'progress':
+        fields[key] = value
+        return None
+    out_time_us = _number(fields.get('out_time_us') or fields.get('out_time_ms'))
+    out_time = out_time_us / 1e6 if out_time_us is not None and out_time_us >= 0 else None
+    if progress:
+        progress(stage,
+                 out_time=out_time,
+                 fps=_number(fields.get('fps')),
+                 speed=_number(fields.get('speed')),
+                 percent=(min(round(100 * out_time / total, 1), 100.0)
+                          if out_time is not None and total else None))
+    fields.clear()
+    return out_time
+
+
+def run(stream_spec, progress=None, stage='encode', duration=None, priority=ENCODE,
+        input_data=None):
+    """Run ``stream_spec`` like ``.run(quiet=True, overwrite_output=True)``.
+
+    Waits for a slot from the encode scheduler first (which may raise
+    ``SchedulerBusy``) and limits ffmpeg to the slot's thread budget.
+
+    ffmpeg writes machine-readable progress (out_time, fps, speed) to stdout,
+    which is forwarded to ``progress(stage, **fields)``. When ``duration``
+    (of the output, in seconds) is not given it is read from the input's
+    ``Duration:`` line so a percentage can still be reported. Raises
+    ``ffmpeg.Error`` with the captured stderr on failure. ``input_data`` is
+    written to ffmpeg's stdin, for graphs reading ``pipe:0``.
+    """
+    with scheduler.slot(priority) as threads, span('encode', op=stage) as details:
+        details['media_seconds'] = _run(stream_spec, progress, stage, duration, threads, input_data)
+
+
+@contextmanager
+def piped(stream_spec, priority=ENCODE, stdin=False, pool=scheduler):
+    """Start ``stream_spec``, whose output is ``pipe:1``, and yield the process.
+
+    The caller reads ``proc.stdout`` (and writes ``proc.stdin`` when
+    ``stdin`` is set). The slot of ``pool`` is held until the block exits,
+    which also kills ffmpeg if it is still running. ffmpeg's stderr is
+    collected in ``proc.stderr_lines``; see ``error()``.
+    """
+    with pool.slot(priority) as threads:
+        proc = subprocess.Popen(_args(stream_spec, threads),
+                                stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.stderr_lines = []
+        reader = threading.Thread(target=proc.stderr_lines.extend, args=(proc.stderr,), daemon=True)
+        reader.start()
+        try:
+            yield proc
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            reader.join()
+            for pipe in (proc.stdin, proc.stdout, proc.stderr):
+                if pipe is not None:
+                    try:
+                        pipe.close()
+                    except OSError:
+                        # A writer thread may still be blocked on stdin
+                        pass
+
+
+def error(proc):
+    """``ffmpeg.Error`` for a failed ``piped()`` process."""
+    import ffmpeg
+    return ffmpeg.Error('ffmpeg', b'', b''.join(proc.stderr_lines))
+
+
+def _args(stream_spec, threads):
+    import ffmpeg
+    args = ffmpeg.compile(stream_spec, cmd=ffmpeg_path(), overwrite_output=True)
+    # Options after the last input and before the output apply to the output,
+    # i.e. the encoder (libx264 takes its thread count from -threads)
+    last_input = len(args) - args[::-1].index('-i') + 1
+    args[last_input:last_input] = ['-threads', str(threads)]
+    args[1:1] = ['-nostats', '-filter_threads', str(threads), '-filter_complex_threads', str(threads)]
+    return args
+
+
+def _run(stream_spec, progress, stage, duration, threads, input_data):
+    """Run ffmpeg and return the output time it reached."""
+    import ffmpeg
+    args = _args(stream_spec, threads)
+    args[1:1] = ['-progress', 'pipe:1']
+    proc = subprocess.Popen(args, stdin=subprocess.DEVNULL if input_data is None else subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed_stdin():
+        try:
+            proc.stdin.write(input_data)
+            proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # ffmpeg stopped reading early, e.g. on an error it reports itself
+            pass
+
+    stderr = []
+    total = [duration]
+
+    def drain_stderr():
+        # Must be read concurrently or ffmpeg blocks on a full pipe
+        for line in proc.stderr:
+            stderr.append(line)
+            if total[0] is None:
+                match = DURATION_RE.search(line)
+                if match:
+                    total[0] = _seconds(match)
+
+    reader = threading.Thread(target=drain_stderr, daemon=True)
+    reader.start()
+    if input_data is not None:
+        threading.Thread(target=feed_stdin, daemon=True).start()
+
+    fields = {}
+    out_time = None
+    for raw in proc.stdout:
+        out_time = _progress_line(raw, fields, progress, stage, total[0]) or out_time
+
+    proc.wait()
+    reader.join()
+    if proc.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', b'', b''.join(stderr))
+    return out_time
+
+
+async def run_async(stream_spec, progress=None, stage='encode', duration=None, priority=ENCODE):
+    """``run()`` for coroutines: ffmpeg runs through ``asyncio.create_subprocess_exec``
+    and neither the slot wait nor the run holds a thread."""
+    import ffmpeg
+    async with scheduler.aslot(priority) as threads:
+        args = _args(stream_spec, threads)
+        args[1:1] = ['-progress', 'pipe:1']
+        with span('encode', op=stage) as details:
+            async with _subprocess(args) as proc:
+                stderr = []
+                total = [duration]
+
+                async def drain_stderr():
+                    async for line in proc.stderr:
+                        stderr.append(line)
+                        if total[0] is None:
+                            match = DURATION_RE.search(line)
+                            if match:
+                                total[0] = _seconds(match)
+
+                reader = asyncio.create_task(drain_stderr())
+                fields = {}
+                async for raw in proc.stdout:
+                    out_time = _progress_line(raw, fields, progress, stage, total[0])
+                    if out_time is not None:
+                        details['media_seconds'] = out_time
+                await proc.wait()
+                await reader
+                if proc.returncode != 0:
+                    raise ffmpeg.Error('ffmpeg', b'', b''.join(stderr))
+
+
+@asynccontextmanager
+async def piped_async(stream_spec, priority=ENCODE, pool=scheduler):
+    """``piped()`` for coroutines, without stdin; ``proc.stdout`` is a StreamReader."""
+    async with pool.aslot(priority) as threads:
+        async with _subprocess(_args(stream_spec, threads)) as proc:
+            proc.stderr_lines = []
+            reader = asyncio.create_task(_collect(proc.stderr, proc.stderr_lines))
+            try:
+                yield proc
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+                await reader
+
+
+def probe(path, **kwargs):
+    """``ffmpeg.probe()`` with the discovered ffprobe."""
+    import ffmpeg
+    with span('probe'):
+        return ffmpeg.probe(path, cmd=ffprobe_path(), **kwargs)
+
+
+async def probe_async(path):
+    """``probe()`` through ``asyncio.create_subprocess_exec``."""
+    import ffmpeg
+    with span('probe'):
+        async with _subprocess([ffprobe_path(), '-show_format', '-show_streams', '-of', 'json', path]) as proc:
+            out, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise ffmpeg.Error('ffprobe', out, err)
+    return json.loads(out.decode('utf-8'))
+
+
+async def _collect(stream, lines):
+    async for line in stream:
+        lines.append(line)
+
+
+@asynccontextmanager
+async def _subprocess(args):
+    proc = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE)
+    try:
+        yield proc
+    finally:
+        # Cancelled, e.g. because the client went away
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
@@ -0,0 +1,193 @@
+"""Ranked format table and the download planner built on it.
+
+The planner picks the cheapest way to deliver what was asked for:
+
+* ``direct``    - a single stream that already is the result; no ffmpeg at all
+* ``remux``     - streams are copied into a new container (video + audio merge,
+                  opus out of webm); ffmpeg runs but barely uses the CPU
+* ``transcode`` - the audio has to be re-encoded into the requested codec
+
+Each plan carries rough estimates of the bytes fetched and the CPU seconds
+spent, which the info endpoint reports next to the formats.
+"""
+import mimetypes
+
+from django.conf import settings
+
+from .cache import TTLCache
+
+AUDIO_FORMATS = ('mp3', 'm4a', 'opus', 'best')
+DEFAULT_AUDIO_FORMAT = 'mp3'
+
+# CPU seconds per second of media, measured on one core with the ffmpeg builds
+# yt-dlp uses; only the order of magnitude matters
+CPU_FACTORS = {
+    'direct': 0.0,
+    'remux': 0.0005,
+    'mp3': 0.02,
+    'm4a': 0.02,
+    'opus': 0.06,
+}
+
+CONTENT_TYPES = {
+    'mp4': 'video/mp4',
+    'webm': 'video/webm',
+    'mkv': 'video/x-matroska',
+    'm4a': 'audio/mp4',
+    'mp3': 'audio/mpeg',
+    'opus': 'audio/ogg',
+    'ogg': 'audio/ogg',
+}
+
+
+def content_type(ext, audio_only=False):
+    """MIME type of a result with extension ``ext``."""
+    if audio_only and ext == 'webm':
+        return 'audio/webm'
+    return CONTENT_TYPES.get(ext) or mimetypes.guess_type(f'x.{ext}')[0] or 'application/octet-stream'
+
+
+def _estimated_bytes(f, duration):
+    size = f.get('filesize') or f.get('filesize_approx')
+    bitrate = f.get('tbr') or f.get('abr')
+    if not size and bitrate and duration:
+        # Bitrates are in kbit/s
+        size = int(bitrate * 1000 / 8 * duration)
+    return size
+
+
+# Tables per extracted info dict; the dicts themselves are shared read-only
+_tables = TTLCache(settings.VIDEO_INFO_CACHE_SIZE)
+
+
+def _rank(entry):
+    return (entry['has_video'], entry['height'] or 0, entry['has_audio'], entry['tbr'] or 0)
+
+
+def format_table(info):
+    """Every downloadable format of ``info``, best first.
+
+    Computed once per extraction of a video, keyed by its ID and extraction
+    time, and must be treated as read-only like ``info`` itself.
+    """
+    key = (info.get('extractor_key'), info['id'], info.get('epoch')) if info.get('id') else None
+    table = _tables.get(key) if key else None
+    if table is None:
+        duration = info.get('duration')
+        table = [{
+            'format_id': f['format_id'],
+            'ext': f.get('ext', 'mp4'),
+            'resolution': f.get('resolution', 'unknown'),
+            'filesize': f.get('filesize'),
+            'note': f.get('format_note', ''),
+            'vcodec': f.get('vcodec'),
+            'acodec': f.get('acodec'),
+            'has_audio': f.get('acodec') != 'none',
+            'has_video': f.get('vcodec') != 'none',
+            'height': f.get('height'),
+            'tbr': f.get('tbr') or f.get('abr'),
+            'bytes': _estimated_bytes(f, duration),
+        } for f in info.get('formats') or [] if f.get('url')]
+        table.sort(key=_rank, reverse=True)
+        if key:
+            _tables.set(key, table, settings.VIDEO_INFO_CACHE_TTL)
+    return table
+
+
+def _best_audio(table, match=lambda entry: True):
+    """Best audio-only entry satisfying ``match``, or None."""
+    audio = [entry for entry in table if entry['has_audio'] and not entry['has_video'] and match(entry)]
+    return max(audio, key=lambda entry: entry['tbr'] or 0, default=None)
+
+
+def _total_bytes(*entries):
+    sizes = [entry['bytes'] if entry else None for entry in entries]
+    return sum(sizes) if all(sizes) else None
+
+
+def _plan(options, pipeline, ext, audio_only, duration, estimated_bytes, cpu=None, streams=None):
+    factor = CPU_FACTORS[cpu or pipeline]
+    return {
+        'options': options,
+        'pipeline': pipeline,
+        'ext': ext,
+        'content_type': content_type(ext, audio_only),
+        'estimated_bytes': estimated_bytes,
+        'estimated_cpu_seconds': round(factor * duration, 2) if duration else None,
+        # Video and audio format IDs that can be downloaded side by side and merged
+        'streams': streams,
+    }
+
+
+def _extract_audio(codec):
+    return [{'key': 'FFmpegExtractAudio', 'preferredcodec': codec, 'preferredquality': '192'}]
+
+
+def plan_video(info, format_id=None):
+    table = format_table(info)
+    duration = info.get('duration')
+    chosen = next((entry for entry in table if entry['format_id'] == format_id), None)
+    if chosen is not None and chosen['has_audio']:
+        # Progressive format: one download, nothing to merge
+        return _plan({'format': format_id}, 'direct', chosen['ext'], False, duration, chosen['bytes'])
+
+    if chosen is not None:
+        audio = _best_audio(table, lambda entry: entry['ext'] == 'm4a') or _best_audio(table)
+        spec = f'{format_id}+bestaudio[ext=m4a]/{format_id}+bestaudio/{format_id}'
+        estimated = _total_bytes(chosen, audio)
+        streams = [format_id, audio['format_id']] if audio is not None else None
+    else:
+        # Unknown or no format ID: take the best there is, as yt-dlp does by default
+        spec = f'{format_id}+bestaudio/{format_id}' if format_id else 'bv*+ba/b'
+        estimated = streams = None
+    return _plan({'format': spec, 'merge_output_format': 'mp4'}, 'remux', 'mp4', False,
+                 duration, estimated, streams=streams)
+
+
+def plan_audio(info, audio_format=None):
+    audio_format = audio_format or DEFAULT_AUDIO_FORMAT
+    table = format_table(info)
+    duration = info.get('duration')
+
+    if audio_format == 'best':
+        native = _best_audio(table)
+        if native is not None:
+            return _plan({'format': native['format_id']}, 'direct', native['ext'], True,
+                         duration, native['bytes'])
+        return _plan({'format': 'bestaudio/best', 'postprocessors': _extract_audio('best')},
+                     'remux', 'm4a', True, duration, None)
+
+    if audio_format == 'mp3':
+        native = _best_audio(table, lambda entry: entry['acodec'] == 'mp3' or entry['ext'] == 'mp3')
+    elif audio_format == 'm4a':
+        native = _best_audio(table, lambda entry: entry['ext'] == 'm4a')
+    else:
+        native = _best_audio(table, lambda entry: (entry['acodec'] or '').startswith('opus'))
+
+    if native is not None and native['ext'] == audio_format:
+        return _plan({'format': native['format_id']}, 'direct', audio_format, True,
+                     duration, native['bytes'])
+    if native is not None:
+        # Right codec, wrong container (opus inside webm): FFmpegExtractAudio copies the stream
+        return _plan({'format': native['format_id'], 'postprocessors': _extract_audio(audio_format)},
+                     'remux', audio_format, True, duration, native['bytes'])
+    source = _best_audio(table)
+    return _plan({'format': 'bestaudio/best', 'postprocessors': _extract_audio(audio_format)},
+                 'transcode', audio_format, True, duration, source['bytes'] if source else None,
+                 cpu=audio_format)
+
+
+def plan_download(info, format_id, audio_only, audio_format=None):
+    """Cheapest plan delivering ``format_id`` (or audio in ``audio_format``).
+
+    Returns a dict with the yt-dlp ``options`` plus ``pipeline``, ``ext``,
+    ``content_type`` and the cost estimates.
+    """
+    if audio_only:
+        return plan_audio(info, audio_format)
+    return plan_video(info, format_id)
+
+
+def plan_cost(plan):
+    """The parts of a plan worth showing to clients."""
+    return {key: value for key, value in plan.items() if key != 'options'}
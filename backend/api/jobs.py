@@ -0,0 +1,169 @@
+"""Background job runner.
+
+Jobs are rows in the ``Job`` table, so anything queued survives a restart.
+Each process runs two thread pools: one for network-bound downloads and one
+for CPU-bound ffmpeg work. Several processes may share one database; a job is
+claimed with a conditional UPDATE so only one of them ever runs it.
+"""
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import Job
+from .media_cache import CacheEntry, derived_cache
+from .progress import ProgressReporter
+from .scheduler import queue_only
+from .scratch import pid_alive, process_started
+from .tracing import traced
+from .pipelines import (save_upload, fetch_media, link_or_copy, file_digest,
+                        trim_video, caption_video, combined_process)
+
+logger = logging.getLogger(__name__)
+
+_pools = {}
+_pools_lock = threading.Lock()
+_recovered = False
+
+
+def _pool(kind):
+    name = 'download' if kind == Job.KIND_DOWNLOAD else 'encode'
+    with _pools_lock:
+        if name not in _pools:
+            workers = (settings.JOB_DOWNLOAD_WORKERS if name == 'download'
+                       else settings.JOB_ENCODE_WORKERS)
+            _pools[name] = ThreadPoolExecutor(max_workers=workers,
+                                              thread_name_prefix=f'job-{name}')
+        return _pools[name]
+
+
+def _execute(job, progress):
+    params = job.params
+    input_path = os.path.join(job.work_dir, 'input.mp4')
+    if job.kind == Job.KIND_DOWNLOAD:
+        section = params.get('section')
+        if section:
+            start, end, frame_accurate = section
+            section = (start, float('inf') if end is None else end, frame_accurate)
+        result_path, result_name, content_type = fetch_media(
+            params['url'], params.get('format_id'), params.get('audio_only', False),
+            job.work_dir, section or None, params.get('captions', ''),
+            progress, params.get('audio_format'))
+    else:
+        # Stored uploads are hashed already; other inputs only when the cache is on
+        digest = params.get('digest')
+        if digest is None and derived_cache.enabled:
+            digest = file_digest(input_path)
+        if job.kind == Job.KIND_TRIM:
+            result_path = trim_video(input_path, params['start'], params['end'], job.work_dir, progress,
+                                     digest=digest)
+            result_name = f"trimmed_{params['name']}"
+        elif job.kind == Job.KIND_CAPTION:
+            result_path = caption_video(input_path, params['captions'], job.work_dir, progress,
+                                        digest=digest)
+            result_name = f"captioned_{params['name']}"
+        elif job.kind == Job.KIND_COMBINED:
+            result_path = combined_process(input_path, params['start'], params['end'],
+                                           params['captions'], job.work_dir,
+                                           frame_accurate=params.get('frame_accurate', False),
+                                           progress=progress, digest=digest)
+            result_name = f"edited_{params['name']}"
+        else:
+            raise ValueError(f'Unknown job kind: {job.kind}')
+        content_type = 'video/mp4'
+    if os.path.dirname(result_path) != job.work_dir:
+        # Give the job its own link so cache eviction can't take the result away
+        result_path = link_or_copy(result_path, os.path.join(job.work_dir, os.path.basename(result_path)))
+    return result_path, result_name, content_type
+
+
+def _run(job_id):
+    close_old_connections()
+    try:
+        claimed = Job.objects.filter(pk=job_id, status=Job.STATUS_QUEUED).update(
+            status=Job.STATUS_RUNNING, worker_pid=os.getpid(), worker_started=process_started(os.getpid()),
+            started_at=timezone.now())
+        if not claimed:
+            # Another worker or process got there first
+            return
+        job = Job.objects.get(pk=job_id)
+        progress = ProgressReporter(str(job.id), job=True)
+        try:
+            with queue_only(), traced(f'job-{job.kind}'):
+                result_path, result_name, content_type = _execute(job, progress)
+        except Exception as e:
+            logger.exception('Job %s failed', job_id)
+            job.status = Job.STATUS_FAILED
+            job.error = str(e)[:1000]
+        else:
+            job.status = Job.STATUS_DONE
+            job.result_path = result_path
+            job.result_name = result_name
+            job.content_type = content_type
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'error', 'result_path', 'result_name',
+                                'content_type', 'finished_at'])
+        progress.finish(job.status)
+    finally:
+        close_old_connections()
+
+
+def _enqueue(job):
+    _pool(job.kind).submit(_run, job.id)
+
+
+def purge_expired():
+    """Delete finished jobs (and their files) older than ``JOB_RESULT_TTL`` seconds."""
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_RESULT_TTL)
+    expired = Job.objects.filter(
+        status__in=[Job.STATUS_DONE, Job.STATUS_FAILED], finished_at__lt=cutoff)
+    for job in expired:
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+    expired.delete()
+
+
+def recover():
+    """Requeue work left behind by a previous run of this or another process.
+
+    Safe to call repeatedly; it only does anything the first time per process.
+    """
+    global _recovered
+    if _recovered:
+        return
+    for job in Job.objects.filter(status=Job.STATUS_RUNNING):
+        # After a restart, workers often get the PIDs of the previous run's
+        if job.worker_pid is None or not pid_alive(job.worker_pid, job.worker_started):
+            Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING).update(
+                status=Job.STATUS_QUEUED, worker_pid=None, worker_started=None, started_at=None)
+    for job in Job.objects.filter(status=Job.STATUS_QUEUED):
+        # Enqueuing twice is harmless, only one worker can claim the job
+        _enqueue(job)
+    purge_expired()
+    _recovered = True
+
+
+def submit(kind, params, upload=None):
+    """Create a job, store its input (an uploaded file or a stored upload
+    entry) and hand it to a worker."""
+    recover()
+    job = Job(kind=kind, params=params)
+    job.work_dir = os.path.join(settings.JOB_ROOT, str(job.id))
+    os.makedirs(job.work_dir, exist_ok=True)
+    try:
+        if isinstance(upload, CacheEntry):
+            # A stored upload; the job gets its own link in case the store expires it
+            link_or_copy(upload.path, os.path.join(job.work_dir, 'input.mp4'))
+        elif upload is not None:
+            save_upload(upload, job.work_dir)
+        job.save()
+    except Exception:
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        raise
+    _enqueue(job)
+    return job
@@ -0,0 +1,189 @@
+"""Shared helpers for the ``bench_*`` management commands."""
+import math
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import ffmpeg
+
+
+def peak_rss_mb():
+    """Peak resident set size of the current process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def disk_write_bytes():
+    """Bytes this process and its reaped children (ffmpeg) caused to be written
+    to storage, or None where ``/proc/self/io`` is unavailable."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines() if line)
+    except OSError:
+        return None
+    return int(fields['write_bytes'])
+
+
+def percentile(values, p):
+    """Nearest-rank ``p``th percentile (0-100) of ``values``."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def _child(queue, fn, args):
+    try:
+        queue.put(('ok', fn(*args)))
+    except Exception as e:
+        queue.put(('error', repr(e)))
+
+
+def run_isolated(fn, *args):
+    """Run ``fn(*args)`` in a fresh forked process and return its result.
+
+    Peak RSS only ever grows within a process, so each measurement needs its
+    own process to be meaningful.
+    """
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_child, args=(queue, fn, args))
+    proc.start()
+    outcome, value = queue.get()
+    proc.join()
+    if outcome == 'error':
+        raise RuntimeError(value)
+    return value
+
+
+def generate_clip(path, duration, size='1280x720', rate=30, gop=None):
+    """Write an H.264/AAC test clip built from ffmpeg's lavfi sources."""
+    video = ffmpeg.input(f'testsrc2=size={size}:rate={rate}', f='lavfi', t=duration)
+    audio = ffmpeg.input('sine=frequency=440:sample_rate=48000', f='lavfi', t=duration)
+    (
+        ffmpeg
+        .output(video, audio, path, **{'c:v': 'libx264', 'preset': 'veryfast',
+                                       'g': gop or rate * 2, 'pix_fmt': 'yuv420p', 'c:a': 'aac',
+                                       'movflags': '+faststart'})
+        .global_args('-y')
+        .run(quiet=True)
+    )
+    return path
+
+
+def sample_srt(duration, every=5, length=2):
+    """SRT text with a short cue every ``every`` seconds."""
+    cues = []
+    for index, start in enumerate(range(0, int(duration), every), 1):
+        cues.append(f'{index}\n{srt_time(start)} --> {srt_time(start + length)}\nCaption {index}\n')
+    return '\n'.join(cues)
+
+
+def srt_time(seconds):
+    ms = int(round(seconds * 1000))
+    return f'{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}'
+
+
+def dir_bytes(path):
+    """Total size of every file under ``path``, i.e. what a pipeline wrote to disk."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler with single-range support, which ffmpeg and yt-dlp
+    need to seek over HTTP. Counts the body bytes it sends, and can stand in
+    for a remote host by delaying each response by the server's ``latency``
+    and capping each connection at ``rate`` bytes per second."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = self.translate_path(self.path)
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if not match or os.path.isdir(path) or not os.path.exists(path):
+            self.range = None
+            return super().send_head()
+        size = os.path.getsize(path)
+        first, last = match.groups()
+        if first:
+            start, end = int(first), int(last) if last else size - 1
+        else:
+            start, end = max(size - int(last), 0), size - 1
+        end = min(end, size - 1)
+        if start >= size:
+            self.send_error(416)
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.range = end - start + 1
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(self.range))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = self.range
+        while remaining is None or remaining > 0:
+            chunk = source.read(64 * 1024 if remaining is None else min(64 * 1024, remaining))
+            if not chunk:
+                break
+            try:
+                outputfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                break
+            self.server.bytes_sent += len(chunk)
+            if self.server.rate:
+                time.sleep(len(chunk) / self.server.rate)
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def end_headers(self):
+        if getattr(self, 'range', None) is None and self.command == 'GET':
+            self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+
+class LocalMediaServer:
+    """Serve ``directory`` on a free localhost port for the duration of a ``with`` block,
+    optionally with ``latency`` seconds per request and ``rate`` bytes/s per connection."""
+
+    def __init__(self, directory, latency=0, rate=None):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=directory))
+        self.httpd.bytes_sent = 0
+        self.httpd.latency = latency
+        self.httpd.rate = rate
+        self.httpd.daemon_threads = True
+
+    @property
+    def bytes_sent(self):
+        return self.httpd.bytes_sent
+
+    def reset(self):
+        self.httpd.bytes_sent = 0
+
+    def url(self, name):
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}/{name}'
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import time
+
+import ffmpeg
+from django.core.management.base import BaseCommand
+
+from api.pipelines import combined_process, write_captions
+from ._bench import generate_clip, sample_srt, dir_bytes
+
+
+def two_step(input_path, start, end, captions, work_dir):
+    """The previous implementation: stream-copy trim, then a second encode pass."""
+    trimmed_path = os.path.join(work_dir, 'trimmed.mp4')
+    probe = ffmpeg.probe(input_path)
+    end = min(end, float(probe['format']['duration']))
+    (
+        ffmpeg
+        .input(input_path, ss=start)
+        .output(trimmed_path, t=end - start, c='copy')
+        .run(overwrite_output=True, quiet=True)
+    )
+    output_path = os.path.join(work_dir, 'final.mp4')
+    srt_escaped = write_captions(captions, work_dir)
+    stream = ffmpeg.input(trimmed_path)
+    video = stream.video.filter('subtitles', filename=srt_escaped)
+    (
+        ffmpeg
+        .output(video, stream.audio, output_path,
+                **{'c:v': 'libx264', 'preset': 'fast', 'crf': '23', 'c:a': 'copy'})
+        .global_args('-y')
+        .run(quiet=True)
+    )
+    return output_path
+
+
+class Command(BaseCommand):
+    help = 'Compare the fused trim + caption pipeline with the old two-step one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=int, default=120, help='Source clip length in seconds')
+        parser.add_argument('--size', default='1280x720')
+        parser.add_argument('--start', type=float, default=30.5)
+        parser.add_argument('--end', type=float, default=90.0)
+        parser.add_argument('--runs', type=int, default=3)
+
+    def handle(self, *args, **options):
+        source_dir = tempfile.mkdtemp()
+        try:
+            source = generate_clip(os.path.join(source_dir, 'source.mp4'),
+                                   options['duration'], options['size'])
+            captions = sample_srt(options['duration'])
+            variants = {
+                'two-step': two_step,
+                'fused': combined_process,
+                'fused (frame accurate)': lambda *a: combined_process(*a, frame_accurate=True),
+            }
+            for name, fn in variants.items():
+                timings = []
+                for _ in range(options['runs']):
+                    work_dir = tempfile.mkdtemp()
+                    try:
+                        started = time.perf_counter()
+                        fn(source, options['start'], options['end'], captions, work_dir)
+                        timings.append(time.perf_counter() - started)
+                        # Everything left in the work dir was written by the pipeline
+                        written = dir_bytes(work_dir)
+                    finally:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                self.stdout.write(
+                    f'{name:<24} best {min(timings):.2f}s  '
+                    f'disk written {written / 1024 ** 2:.1f} MiB'
+                )
+        finally:
+            shutil.rmtree(source_dir, ignore_errors=True)
@@ -0,0 +1,204 @@
+import asyncio
+import importlib
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from io import BytesIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import clear_url_caches
+
+from ._bench import LocalMediaServer, generate_clip, peak_rss_mb, run_isolated
+
+MODES = {
+    # Sync views on a thread per connection, like gunicorn's gthread worker
+    'wsgi': 'WSGI, thread per client',
+    # Sync views under ASGI before streamed responses were adapted: Django
+    # reads every sync iterator into a list before sending it
+    'asgi-before': 'ASGI, sync views, buffered',
+    'asgi-sync': 'ASGI, sync views',
+    'asgi': 'ASGI, async views',
+}
+
+
+def _current_rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+
+def _load_urls(async_views):
+    settings.ASYNC_VIEWS = async_views
+    import api.urls
+    import youtube_downloader.urls
+    importlib.reload(api.urls)
+    importlib.reload(youtube_downloader.urls)
+    clear_url_caches()
+
+
+def _wsgi_client(app, method, path, body, delay, result):
+    environ = {
+        'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '443', 'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.url_scheme': 'https',
+        'wsgi.input': BytesIO(body), 'wsgi.errors': BytesIO(), 'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    started = time.perf_counter()
+    response = app(environ, lambda status, headers: result.update(status=status.split()[0]))
+    try:
+        for chunk in response:
+            result.setdefault('ttfb', time.perf_counter() - started)
+            result['bytes'] = result.get('bytes', 0) + len(chunk)
+            time.sleep(delay)
+    finally:
+        response.close()
+
+
+async def _asgi_client(app, method, path, body, delay, result):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'https', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+        'headers': [(b'host', b'localhost'), (b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode())],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 443),
+    }
+    finished = asyncio.Event()
+    received = False
+    started = time.perf_counter()
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            result['status'] = str(message['status'])
+        elif message['type'] == 'http.response.body':
+            if message.get('body'):
+                result.setdefault('ttfb', time.perf_counter() - started)
+                result['bytes'] = result.get('bytes', 0) + len(message['body'])
+                # A slow client: the next chunk only goes out once this one is read
+                await asyncio.sleep(delay)
+            if not message.get('more_body'):
+                finished.set()
+
+    await app(scope, receive, send)
+
+
+def _serve(mode, requests, delay, overrides):
+    with override_settings(**overrides):
+        _load_urls(mode == 'asgi')
+        patches = []
+        if mode == 'asgi-before':
+            for target in ('api.streaming.streaming_content', 'api.views.streaming_content'):
+                patches.append(mock.patch(target, lambda request, iterator: iterator))
+        for patch in patches:
+            patch.start()
+
+        baseline = _current_rss_mb()
+        results = [{} for _ in requests]
+        peak_threads = threading.active_count()
+        sampling = True
+
+        def sample():
+            nonlocal peak_threads
+            while sampling:
+                peak_threads = max(peak_threads, threading.active_count())
+                time.sleep(0.02)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        started = time.perf_counter()
+        if mode == 'wsgi':
+            app = WSGIHandler()
+            clients = [threading.Thread(target=_wsgi_client, args=(app, method, path, body, delay, result))
+                       for (method, path, body), result in zip(requests, results)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+        else:
+            app = ASGIHandler()
+
+            async def run_all():
+                await asyncio.gather(*(_asgi_client(app, method, path, body, delay, result)
+                                       for (method, path, body), result in zip(requests, results)))
+
+            asyncio.run(run_all())
+        elapsed = time.perf_counter() - started
+        sampling = False
+        sampler.join()
+        for patch in patches:
+            patch.stop()
+
+    ttfb = [r['ttfb'] for r in results if 'ttfb' in r]
+    return {
+        'ok': sum(1 for r in results if r.get('status') == '200'),
+        'bytes': sum(r.get('bytes', 0) for r in results),
+        'seconds': elapsed,
+        'threads': peak_threads,
+        'rss_growth_mb': peak_rss_mb() - baseline,
+        'ttfb_p50': statistics.median(ttfb) if ttfb else None,
+        'ttfb_max': max(ttfb) if ttfb else None,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Hold many slow streaming clients open under WSGI and ASGI and compare threads and memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=('download', 'progress'), default='download',
+                            help='Slow downloads of a cached video, or idle progress event streams')
+        parser.add_argument('--clients', type=int, default=200)
+        parser.add_argument('--duration', type=int, default=30, help='Length of the downloaded clip in seconds')
+        parser.add_argument('--delay', type=float, default=0.05,
+                            help='Seconds a slow client takes to read each 64 KiB chunk')
+        parser.add_argument('--hold', type=int, default=10, help='Seconds each progress stream stays open')
+        parser.add_argument('--modes', default=','.join(MODES))
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp()
+        overrides = {'STREAM_CHUNK_SIZE': 64 * 1024, 'MEDIA_CACHE_DIR': os.path.join(work_dir, 'cache')}
+        try:
+            with LocalMediaServer(work_dir) as server:
+                if options['scenario'] == 'download':
+                    generate_clip(os.path.join(work_dir, 'clip.mp4'), options['duration'], '1280x720')
+                    body = json.dumps({'url': server.url('clip.mp4')}).encode()
+                    requests = [('POST', '/api/download/', body)] * options['clients']
+                    # Download once so every client streams from the media cache
+                    with override_settings(**overrides):
+                        response = Client().post('/api/download/', body, content_type='application/json',
+                                                 secure=True)
+                        b''.join(response.streaming_content)
+                        response.close()
+                    size = os.path.getsize(os.path.join(work_dir, 'clip.mp4'))
+                    self.stdout.write(f"{options['clients']} clients downloading a {size / 1024 ** 2:.1f} MiB "
+                                      f"video at {64 / options['delay'] / 1024:.1f} MiB/s each")
+                else:
+                    overrides.update(PROGRESS_STREAM_TIMEOUT=options['hold'], PROGRESS_KEEPALIVE=1)
+                    requests = [('GET', f'/api/progress/bench-{i}/', b'') for i in range(options['clients'])]
+                    self.stdout.write(f"{options['clients']} idle progress streams held for {options['hold']}s")
+
+                for mode in options['modes'].split(','):
+                    result = run_isolated(_serve, mode, requests, options['delay'], overrides)
+                    ttfb = (f"TTFB p50 {result['ttfb_p50']:.2f}s max {result['ttfb_max']:.2f}s"
+                            if result['ttfb_p50'] is not None else 'no bytes sent')
+                    self.stdout.write(
+                        f"{MODES[mode]:<28} {result['ok']:>4}/{len(requests)} ok  "
+                        f"peak threads {result['threads']:>4}  peak RSS +{result['rss_growth_mb']:7.1f} MiB  "
+                        f"{ttfb}  {result['seconds']:.1f}s"
+                    )
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
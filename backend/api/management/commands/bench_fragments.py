@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpeg
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from api.connections import host_connections
+from api.formats import format_table
+from api.metadata import get_video_info
+from api.pipelines import download_video
+from ._bench import generate_clip, LocalMediaServer
+
+MASTER_PLAYLIST = '''#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="main",DEFAULT=YES,AUTOSELECT=YES,URI="audio/index.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={size},CODECS="avc1.640028,mp4a.40.2",AUDIO="audio"
+video/index.m3u8
+'''
+
+
+def write_hls(clip, directory, segment, size):
+    """Split ``clip`` into video-only and audio-only fMP4 HLS renditions under a
+    master playlist, the way streaming sites serve separate DASH/HLS streams."""
+    for kind, stream in (('video', ffmpeg.input(clip).video), ('audio', ffmpeg.input(clip).audio)):
+        os.makedirs(os.path.join(directory, kind))
+        (
+            ffmpeg
+            .output(stream, os.path.join(directory, kind, 'index.m3u8'), c='copy', f='hls', hls_time=segment,
+                    hls_playlist_type='vod', hls_segment_type='fmp4', hls_fmp4_init_filename='init.mp4',
+                    hls_segment_filename=os.path.join(directory, kind, '%04d.m4s'))
+            .global_args('-y')
+            .run(quiet=True)
+        )
+    bandwidth = int(os.path.getsize(clip) * 8 / float(ffmpeg.probe(clip)['format']['duration']))
+    with open(os.path.join(directory, 'master.m3u8'), 'w') as f:
+        f.write(MASTER_PLAYLIST.format(bandwidth=bandwidth, size=size))
+
+
+class Command(BaseCommand):
+    help = ('Download a fragmented HLS video with separate audio from a local stand-in server that '
+            'adds latency and caps per-connection bandwidth, across fragment concurrency, parallel '
+            'video/audio streams and the per-host connection limit')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=int, default=60, help='Video length in seconds')
+        parser.add_argument('--size', default='1280x720')
+        parser.add_argument('--segment', type=float, default=2, help='HLS fragment length in seconds')
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every request')
+        parser.add_argument('--rate', type=float, default=4, help='MiB/s per connection (0: unlimited)')
+        parser.add_argument('--fragments', default='1,2,4,8', help='Concurrent fragments, comma-separated')
+        parser.add_argument('--downloads', type=int, default=1, help='Downloads running at once')
+        parser.add_argument('--host-connections', type=int, default=0,
+                            help='Per-host connection limit (0: none)')
+
+    def handle(self, *args, **options):
+        source_dir = tempfile.mkdtemp()
+        previous_limit = host_connections.limit
+        host_connections.limit = options['host_connections']
+        try:
+            clip = generate_clip(os.path.join(source_dir, 'source.mp4'), options['duration'], options['size'],
+                                 gop=int(30 * options['segment']))
+            write_hls(clip, os.path.join(source_dir, 'hls'), options['segment'], options['size'])
+            with LocalMediaServer(os.path.join(source_dir, 'hls'), latency=options['latency'],
+                                  rate=options['rate'] * 1024 ** 2 or None) as server:
+                url = server.url('master.m3u8')
+                format_id = next(f['format_id'] for f in format_table(get_video_info(url)) if f['has_video'])
+                self.stdout.write(f"{'fragments':>9} {'streams':<10} {'seconds':>8} {'MiB/s':>7} "
+                                  f"{'network MiB':>11}")
+                for fragments in map(int, options['fragments'].split(',')):
+                    for parallel in (False, True):
+                        with override_settings(YTDL_CONCURRENT_FRAGMENTS=fragments,
+                                               YTDL_PARALLEL_STREAMS=parallel):
+                            self.run(server, url, format_id, fragments, parallel, options['downloads'])
+        finally:
+            host_connections.limit = previous_limit
+            shutil.rmtree(source_dir, ignore_errors=True)
+
+    def run(self, server, url, format_id, fragments, parallel, downloads):
+        work_dirs = [tempfile.mkdtemp() for _ in range(downloads)]
+        try:
+            server.reset()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=downloads) as pool:
+                paths = list(pool.map(lambda work_dir: download_video(url, format_id, False, work_dir)[0],
+                                      work_dirs))
+            elapsed = time.perf_counter() - started
+            size = sum(os.path.getsize(path) for path in paths)
+            self.stdout.write(
+                f"{fragments:>9} {'parallel' if parallel else 'serial':<10} {elapsed:8.2f} "
+                f"{size / 1024 ** 2 / elapsed:7.2f} {server.bytes_sent / 1024 ** 2:11.1f}"
+            )
+        finally:
+            for work_dir in work_dirs:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import time
+
+import ffmpeg
+from django.core.management.base import BaseCommand
+
+from api.pipelines import download_video, fetch_media
+from ._bench import generate_clip, sample_srt, dir_bytes, LocalMediaServer
+
+
+class Command(BaseCommand):
+    help = ('Download a clip window from a locally served test video and compare '
+            'network and disk bytes with a full download')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=int, default=600, help='Source video length in seconds')
+        parser.add_argument('--size', default='1280x720')
+        parser.add_argument('--start', type=float, default=300.0)
+        parser.add_argument('--end', type=float, default=320.0)
+
+    def handle(self, *args, **options):
+        source_dir = tempfile.mkdtemp()
+        try:
+            generate_clip(os.path.join(source_dir, 'source.mp4'), options['duration'], options['size'])
+            start, end = options['start'], options['end']
+            with LocalMediaServer(source_dir) as server:
+                url = server.url('source.mp4')
+                runs = [
+                    ('full download', lambda d: download_video(url, 'mp4', False, d)),
+                    ('ranged, keyframe cut', lambda d: download_video(url, 'mp4', False, d, (start, end, False))),
+                    ('ranged, exact cut', lambda d: download_video(url, 'mp4', False, d, (start, end, True))),
+                    ('ranged + captions', lambda d: fetch_media(url, 'mp4', False, d, (start, end, True),
+                                                                sample_srt(options['duration']))),
+                ]
+                for name, run in runs:
+                    work_dir = tempfile.mkdtemp()
+                    try:
+                        server.reset()
+                        started = time.perf_counter()
+                        path, _, _ = run(work_dir)
+                        elapsed = time.perf_counter() - started
+                        duration = float(ffmpeg.probe(path)['format']['duration'])
+                        self.stdout.write(
+                            f'{name:<22} {elapsed:6.2f}s  network {server.bytes_sent / 1024 ** 2:8.1f} MiB  '
+                            f'disk {dir_bytes(work_dir) / 1024 ** 2:8.1f} MiB  output {duration:.1f}s'
+                        )
+                    finally:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+        finally:
+            shutil.rmtree(source_dir, ignore_errors=True)
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import time
+
+import ffmpeg
+from django.core.management.base import BaseCommand
+
+from api.pipelines import caption_video, caption_video_segmented
+from api.scheduler import scheduler
+from ._bench import generate_clip, sample_srt
+
+
+def frame_count(path):
+    probe = ffmpeg.probe(path, select_streams='v:0', count_packets=None,
+                         show_entries='stream=nb_read_packets')
+    return int(probe['streams'][0]['nb_read_packets'])
+
+
+class Command(BaseCommand):
+    help = 'Compare a single caption encode with segmented parallel encodes at several worker counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=int, default=120, help='Source clip length in seconds')
+        parser.add_argument('--size', default='1280x720')
+        parser.add_argument('--workers', type=int, nargs='+',
+                            help='Worker counts to try (default: 2, 4, ... up to the core count)')
+        parser.add_argument('--runs', type=int, default=1)
+
+    def handle(self, *args, **options):
+        cores = os.cpu_count() or 1
+        worker_counts = options['workers'] or [n for n in (2, 4, 8, 16, 32) if n < cores] + [max(cores, 2)]
+        saved = scheduler.slots, scheduler.threads, scheduler.max_wait
+        source_dir = tempfile.mkdtemp()
+        try:
+            source = generate_clip(os.path.join(source_dir, 'source.mp4'),
+                                   options['duration'], options['size'])
+            captions = sample_srt(options['duration'])
+            expected_frames = frame_count(source)
+            scheduler.max_wait = float('inf')
+            self.stdout.write(f'{cores} cores, {options["duration"]}s {options["size"]} clip, '
+                              f'{expected_frames} frames')
+
+            # One encode with every core, as before
+            scheduler.slots, scheduler.threads = 1, cores
+            baseline = self.measure(options['runs'], expected_frames,
+                                    lambda work_dir: caption_video(source, captions, work_dir))
+            self.stdout.write(f'{"single encode":<22} best {baseline:.2f}s')
+
+            for workers in worker_counts:
+                scheduler.slots, scheduler.threads = workers, max(1, cores // workers)
+                best = self.measure(options['runs'], expected_frames,
+                                    lambda work_dir: caption_video_segmented(
+                                        source, captions, work_dir, workers))
+                self.stdout.write(f'{f"segmented x{workers}":<22} best {best:.2f}s  '
+                                  f'speedup {baseline / best:.2f}x')
+        finally:
+            scheduler.slots, scheduler.threads, scheduler.max_wait = saved
+            shutil.rmtree(source_dir, ignore_errors=True)
+
+    def measure(self, runs, expected_frames, fn):
+        timings = []
+        for _ in range(runs):
+            work_dir = tempfile.mkdtemp()
+            try:
+                started = time.perf_counter()
+                output_path = fn(work_dir)
+                timings.append(time.perf_counter() - started)
+                frames = frame_count(output_path)
+                if frames != expected_frames:
+                    self.stderr.write(f'  frame count {frames}, expected {expected_frames}')
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        return min(timings)
@@ -0,0 +1,89 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from api.pipelines import caption_video
+from ._bench import generate_clip, srt_time
+
+
+def frame_hashes(path):
+    """``[(pts, md5)]`` of every decoded video frame, in order."""
+    out = subprocess.run(['ffmpeg', '-v', 'error', '-i', path, '-map', '0:v', '-fps_mode', 'passthrough',
+                          '-f', 'framemd5', '-'], capture_output=True, text=True, check=True).stdout
+    frames = []
+    for line in out.splitlines():
+        if not line.startswith('#'):
+            fields = [field.strip() for field in line.split(',')]
+            frames.append((int(fields[2]), fields[5]))
+    return frames
+
+
+def frame_psnr(path, reference, work_dir):
+    """Per-frame PSNR of ``path`` against ``reference``."""
+    stats_path = os.path.join(work_dir, 'psnr.log')
+    subprocess.run(['ffmpeg', '-v', 'error', '-i', path, '-i', reference,
+                    '-lavfi', f'[0:v][1:v]psnr=stats_file={stats_path}', '-f', 'null', '-'],
+                   check=True)
+    with open(stats_path) as f:
+        return [float(m.group(1)) if m.group(1) != 'inf' else float('inf')
+                for m in re.finditer(r'psnr_avg:(\S+)', f.read())]
+
+
+class Command(BaseCommand):
+    help = 'Check smart caption rendering frame by frame against a full encode and time both'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=int, default=300, help='Source clip length in seconds')
+        parser.add_argument('--size', default='1280x720')
+        parser.add_argument('--min-psnr', type=float, default=35.0,
+                            help='Lowest acceptable per-frame PSNR against the full encode')
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp()
+        try:
+            duration = options['duration']
+            source = generate_clip(os.path.join(work_dir, 'source.mp4'), duration, options['size'])
+            # A title card and one caption in the middle
+            captions = (f'1\n{srt_time(1)} --> {srt_time(4)}\nTitle card\n\n'
+                        f'2\n{srt_time(duration / 2)} --> {srt_time(duration / 2 + 2)}\nHalfway\n')
+
+            full_dir = os.path.join(work_dir, 'full')
+            smart_dir = os.path.join(work_dir, 'smart')
+            os.makedirs(full_dir)
+            os.makedirs(smart_dir)
+            with override_settings(SMART_RENDER_MAX_COVERAGE=0, CAPTION_SEGMENT_MIN_DURATION=float('inf')):
+                started = time.perf_counter()
+                full = caption_video(source, captions, full_dir)
+                full_time = time.perf_counter() - started
+            started = time.perf_counter()
+            smart = caption_video(source, captions, smart_dir)
+            smart_time = time.perf_counter() - started
+
+            source_frames = frame_hashes(source)
+            full_frames = frame_hashes(full)
+            smart_frames = frame_hashes(smart)
+            if [pts for pts, _ in smart_frames] != [pts for pts, _ in full_frames]:
+                raise CommandError(f'Frame timestamps differ: {len(smart_frames)} smart frames, '
+                                   f'{len(full_frames)} full encode frames')
+            copied = sum(1 for a, b in zip(smart_frames, source_frames) if a == b)
+            psnr = frame_psnr(smart, full, work_dir)
+            worst = min(psnr)
+            # Identical frames have infinite PSNR
+            finite = [value for value in psnr if value != float('inf')] or [worst]
+
+            self.stdout.write(f'full encode   {full_time:.2f}s')
+            self.stdout.write(f'smart render  {smart_time:.2f}s  speedup {full_time / smart_time:.1f}x')
+            self.stdout.write(f'{len(smart_frames)} frames, {copied} copied bit-exact from the source, '
+                              f'{len(smart_frames) - copied} re-encoded')
+            self.stdout.write(f'PSNR against the full encode: min {worst:.1f} dB, '
+                              f'mean {sum(finite) / len(finite):.1f} dB')
+            if worst < options['min_psnr']:
+                raise CommandError(f'Lowest per-frame PSNR {worst:.1f} dB is below {options["min_psnr"]} dB')
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,101 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import shutil
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ._bench import LocalMediaServer, generate_clip
+
+# Runs in a fresh interpreter: boots the WSGI application, then times info
+# lookups of URLs nobody has looked up yet, through the view and directly
+WORKER = '''
+import json, sys, time
+import os
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'youtube_downloader.settings')
+from youtube_downloader.wsgi import application
+ready = time.time()
+
+from django.test import Client
+from api.metadata import _extract
+from api.ytdl import INFO_OPTIONS
+
+urls = json.loads(sys.argv[1])
+client = Client()
+requests = []
+for url in urls[:-2]:
+    started = time.perf_counter()
+    response = client.post('/api/info/', {'url': url}, content_type='application/json', secure=True)
+    assert response.status_code == 200, response.content
+    requests.append(time.perf_counter() - started)
+
+started = time.perf_counter()
+_extract(urls[-2])
+pooled = time.perf_counter() - started
+
+import yt_dlp
+started = time.perf_counter()
+with yt_dlp.YoutubeDL(dict(INFO_OPTIONS)) as ydl:
+    ydl.extract_info(urls[-1], download=False)
+fresh = time.perf_counter() - started
+
+print(json.dumps({'ready': ready, 'requests': requests, 'pooled': pooled, 'fresh': fresh}))
+'''
+
+
+def _worker(urls, warm_up):
+    env = dict(os.environ, WARM_UP=str(warm_up), ASYNC_VIEWS='False')
+    launched = time.time()
+    result = subprocess.run([sys.executable, '-c', WORKER, json.dumps(urls)], cwd=settings.BASE_DIR,
+                            env=env, capture_output=True, text=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['boot'] = timings.pop('ready') - launched
+    return timings
+
+
+def _command_seconds(*args):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, 'manage.py', *args], cwd=settings.BASE_DIR,
+                   capture_output=True, check=True)
+    return time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = 'Time process startup, management commands and the first info lookups of a worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5, help='Info lookups per worker')
+        parser.add_argument('--runs', type=int, default=3, help='Workers started per configuration')
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp()
+        try:
+            generate_clip(os.path.join(work_dir, 'clip.mp4'), 2, '320x240')
+            check = statistics.median(_command_seconds('check') for _ in range(options['runs']))
+            self.stdout.write(f'manage.py check: {check:.2f}s')
+
+            with LocalMediaServer(work_dir) as server:
+                count = 0
+                for warm_up in (False, True):
+                    runs = []
+                    for _ in range(options['runs']):
+                        # Distinct query strings, so every lookup misses the metadata cache
+                        urls = [server.url(f'clip.mp4?n={count + i}') for i in range(options['requests'] + 2)]
+                        count += len(urls)
+                        runs.append(_worker(urls, warm_up))
+                    median = lambda key: statistics.median(run[key] for run in runs)
+                    first = statistics.median(run['requests'][0] for run in runs)
+                    rest = statistics.median(t for run in runs for t in run['requests'][1:])
+                    self.stdout.write(
+                        f"WARM_UP={warm_up!s:<5}  worker boot {median('boot'):5.2f}s  "
+                        f"first info request {first * 1000:6.0f} ms  later requests {rest * 1000:5.0f} ms  "
+                        f"lookup with pooled YoutubeDL {median('pooled') * 1000:4.0f} ms, "
+                        f"with a new one {median('fresh') * 1000:4.0f} ms"
+                    )
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from api.streaming import stream_file
+from ._bench import peak_rss_mb, run_isolated
+
+
+def _serve(path, mode):
+    baseline = peak_rss_mb()
+    request = RequestFactory().post('/api/download/')
+    started = time.perf_counter()
+    if mode == 'buffered':
+        # What the views used to do
+        with open(path, 'rb') as f:
+            response = HttpResponse(f.read(), content_type='video/mp4')
+        sent = len(response.content)
+    else:
+        response = stream_file(request, path, 'bench.mp4', 'video/mp4')
+        sent = sum(len(chunk) for chunk in response)
+        response.close()
+    return {
+        'bytes': sent,
+        'seconds': time.perf_counter() - started,
+        'rss_growth_mb': peak_rss_mb() - baseline,
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compare peak RSS of streamed vs. buffered file responses across file sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='16,128,512',
+                            help='Comma separated file sizes in MiB')
+        parser.add_argument('--skip-buffered', action='store_true',
+                            help='Only measure the streaming path')
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+        modes = ['streamed'] if options['skip_buffered'] else ['streamed', 'buffered']
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for size in sizes:
+                path = os.path.join(temp_dir, f'{size}.bin')
+                with open(path, 'wb') as f:
+                    chunk = os.urandom(1024 * 1024)
+                    for _ in range(size):
+                        f.write(chunk)
+                for mode in modes:
+                    result = run_isolated(_serve, path, mode)
+                    self.stdout.write(
+                        f"{size:>6} MiB  {mode:<9} peak RSS +{result['rss_growth_mb']:.1f} MiB  "
+                        f"{result['seconds']:.2f}s"
+                    )
+                os.remove(path)
@@ -0,0 +1,234 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+
+from ._bench import (LocalMediaServer, disk_write_bytes, generate_clip, peak_rss_mb, percentile,
+                     run_isolated, sample_srt)
+
+PATHS = {
+    'info': '/api/info/',
+    'download': '/api/download/',
+    'trim': '/api/trim/',
+    'caption': '/api/caption/',
+    'combined': '/api/combined/',
+}
+
+# Comparing runs of a different format would only mislead
+FORMAT_VERSION = 1
+
+
+def _git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=settings.BASE_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def _send(endpoint, clip, cached):
+    """Make one request and read the whole response; returns (status, body bytes)."""
+    client = Client()
+    if endpoint in ('info', 'download'):
+        # A query string of its own, unless caching is measured, so every
+        # request extracts and downloads
+        url = clip['url'] if cached else f"{clip['url']}?n={uuid.uuid4().hex}"
+        response = client.post(PATHS[endpoint], {'url': url}, content_type='application/json', secure=True)
+    else:
+        data = {'start': clip['duration'] * 0.25, 'end': clip['duration'] * 0.75}
+        if endpoint != 'trim':
+            data['captions'] = sample_srt(clip['duration'])
+        with open(clip['path'], 'rb') as f:
+            data['video'] = f
+            response = client.post(PATHS[endpoint], data, secure=True)
+    try:
+        if response.streaming:
+            size = sum(len(chunk) for chunk in response.streaming_content)
+        else:
+            size = len(response.content)
+    finally:
+        response.close()
+    return response.status_code, size
+
+
+def _scenario(endpoint, clip, concurrency, count, warmup, cached, overrides):
+    """Run in a forked process: ``count`` requests, ``concurrency`` at a time."""
+    from api.media_cache import media_cache, derived_cache
+    if not cached:
+        media_cache.max_bytes = derived_cache.max_bytes = 0
+
+    with override_settings(**overrides):
+        for _ in range(warmup):
+            _send(endpoint, clip, cached)
+
+        def timed(_):
+            started = time.perf_counter()
+            status, size = _send(endpoint, clip, cached)
+            return status, size, time.perf_counter() - started
+
+        baseline_rss = peak_rss_mb()
+        written = disk_write_bytes()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(timed, range(count)))
+        elapsed = time.perf_counter() - started
+        if written is not None:
+            written = disk_write_bytes() - written
+
+    latencies = [seconds for status, _, seconds in results if status < 400]
+    body_bytes = sum(size for status, size, _ in results if status < 400)
+    return {
+        'endpoint': endpoint,
+        'clip': clip['name'],
+        'duration': clip['duration'],
+        'size': clip['size'],
+        'concurrency': concurrency,
+        'requests': count,
+        'ok': len(latencies),
+        'statuses': sorted({status for status, _, _ in results}),
+        'seconds': round(elapsed, 4),
+        'p50': round(percentile(latencies, 50), 4) if latencies else None,
+        'p95': round(percentile(latencies, 95), 4) if latencies else None,
+        'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+        'requests_per_second': round(len(latencies) / elapsed, 3),
+        'response_mib_per_second': round(body_bytes / 1024 ** 2 / elapsed, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'rss_growth_mb': round(peak_rss_mb() - baseline_rss, 1),
+        'disk_write_bytes': written,
+    }
+
+
+def _key(result):
+    return result['endpoint'], result['clip'], result['concurrency']
+
+
+def _change(old, new):
+    if old is None or new is None or not old:
+        return '     n/a'
+    return f'{(new - old) / old * 100:+7.1f}%'
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the info, download and edit endpoints offline against generated media '
+            'served from a local HTTP server, and write the results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', default=','.join(PATHS), help='Comma-separated, from: ' + ', '.join(PATHS))
+        parser.add_argument('--durations', default='10,30', help='Clip lengths in seconds, comma-separated')
+        parser.add_argument('--sizes', default='640x360,1280x720', help='Clip resolutions, comma-separated')
+        parser.add_argument('--concurrency', default='1,4', help='Requests in flight at once, comma-separated')
+        parser.add_argument('--requests', type=int, default=4, help='Measured requests per scenario')
+        parser.add_argument('--warmup', type=int, default=1, help='Unmeasured requests before each scenario')
+        parser.add_argument('--cached', action='store_true',
+                            help='Leave the media and derived caches on and repeat identical requests')
+        parser.add_argument('--output', help='JSON file to write (default: bench-<commit>.json)')
+        parser.add_argument('--compare', help='Earlier JSON results to print changes against')
+
+    def handle(self, *args, **options):
+        endpoints = options['endpoints'].split(',')
+        unknown = set(endpoints) - set(PATHS)
+        if unknown:
+            raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            if baseline.get('format') != FORMAT_VERSION:
+                raise CommandError(f"{options['compare']} was written by another version of this command")
+
+        commit = _git_commit()
+        output = options['output'] or f"bench-{commit or 'unknown'}.json"
+        work_dir = tempfile.mkdtemp()
+        overrides = {
+            'SCRATCH_ROOT': os.path.join(work_dir, 'scratch'),
+            'JOB_ROOT': os.path.join(work_dir, 'jobs'),
+            'PROFILE_SAMPLE_RATE': 0,
+        }
+        results = []
+        try:
+            with LocalMediaServer(work_dir) as server:
+                clips = []
+                for duration in map(int, options['durations'].split(',')):
+                    for size in options['sizes'].split(','):
+                        name = f'{duration}s_{size}'
+                        path = generate_clip(os.path.join(work_dir, f'{name}.mp4'), duration, size)
+                        clips.append({'name': name, 'path': path, 'url': server.url(f'{name}.mp4'),
+                                      'duration': duration, 'size': size})
+                self.stdout.write(f"{'endpoint':<9} {'clip':<16} {'conc':>4} {'ok':>5} {'p50':>8} {'p95':>8} "
+                                  f"{'req/s':>7} {'MiB/s':>7} {'RSS+':>7} {'written':>9}")
+                for endpoint in endpoints:
+                    for clip in clips:
+                        for concurrency in map(int, options['concurrency'].split(',')):
+                            result = run_isolated(_scenario, endpoint, clip, concurrency, options['requests'],
+                                                  options['warmup'], options['cached'], overrides)
+                            results.append(result)
+                            self.stdout.write(self.format(result))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        report = {
+            'format': FORMAT_VERSION,
+            'commit': commit,
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'ffmpeg': self.ffmpeg_version(),
+            },
+            'options': {key: options[key] for key in ('endpoints', 'durations', 'sizes', 'concurrency',
+                                                      'requests', 'warmup', 'cached')},
+            'results': results,
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(f'Results written to {output}')
+        if baseline is not None:
+            self.compare(baseline, report)
+
+    def ffmpeg_version(self):
+        from api.ffmpeg_runner import ffmpeg_version
+        try:
+            return ffmpeg_version()
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    def format(self, result):
+        def seconds(value):
+            return f'{value:7.3f}s' if value is not None else '     n/a'
+        written = result['disk_write_bytes']
+        return (f"{result['endpoint']:<9} {result['clip']:<16} {result['concurrency']:>4} "
+                f"{result['ok']:>2}/{result['requests']:<2} {seconds(result['p50'])} {seconds(result['p95'])} "
+                f"{result['requests_per_second']:7.2f} {result['response_mib_per_second']:7.2f} "
+                f"{result['rss_growth_mb']:6.1f}M "
+                f"{written / 1024 ** 2 if written is not None else float('nan'):8.1f}M")
+
+    def compare(self, baseline, report):
+        self.stdout.write(f"\nChanges since {baseline.get('commit') or baseline['created']} "
+                          f"(negative latency is faster)")
+        before = {_key(result): result for result in baseline['results']}
+        for result in report['results']:
+            old = before.get(_key(result))
+            if old is None:
+                continue
+            self.stdout.write(
+                f"{result['endpoint']:<9} {result['clip']:<16} {result['concurrency']:>4}  "
+                f"p50 {_change(old['p50'], result['p50'])}  p95 {_change(old['p95'], result['p95'])}  "
+                f"req/s {_change(old['requests_per_second'], result['requests_per_second'])}  "
+                f"written {_change(old['disk_write_bytes'], result['disk_write_bytes'])}"
+            )
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from ._bench import generate_clip, sample_srt
+
+DJANGO_HANDLERS = [
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+
+def bytes_written():
+    """Bytes this process has passed to write() so far (Linux only)."""
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('wchar:'):
+                return int(line.split()[1])
+    return 0
+
+
+def copy_upload(uploaded_file, work_dir):
+    """The previous save_upload: rewrite every upload chunk by chunk."""
+    input_path = os.path.join(work_dir, 'input.mp4')
+    with open(input_path, 'wb') as f:
+        for chunk in uploaded_file.chunks():
+            f.write(chunk)
+    return input_path
+
+
+class Command(BaseCommand):
+    help = 'Measure the disk writes the edit endpoints make per request to take in an upload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=int, default=60, help='Length of the large upload in seconds')
+        parser.add_argument('--size', default='1280x720')
+
+    def handle(self, *args, **options):
+        source_dir = tempfile.mkdtemp()
+        try:
+            large = generate_clip(os.path.join(source_dir, 'large.mp4'), options['duration'], options['size'])
+            # Small enough to stay in memory (FILE_UPLOAD_MAX_MEMORY_SIZE)
+            small = generate_clip(os.path.join(source_dir, 'small.mp4'), 5, '320x240')
+            cases = [
+                ('trim, large upload', '/api/trim/', large, {'start': 1, 'end': 5}),
+                ('caption, small upload', '/api/caption/', small, {'captions': sample_srt(5)}),
+            ]
+            for label, url, path, data in cases:
+                legacy = self.measure(url, path, data, legacy=True)
+                current = self.measure(url, path, data, legacy=False)
+                self.stdout.write(
+                    f'{label:<24} upload {os.path.getsize(path) / 1024 ** 2:7.1f} MiB  '
+                    f'written before {legacy / 1024 ** 2:7.1f} MiB  now {current / 1024 ** 2:7.1f} MiB  '
+                    f'saved {(legacy - current) / 1024 ** 2:7.1f} MiB per request'
+                )
+        finally:
+            shutil.rmtree(source_dir, ignore_errors=True)
+
+    def measure(self, url, path, data, legacy):
+        client = Client()
+        with open(path, 'rb') as f:
+            payload = dict(data, video=f)
+            if legacy:
+                with override_settings(FILE_UPLOAD_HANDLERS=DJANGO_HANDLERS), \
+                        mock.patch('api.uploads.save_upload', copy_upload), \
+                        mock.patch('api.views.piped_upload', lambda request: None):
+                    before = bytes_written()
+                    response = client.post(url, payload, secure=True)
+            else:
+                before = bytes_written()
+                response = client.post(url, payload, secure=True)
+        written = bytes_written() - before
+        # Drain the streamed result so the request's cleanup runs
+        b''.join(response.streaming_content)
+        response.close()
+        if response.status_code != 200:
+            self.stderr.write(f'{url} answered {response.status_code}')
+        return written
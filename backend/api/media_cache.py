@@ -0,0 +1,267 @@
+"""Persistent, byte-budgeted LRU cache of files on disk.
+
+Each entry is a directory ``<root>/<key>/`` holding the payload file and a
+``meta.json`` sidecar. Entries are built in ``<root>/.tmp`` and renamed into
+place, so a crash never leaves a half-written entry behind. The directory
+tree is the only index, which keeps several worker processes consistent
+with each other and lets the cache survive restarts. Recency is tracked
+through the mtime of ``meta.json``, which also drives the optional idle
+expiry (``max_age``). Callers that use an entry's file after looking it up
+take it through ``fetch()``, which hard-links it into their work dir so an
+eviction can't remove it under them.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import SingleFlight
+from .metrics import Counter, Gauge
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+META_NAME = 'meta.json'
+
+
+def make_key(*parts):
+    """Stable hex key for any JSON-serialisable combination of values."""
+    blob = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class CacheEntry:
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.meta = meta
+        self.path = os.path.join(directory, meta['file'])
+        self.size = meta['size']
+
+
+class DiskCache:
+    def __init__(self, name, root, max_bytes, max_age=None):
+        self.name = name
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._flight = SingleFlight()
+        self._evict_lock = threading.Lock()
+        self.hits = Counter(f'{name}_cache_hits', f'{name} cache hits')
+        self.misses = Counter(f'{name}_cache_misses', f'{name} cache misses')
+        self.bytes_saved = Counter(f'{name}_cache_bytes_saved',
+                                   f'Bytes served from the {name} cache instead of being produced again')
+        self.evictions = Counter(f'{name}_cache_evictions', f'{name} cache entries evicted')
+        self.evicted_bytes = Counter(f'{name}_cache_evicted_bytes', f'Bytes evicted from the {name} cache')
+        Gauge(f'{name}_cache_hit_rate', self.hit_rate, f'{name} cache hit rate since start')
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def hit_rate(self):
+        total = self.hits.value + self.misses.value
+        return round(self.hits.value / total, 4) if total else 0.0
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def _expired(self, used):
+        return self.max_age is not None and time.time() - used > self.max_age
+
+    def get(self, key):
+        """Return the entry for ``key`` and mark it recently used, or None."""
+        directory = self._entry_dir(key)
+        meta_path = os.path.join(directory, META_NAME)
+        try:
+            if self._expired(os.path.getmtime(meta_path)):
+                self._remove(key)
+                return None
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        entry = CacheEntry(directory, meta)
+        if not os.path.exists(entry.path):
+            return None
+        return entry
+
+    @contextlib.contextmanager
+    def _process_lock(self, key):
+        """Serialise producers of one key across worker processes."""
+        if fcntl is None:
+            yield
+            return
+        lock_path = self._lock_path(key)
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        while True:
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # An eviction may have unlinked the file while we waited for it
+            try:
+                current = os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            lock_file.close()
+        with lock_file:
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _lock_path(self, key):
+        return os.path.join(self.root, '.locks', key)
+
+    def _remove(self, key):
+        """Delete an entry and its lock file, unless a producer holds the lock."""
+        # Open readers keep streaming from the unlinked file on POSIX
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+        if fcntl is None:
+            return
+        try:
+            lock_file = open(self._lock_path(key), 'a')
+        except OSError:
+            return
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self._lock_path(key))
+
+    def get_or_create(self, key, produce):
+        """Return ``(entry, hit)``, running ``produce(work_dir)`` on a miss.
+
+        ``produce`` writes into the scratch dir it is given and returns
+        ``(file_path, meta)``. Concurrent callers for the same key, in this
+        process or another one, wait for a single producer.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            self.hits.inc()
+            self.bytes_saved.inc(entry.size)
+            return entry, True
+
+        def build():
+            with self._process_lock(key):
+                # Another process may have finished it while we waited for the lock
+                entry = self.get(key)
+                if entry is not None:
+                    return entry, True
+                return self._create(key, produce), False
+
+        (entry, hit), shared = self._flight.do(key, build)
+        if hit or shared:
+            self.hits.inc()
+            self.bytes_saved.inc(entry.size)
+        else:
+            self.misses.inc()
+        return entry, hit or shared
+
+    def fetch(self, key, produce, directory):
+        """``get_or_create()`` for callers that go on using the file: returns
+        ``(path, meta)`` with the file hard-linked into ``directory``, where
+        eviction can't take it away. An entry evicted before it could be
+        linked counts as a miss. Across filesystems the cache path is returned.
+        """
+        return self._use(key, produce, lambda entry: (self.pin(entry, directory), entry.meta))
+
+    def read(self, key, produce):
+        """``(content, meta)`` of the entry for ``key``, produced on a miss; for small files."""
+        def read(entry):
+            with open(entry.path, 'rb') as f:
+                return f.read(), entry.meta
+        return self._use(key, produce, read)
+
+    def _use(self, key, produce, use):
+        for _ in range(3):
+            entry, _ = self.get_or_create(key, produce)
+            # None when another process evicted it right after it was created
+            if entry is not None:
+                try:
+                    return use(entry)
+                except FileNotFoundError:
+                    pass
+        raise FileNotFoundError(f'{self.name} cache entry {key} was evicted before it could be used')
+
+    def pin(self, entry, directory):
+        """Hard-link ``entry``'s file into ``directory`` and return the link's
+        path (the cache path on another filesystem). Raises FileNotFoundError
+        if the entry has been evicted."""
+        path = os.path.join(directory, f'{self.name}-{os.path.basename(entry.path)}')
+        try:
+            os.link(entry.path, path)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            return entry.path
+        return path
+
+    def _create(self, key, produce):
+        tmp_root = os.path.join(self.root, '.tmp')
+        os.makedirs(tmp_root, exist_ok=True)
+        work_dir = tempfile.mkdtemp(dir=tmp_root)
+        try:
+            file_path, meta = produce(work_dir)
+            staging = os.path.join(work_dir, 'entry')
+            os.makedirs(staging)
+            file_name = os.path.basename(file_path)
+            os.replace(file_path, os.path.join(staging, file_name))
+            meta = dict(meta, file=file_name, size=os.path.getsize(os.path.join(staging, file_name)))
+            with open(os.path.join(staging, META_NAME), 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            try:
+                os.replace(staging, self._entry_dir(key))
+            except OSError:
+                # A stale entry without metadata is in the way; replace it
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                os.replace(staging, self._entry_dir(key))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        self.evict(keep=key)
+        return self.get(key)
+
+    def evict(self, keep=None):
+        """Drop expired entries, then least recently used ones until the cache
+        fits its byte budget."""
+        with self._evict_lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.root):
+                if name.startswith('.'):
+                    continue
+                meta_path = os.path.join(self.root, name, META_NAME)
+                try:
+                    with open(meta_path, encoding='utf-8') as f:
+                        size = json.load(f)['size']
+                    used = os.path.getmtime(meta_path)
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((used, name, size))
+                total += size
+            entries.sort()
+            for used, name, size in entries:
+                if total <= self.max_bytes and not self._expired(used):
+                    break
+                if name == keep:
+                    continue
+                self._remove(name)
+                total -= size
+                self.evictions.inc()
+                self.evicted_bytes.inc(size)
+
+
+media_cache = DiskCache('media', settings.MEDIA_CACHE_DIR, settings.MEDIA_CACHE_MAX_BYTES)
+derived_cache = DiskCache('derived', settings.DERIVED_CACHE_DIR, settings.DERIVED_CACHE_MAX_BYTES)
+preview_cache = DiskCache('preview', settings.PREVIEW_CACHE_DIR, settings.PREVIEW_CACHE_MAX_BYTES)
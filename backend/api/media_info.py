@@ -0,0 +1,154 @@
+"""ffprobe results kept per file content.
+
+Each input is probed once: duration, streams and codecs, plus the video
+keyframe index the first time something needs it. Results stay in memory
+and, for inputs whose SHA-256 is known (stored uploads, hashed edit inputs),
+in the ``MediaProbe`` table, so they survive restarts and are shared between
+worker processes. Inputs without a digest are keyed by device, inode, size
+and mtime, which hard links of the same upload share.
+"""
+import os
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .cache import TTLCache, SingleFlight
+from .ffmpeg_runner import probe, probe_async
+from .metrics import Counter
+from .models import MediaProbe
+
+_cache = TTLCache(settings.MEDIA_INFO_CACHE_SIZE)
+_flight = SingleFlight()
+
+hits = Counter('media_info_hits', 'Media info lookups answered without running ffprobe')
+probes = Counter('media_info_probes', 'ffprobe runs for media info and keyframe indexes')
+
+
+def _key(path, digest):
+    if digest:
+        return digest
+    st = os.stat(path)
+    return f'{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}'
+
+
+def _from_probe(digest, result):
+    fmt = {key: value for key, value in result.get('format', {}).items() if key != 'filename'}
+    duration = fmt.get('duration')
+    return MediaProbe(digest=digest or '', duration=float(duration) if duration else None,
+                      format=fmt, streams=result.get('streams', []))
+
+
+def _stored(digest):
+    try:
+        info = MediaProbe.objects.filter(pk=digest).first()
+        if info is not None:
+            MediaProbe.objects.filter(pk=digest).update(used_at=timezone.now())
+        return info
+    except DatabaseError:
+        # Not migrated yet
+        return None
+
+
+def _store(info, fields=None):
+    if not info.digest:
+        return
+    try:
+        if fields:
+            MediaProbe.objects.filter(pk=info.digest).update(**{field: getattr(info, field) for field in fields})
+            return
+        info.save()
+        MediaProbe.objects.filter(used_at__lt=timezone.now() - timedelta(seconds=settings.MEDIA_INFO_TTL)).delete()
+    except DatabaseError:
+        pass
+
+
+def _remember(key, info):
+    _cache.set(key, info, settings.MEDIA_INFO_TTL)
+    return info
+
+
+def media_info(path, digest=None):
+    """``MediaProbe`` for the file at ``path``, probing only the first time its
+    content is seen. ``digest`` is the file's SHA-256 when known.
+
+    The result is shared and must be treated as read-only.
+    """
+    key = _key(path, digest)
+    info = _cache.get(key)
+    if info is not None:
+        hits.inc()
+        return info
+
+    def load():
+        info = _stored(digest) if digest else None
+        if info is not None:
+            hits.inc()
+        else:
+            probes.inc()
+            info = _from_probe(digest, probe(path))
+            _store(info)
+        return _remember(key, info)
+
+    info, _ = _flight.do(key, load)
+    return info
+
+
+async def media_info_async(path, digest=None):
+    """``media_info()`` with ffprobe run as an asyncio subprocess."""
+    key = _key(path, digest)
+    info = _cache.get(key)
+    if info is None and digest:
+        info = await sync_to_async(_stored, thread_sensitive=False)(digest)
+    if info is not None:
+        hits.inc()
+        return _remember(key, info)
+    probes.inc()
+    info = _from_probe(digest, await probe_async(path))
+    await sync_to_async(_store, thread_sensitive=False)(info)
+    return _remember(key, info)
+
+
+def keyframes(path, digest=None):
+    """Timestamps of every video keyframe of ``path``, ascending, counted from
+    the file's start time like ffmpeg's seeks and filters. Read from the
+    packet flags without decoding, once per content."""
+    info = media_info(path, digest)
+    if info.keyframes is None:
+        _scan_keyframes(path, digest, info)
+    return [t - info.start_time for t in info.keyframes]
+
+
+def _scan_keyframes(path, digest, info):
+    def scan():
+        if info.keyframes is None:
+            probes.inc()
+            result = probe(path, select_streams='v:0', show_entries='packet=pts_time,flags')
+            info.keyframes = sorted(float(p['pts_time']) for p in result.get('packets', [])
+                                    if 'K' in p.get('flags', '') and p.get('pts_time') not in (None, 'N/A'))
+            _store(info, fields=['keyframes'])
+        return info.keyframes
+
+    _flight.do(('keyframes', _key(path, digest)), scan)
+
+
+def keyframe_before(path, position, digest=None):
+    """Timestamp of the video keyframe an input seek to ``position`` lands on,
+    both counted from the file's start time.
+
+    Answered from the keyframe index when it has been built; otherwise only
+    the one packet at the seek point is read.
+    """
+    info = media_info(path, digest)
+    if info.keyframes is not None:
+        return info.keyframe_before(position)
+    probes.inc()
+    # ffprobe seeks to timestamps as they are in the file
+    result = probe(path, select_streams='v:0', read_intervals=f'{position + info.start_time}%+#1',
+                   show_entries='packet=pts_time')
+    packets = result.get('packets') or []
+    if not packets or packets[0].get('pts_time') in (None, 'N/A'):
+        return position
+    return float(packets[0]['pts_time']) - info.start_time
@@ -0,0 +1,139 @@
+"""Cached ``extract_info`` lookups keyed by canonical video ID."""
+import re
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from django.conf import settings
+
+from .cache import TTLCache, SingleFlight
+from .metrics import Counter
+from .tracing import span
+from .ytdl import ydl_pool
+
+YOUTUBE_HOSTS = ('youtube.com', 'youtu.be', 'youtube-nocookie.com')
+YOUTUBE_ID_RE = re.compile(r'^[0-9A-Za-z_-]{11}$')
+YOUTUBE_PATH_RE = re.compile(r'^/(?:shorts|embed|live|v|e)/([0-9A-Za-z_-]{11})')
+# Query parameters that never change what gets extracted
+IGNORED_PARAMS = {'t', 'start', 'feature', 'si', 'pp', 'ab_channel', 'utm_source',
+                  'utm_medium', 'utm_campaign'}
+
+_cache = TTLCache(settings.VIDEO_INFO_CACHE_SIZE)
+_flight = SingleFlight()
+
+hits = Counter('video_info_cache_hits', 'Metadata lookups served from cache')
+misses = Counter('video_info_cache_misses', 'Metadata lookups that ran the extractor')
+coalesced = Counter('video_info_cache_coalesced',
+                    'Lookups that waited on an identical in-flight extraction')
+
+
+def canonical_video_id(url):
+    """Map the many URL forms of one video onto a single cache key.
+
+    ``youtu.be/x``, ``watch?v=x&t=10``, ``shorts/x`` and friends all become
+    ``youtube:x``. Other sites fall back to the URL with its fragment and
+    tracking parameters stripped and the query sorted.
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = 'https://' + url
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.') or host.startswith('m.') or host.startswith('music.'):
+        host = host.split('.', 1)[1]
+
+    if host in YOUTUBE_HOSTS:
+        if host == 'youtu.be':
+            video_id = parts.path.strip('/').split('/')[0]
+        else:
+            video_id = dict(parse_qsl(parts.query)).get('v')
+            if not video_id:
+                match = YOUTUBE_PATH_RE.match(parts.path)
+                video_id = match.group(1) if match else None
+        if video_id and YOUTUBE_ID_RE.match(video_id):
+            return f'youtube:{video_id}'
+
+    if parts.port and parts.port not in (80, 443):
+        # Other ports can be other servers
+        host = f'{host}:{parts.port}'
+    query = sorted((k, v) for k, v in parse_qsl(parts.query) if k not in IGNORED_PARAMS)
+    return urlunsplit(('https', host, parts.path.rstrip('/'), urlencode(query), ''))
+
+
+def _ttl(info):
+    """Cache lifetime: the configured TTL, cut short if signed URLs expire sooner."""
+    ttl = settings.VIDEO_INFO_CACHE_TTL
+    now = time.time()
+    for f in info.get('formats') or []:
+        expire = dict(parse_qsl(urlsplit(f.get('url') or '').query)).get('expire')
+        if expire and expire.isdigit():
+            ttl = min(ttl, int(expire) - now - settings.VIDEO_INFO_EXPIRY_MARGIN)
+    return ttl
+
+
+def _extract(url):
+    with span('extract'), ydl_pool.acquire() as ydl:
+        return ydl.extract_info(url, download=False)
+
+
+def get_video_info(url):
+    """Return the processed info dict for ``url``, extracting only on a cache miss.
+
+    The dict is shared between callers and must be treated as read-only; pass
+    it through ``YoutubeDL.sanitize_info`` before handing it back to yt-dlp.
+    """
+    key = canonical_video_id(url)
+    info = _cache.get(key)
+    if info is not None:
+        hits.inc()
+        return info
+
+    def load():
+        info = _extract(url)
+        _cache.set(key, info, _ttl(info))
+        return info
+
+    info, shared = _flight.do(key, load)
+    if shared:
+        coalesced.inc()
+    else:
+        misses.inc()
+    return info
+
+
+def invalidate(url):
+    """Drop the cached info for ``url``, e.g. after its format URLs stopped working."""
+    _cache.delete(canonical_video_id(url))
+
+
+def flat_playlist(url, limit):
+    """Info for the playlist (or channel, etc.) at ``url`` with at most
+    ``limit`` entries listed but not extracted, or None for a single video.
+
+    A single video found this way is fully extracted already, so it goes
+    into the cache.
+    """
+    if canonical_video_id(url).startswith('youtube:'):
+        # A watch URL, even with &list=, is one video as in noplaylist downloads
+        return None
+    import yt_dlp
+    ydl_opts = {
+        'skip_download': True,
+        'quiet': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': limit,
+    }
+    with span('extract', playlist=True), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if info.get('_type') != 'playlist':
+        _cache.set(canonical_video_id(url), info, _ttl(info))
+        return None
+    return info
+
+
+def playlist_entries(url, limit):
+    """Video URLs of the playlist at ``url`` in order, or None for a single video."""
+    playlist = flat_playlist(url, limit)
+    if playlist is None:
+        return None
+    entries = [entry.get('webpage_url') or entry.get('url') for entry in playlist.get('entries') or [] if entry]
+    return [entry for entry in entries if entry]
@@ -0,0 +1,173 @@
+"""Process-wide metrics reported by the stats and metrics endpoints.
+
+Metrics declared with ``labels`` keep one series per combination of label
+values, passed as keyword arguments (``requests.inc(endpoint='trim')``).
+"""
+import threading
+from contextlib import contextmanager
+
+REGISTRY = {}
+
+
+def _series(metric, labels):
+    """Label values of one series of ``metric``, in declaration order."""
+    if set(labels) != set(metric.labels):
+        raise ValueError(f'{metric.name} takes labels {metric.labels}, got {tuple(labels)}')
+    return tuple(str(labels[name]) for name in metric.labels)
+
+
+def _snapshot(metric, values):
+    """``value`` of a metric from its per-series ``values``."""
+    if not metric.labels:
+        return values.get(())
+    return {','.join(f'{name}={v}' for name, v in zip(metric.labels, key)): value
+            for key, value in sorted(values.items())}
+
+
+class Counter:
+    """A monotonically increasing, thread-safe count."""
+
+    kind = 'counter'
+
+    def __init__(self, name, description='', labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {} if self.labels else {(): 0}
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = _series(self, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    @property
+    def value(self):
+        with self._lock:
+            return _snapshot(self, dict(self.values))
+
+
+class Gauge:
+    """A value computed on demand by calling ``fn``, or set through ``inc()``
+    and ``dec()`` when there is no ``fn``."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, fn=None, description='', labels=()):
+        self.name = name
+        self.description = description
+        self.fn = fn
+        self.labels = tuple(labels)
+        self.values = {} if self.labels else {(): 0}
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = _series(self, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the block as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    @property
+    def value(self):
+        if self.fn is not None:
+            return self.fn()
+        with self._lock:
+            return _snapshot(self, dict(self.values))
+
+
+class Histogram:
+    """Observations counted into cumulative ``le`` buckets, Prometheus style."""
+
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name, description='', buckets=DEFAULT_BUCKETS, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        # Per series: [bucket counts, count, sum]
+        self.values = {} if self.labels else {(): [[0] * len(self.buckets), 0, 0.0]}
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def observe(self, amount, **labels):
+        key = _series(self, labels)
+        with self._lock:
+            series = self.values.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+            series[1] += 1
+            series[2] += amount
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    series[0][i] += 1
+
+    def _value(self, series):
+        counts, count, total = series
+        buckets = {str(bound): n for bound, n in zip(self.buckets, counts)}
+        buckets['+Inf'] = count
+        return {'count': count, 'sum': round(total, 6), 'buckets': buckets}
+
+    @property
+    def value(self):
+        with self._lock:
+            return _snapshot(self, {key: self._value(series) for key, series in self.values.items()})
+
+
+def snapshot():
+    """Current value of every registered metric, keyed by name."""
+    return {name: metric.value for name, metric in sorted(REGISTRY.items())}
+
+
+def _escape(value, quotes=True):
+    value = value.replace('\\', r'\\').replace('\n', r'\n')
+    return value.replace('"', r'\"') if quotes else value
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+    return f'{name} {float(value)!r}'
+
+
+def _samples(metric):
+    """(label pairs, value) of every series of a counter or gauge."""
+    if getattr(metric, 'fn', None) is not None:
+        value = metric.fn()
+        return [((), value)] if isinstance(value, (int, float)) else []
+    with metric._lock:
+        values = dict(metric.values)
+    return [(tuple(zip(metric.labels, key)), value) for key, value in sorted(values.items())]
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format (0.0.4)."""
+    lines = []
+    for name, metric in sorted(REGISTRY.items()):
+        lines.append(f'# HELP {name} {_escape(metric.description, quotes=False)}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        if metric.kind != 'histogram':
+            lines.extend(_sample(name, labels, value) for labels, value in _samples(metric))
+            continue
+        with metric._lock:
+            values = {key: (list(series[0]), series[1], series[2]) for key, series in metric.values.items()}
+        for key, (counts, count, total) in sorted(values.items()):
+            labels = tuple(zip(metric.labels, key))
+            for bound, n in zip(metric.buckets, counts):
+                lines.append(_sample(f'{name}_bucket', labels + (('le', str(float(bound))),), n))
+            lines.append(_sample(f'{name}_bucket', labels + (('le', '+Inf'),), count))
+            lines.append(_sample(f'{name}_sum', labels, total))
+            lines.append(_sample(f'{name}_count', labels, count))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,25 @@
+# Generated by Django 5.2 on 2026-10-18 02:31
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_job_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaProbe',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('format', models.JSONField(blank=True, default=dict)),
+                ('streams', models.JSONField(blank=True, default=list)),
+                ('keyframes', models.JSONField(blank=True, null=True)),
+                ('used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 03:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_mediaprobe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='worker_started',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
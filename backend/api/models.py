@@ -1,3 +1,85 @@
+import bisect
+import uuid
+
 from django.db import models
+from django.utils import timezone
+
+
+class Job(models.Model):
+    """A download or edit that runs on a background worker instead of the request thread"""
+    KIND_DOWNLOAD = 'download'
+    KIND_TRIM = 'trim'
+    KIND_CAPTION = 'caption'
+    KIND_COMBINED = 'combined'
+    KIND_CHOICES = [
+        (KIND_DOWNLOAD, 'Download'),
+        (KIND_TRIM, 'Trim'),
+        (KIND_CAPTION, 'Caption'),
+        (KIND_COMBINED, 'Trim + caption'),
+    ]
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES,
+                              default=STATUS_QUEUED, db_index=True)
+    params = models.JSONField(default=dict, blank=True)
+    work_dir = models.CharField(max_length=500)
+    result_path = models.CharField(max_length=500, blank=True)
+    result_name = models.CharField(max_length=255, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+    progress = models.JSONField(default=dict, blank=True)
+    worker_pid = models.IntegerField(null=True, blank=True)
+    # Start time of the worker process, to tell it from a later one reusing its PID
+    worker_started = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f'{self.kind} {self.id} ({self.status})'
+
+
+class MediaProbe(models.Model):
+    """ffprobe results for one file content, keyed by its SHA-256 (see ``api/media_info.py``)"""
+    digest = models.CharField(max_length=64, primary_key=True)
+    duration = models.FloatField(null=True, blank=True)
+    format = models.JSONField(default=dict, blank=True)
+    streams = models.JSONField(default=list, blank=True)
+    # Video keyframe timestamps as in the file, ascending; filled in on first demand
+    keyframes = models.JSONField(null=True, blank=True)
+    used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f'{self.digest[:12]} ({self.duration}s)'
+
+    @property
+    def video_stream(self):
+        return next((s for s in self.streams if s.get('codec_type') == 'video'), {})
+
+    @property
+    def start_time(self):
+        """Timestamp the file starts at; ffmpeg counts seeks and filter times from here."""
+        return float(self.format.get('start_time') or 0)
 
-# Create your models here.
+    def keyframe_before(self, position):
+        """Timestamp of the keyframe an input seek to ``position`` lands on,
+        both counted from ``start_time``. Needs ``keyframes``."""
+        if not self.keyframes:
+            return position
+        index = bisect.bisect_right(self.keyframes, position + self.start_time) - 1
+        return self.keyframes[max(index, 0)] - self.start_time
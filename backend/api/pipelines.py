@@ -0,0 +1,795 @@
+"""The actual media work behind each endpoint.
+
+Every function writes into a caller-owned ``work_dir`` and returns the path of
+the finished file, so the same code runs inside a request or on a job worker.
+"""
+import asyncio
+import bisect
+import csv
+import hashlib
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from django.conf import settings
+
+from .connections import host_connections, host_of
+from .ffmpeg_runner import run as run_ffmpeg, run_async as run_ffmpeg_async, ffmpeg_path, ffmpeg_version
+from .formats import plan_download, content_type as content_type_for
+from .media_cache import media_cache, derived_cache, make_key
+from .media_info import media_info, media_info_async, keyframes as keyframe_times, keyframe_before
+from .metadata import canonical_video_id, get_video_info, invalidate
+from .metrics import Counter
+from .scheduler import COPY, ENCODE, scheduler, queue_only
+from .tracing import span, record, bind
+
+# Shorter segments add more overhead than the extra parallelism is worth
+MIN_SEGMENT_LENGTH = 10
+
+upload_bytes_linked = Counter('upload_bytes_linked', 'Upload bytes hard-linked instead of copied')
+upload_bytes_piped = Counter('upload_bytes_piped', 'Upload bytes piped to ffmpeg instead of written')
+
+# ffprobe profile names to the libx264 -profile:v values that reproduce them
+H264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+}
+
+# Video encoder settings of every captioned output
+X264_OPTIONS = {'c:v': 'libx264', 'preset': 'fast', 'crf': '23'}
+
+
+def save_upload(uploaded_file, work_dir):
+    """Put an uploaded video into ``work_dir`` as ``input.mp4`` and return its path.
+
+    Uploads Django already spooled to disk are hard-linked rather than
+    copied; the copy is only the fallback, e.g. across filesystems.
+    """
+    input_path = os.path.join(work_dir, 'input.mp4')
+    if link_upload(uploaded_file, input_path):
+        return input_path
+    with span('file_io', op='save_upload', bytes=uploaded_file.size), open(input_path, 'wb') as f:
+        for chunk in uploaded_file.chunks():
+            f.write(chunk)
+    return input_path
+
+
+def link_upload(uploaded_file, path):
+    """Hard-link an upload Django spooled to disk to ``path``; False if it can't be."""
+    if not hasattr(uploaded_file, 'temporary_file_path'):
+        return False
+    try:
+        os.link(uploaded_file.temporary_file_path(), path)
+    except OSError:
+        return False
+    upload_bytes_linked.inc(uploaded_file.size)
+    return True
+
+
+def is_streamable_mp4(data):
+    """True when an MP4's ``moov`` box comes before ``mdat``, so ffmpeg can read
+    it front to back from a pipe."""
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box = struct.unpack('>I4s', data[offset:offset + 8])
+        if box == b'moov':
+            return True
+        if box == b'mdat':
+            return False
+        if size == 1 and offset + 16 <= len(data):
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+
+def section_options(section):
+    """yt-dlp options that fetch only the ``(start, end, frame_accurate)`` window.
+
+    Only the fragments/byte ranges covering the window are downloaded. Without
+    ``frame_accurate`` the cut is a stream copy that starts on a keyframe;
+    with it yt-dlp forces keyframes at the cuts, which re-encodes the clip.
+    """
+    import yt_dlp
+    start, end, frame_accurate = section
+    return {
+        'download_ranges': yt_dlp.utils.download_range_func(None, [(start, end)]),
+        'force_keyframes_at_cuts': frame_accurate,
+    }
+
+
+def _backoff(attempt):
+    return min(settings.YTDL_RETRY_BACKOFF * 2 ** attempt, settings.YTDL_RETRY_MAX_SLEEP)
+
+
+def download_options(work_dir):
+    """yt-dlp options shared by every download: quiet, with fragment
+    concurrency, HTTP chunking and retries as configured, and the
+    scheduler's thread budget for the ffmpeg runs yt-dlp starts itself."""
+    threads = ['-threads', str(scheduler.threads)]
+    options = {
+        'noplaylist': True,
+        'quiet': True,
+        'noprogress': True,
+        'socket_timeout': 30,
+        'ffmpeg_location': ffmpeg_path(),
+        'outtmpl': os.path.join(work_dir, '%(title)s.%(ext)s'),
+        'concurrent_fragment_downloads': settings.YTDL_CONCURRENT_FRAGMENTS,
+        'retries': settings.YTDL_RETRIES,
+        'fragment_retries': settings.YTDL_RETRIES,
+        'retry_sleep_functions': {'http': _backoff, 'fragment': _backoff},
+        # Output options of postprocessors, and of ffmpeg downloading sections
+        'postprocessor_args': {'ffmpeg': threads},
+        'external_downloader_args': {'ffmpeg': threads},
+    }
+    if settings.YTDL_HTTP_CHUNK_SIZE:
+        options['http_chunk_size'] = settings.YTDL_HTTP_CHUNK_SIZE
+    return options
+
+
+def _media_host(info, format_id):
+    """Host serving ``format_id`` of ``info``, else the page's host."""
+    url = next((f.get('url') for f in info.get('formats') or [] if f.get('format_id') == format_id), None)
+    return host_of(url or info.get('url') or info.get('webpage_url'))
+
+
+class _PostprocessorSlots:
+    """yt-dlp ``postprocessor_hooks`` entry holding a scheduler slot while one
+    of yt-dlp's ffmpeg postprocessors runs; ``close()`` frees it on errors.
+
+    The download is done by then, so it queues instead of being turned away.
+    """
+
+    def __init__(self, priority):
+        self.priority = priority
+        self._held = None
+
+    def __call__(self, d):
+        name = d.get('postprocessor') or ''
+        if not (name in ('ExtractAudio', 'Merger') or name.startswith('Fixup')):
+            return
+        # yt-dlp may report each event more than once
+        if d.get('status') == 'started' and self._held is None:
+            with ExitStack() as stack, queue_only():
+                stack.enter_context(scheduler.slot(self.priority if name == 'ExtractAudio' else COPY))
+                self._held = stack.pop_all()
+        elif d.get('status') == 'finished':
+            self.close()
+
+    def close(self):
+        held, self._held = self._held, None
+        if held is not None:
+            held.close()
+
+
+def _ytdl_download(url, cached, ydl_opts, host, priority=COPY):
+    """Run one yt-dlp download of the extracted ``cached`` info and return
+    (info, filename), holding connections to ``host`` while it runs.
+
+    ``priority`` is that of audio extraction, or of the whole run for
+    sections, which ffmpeg downloads (and re-encodes when frame accurate).
+    """
+    import yt_dlp
+    with ExitStack() as stack:
+        hooks = list(ydl_opts.get('postprocessor_hooks', []))
+        if ydl_opts.get('download_ranges'):
+            # Also covers the postprocessors; a second slot could wait on this one
+            stack.enter_context(scheduler.slot(priority))
+        else:
+            slots = _PostprocessorSlots(priority)
+            stack.callback(slots.close)
+            hooks.insert(0, slots)
+        granted = stack.enter_context(host_connections.acquire(host, ydl_opts['concurrent_fragment_downloads']))
+        ydl_opts = dict(ydl_opts, concurrent_fragment_downloads=granted, postprocessor_hooks=hooks)
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            try:
+                try:
+                    info = ydl.process_ie_result(ydl.sanitize_info(cached, True), download=True)
+                except yt_dlp.utils.ExtractorError as e:
+                    # extract_info() would have reported this as a DownloadError
+                    raise yt_dlp.utils.DownloadError(str(e)) from e
+            except yt_dlp.utils.DownloadError as e:
+                if 'HTTP Error 403' not in str(e):
+                    raise
+                # The signed format URLs went stale earlier than expected
+                invalidate(url)
+                info = ydl.extract_info(url, download=True)
+            return info, ydl.prepare_filename(info)
+
+
+def _summed_progress(hook):
+    """``hook`` fed the combined progress of downloads running side by side."""
+    lock = threading.Lock()
+    parts = {}
+
+    def report(d):
+        with lock:
+            parts[d.get('filename')] = d
+            totals = [p.get('total_bytes') or p.get('total_bytes_estimate') for p in parts.values()]
+            combined = dict(
+                d,
+                status='finished' if all(p.get('status') == 'finished' for p in parts.values()) else 'downloading',
+                downloaded_bytes=sum(p.get('downloaded_bytes') or 0 for p in parts.values()),
+                total_bytes=sum(totals) if all(totals) else None,
+                total_bytes_estimate=None,
+                speed=sum(p.get('speed') or 0 for p in parts.values() if p.get('status') != 'finished') or None,
+            )
+        hook(combined)
+    return report
+
+
+def _download_streams(url, cached, plan, work_dir, ydl_opts, progress):
+    """Download the video and audio of a merged plan side by side instead of
+    one after the other, then merge them as yt-dlp would. Returns (info, path)."""
+    import ffmpeg
+    video_id, audio_id = plan['streams']
+    ydl_opts = dict(ydl_opts, merge_output_format=None)
+
+    def fetch(format_id, name):
+        options = dict(ydl_opts, format=format_id, outtmpl=os.path.join(work_dir, f'{name}.%(ext)s'))
+        return _ytdl_download(url, cached, options, _media_host(cached, format_id))
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='stream') as pool:
+        video = pool.submit(bind(fetch, video_id, 'video'))
+        audio = pool.submit(bind(fetch, audio_id, 'audio'))
+        (info, video_path), (_, audio_path) = video.result(), audio.result()
+
+    output_path = os.path.join(work_dir, 'merged.mp4')
+    stream_spec = ffmpeg.output(ffmpeg.input(video_path).video, ffmpeg.input(audio_path).audio, output_path,
+                                c='copy', movflags='+faststart')
+    run_ffmpeg(stream_spec, progress, stage='merge', duration=cached.get('duration'), priority=COPY)
+    for path in (video_path, audio_path):
+        os.remove(path)
+    return info, output_path
+
+
+def download_video(url, format_id, audio_only, work_dir, section=None, progress=None,
+                   audio_format=None):
+    """Download ``url`` (or just ``section`` of it) and return
+    (path, download filename, content type)."""
+    # Reuse the info dict from the preceding /info/ lookup instead of extracting again
+    cached = get_video_info(url)
+    plan = plan_download(cached, format_id, audio_only, audio_format)
+    ydl_opts = download_options(work_dir)
+    ydl_opts.update(plan['options'])
+    if section is not None:
+        ydl_opts.update(section_options(section))
+    postprocessing = {}
+
+    def record_download(d):
+        if d.get('status') == 'finished' and d.get('elapsed') is not None:
+            record('download', d['elapsed'], bytes=d.get('total_bytes') or d.get('downloaded_bytes') or 0)
+
+    def record_postprocessor(d):
+        name = d.get('postprocessor')
+        if d.get('status') == 'started':
+            postprocessing[name] = time.perf_counter()
+        elif d.get('status') == 'finished' and name in postprocessing:
+            record('postprocess', time.perf_counter() - postprocessing.pop(name), postprocessor=name)
+
+    priority = ENCODE if plan['pipeline'] == 'transcode' or (section and section[2]) else COPY
+    if priority == ENCODE:
+        # Turn the request away before downloading rather than after
+        scheduler.check(ENCODE)
+    parallel = plan['streams'] and section is None and settings.YTDL_PARALLEL_STREAMS
+    ydl_opts['progress_hooks'] = [record_download]
+    ydl_opts['postprocessor_hooks'] = [record_postprocessor]
+    if progress:
+        ydl_opts['progress_hooks'].append(_summed_progress(progress.ytdl_hook) if parallel else progress.ytdl_hook)
+        ydl_opts['postprocessor_hooks'].append(progress.ytdl_postprocessor_hook)
+
+    if parallel:
+        info, filename = _download_streams(url, cached, plan, work_dir, ydl_opts, progress)
+    else:
+        info, filename = _ytdl_download(url, cached, ydl_opts, _media_host(cached, format_id), priority)
+        downloads = info.get('requested_downloads') or []
+        if downloads and downloads[0].get('filepath'):
+            # Final path after merging and post-processing
+            filename = downloads[0]['filepath']
+        elif not filename.endswith('.' + plan['ext']):
+            filename = os.path.splitext(filename)[0] + '.' + plan['ext']
+
+    # Post-processors may pick the container themselves (audio_format=best)
+    ext = os.path.splitext(filename)[1].lstrip('.') or plan['ext']
+    return filename, download_name(info, ext, section), content_type_for(ext, audio_only)
+
+
+def download_name(info, ext, section=None):
+    """Safe attachment filename for a download of ``info`` (or ``section`` of it)."""
+    title = re.sub(r'[^\w\-_\. ]', '', info.get('title', 'video'))
+    span = ''
+    if section is not None:
+        start, end = section[0], section[1]
+        span = f'_{start:g}-{end:g}' if end != float('inf') else f'_{start:g}-end'
+    return f"{title[:50]}{span}.{ext}"
+
+
+def cached_download(url, format_id, audio_only, work_dir, section=None, progress=None, audio_format=None):
+    """Like ``download_video`` but served from the media cache when possible.
+
+    The returned path is the cache entry linked into ``work_dir`` (or the
+    entry itself across filesystems) and must not be modified.
+    """
+    audio_only = bool(audio_only)
+    if audio_only:
+        # The format is picked by the plan alone
+        format_id = None
+    plan = plan_download(get_video_info(url), format_id, audio_only, audio_format)
+    key = make_key(canonical_video_id(url), format_id, audio_only, plan['options'], section)
+
+    def produce(work_dir):
+        filename, safe_filename, content_type = download_video(
+            url, format_id, audio_only, work_dir, section, progress, audio_format)
+        return filename, {'filename': safe_filename, 'content_type': content_type}
+
+    path, meta = media_cache.fetch(key, produce, work_dir)
+    return path, meta['filename'], meta['content_type']
+
+
+def fetch_media(url, format_id, audio_only, work_dir, section=None, captions='', progress=None,
+                audio_format=None):
+    """Download through the media cache (when enabled) and optionally burn in captions.
+
+    Captions are timed against the original video and are shifted to the
+    start of ``section``. Returns (path, download filename, content type);
+    the path is inside either ``work_dir`` or the media cache, so callers
+    only ever clean up ``work_dir``.
+    """
+    if media_cache.enabled:
+        path, filename, content_type = cached_download(url, format_id, audio_only, work_dir, section,
+                                                       progress, audio_format)
+    else:
+        path, filename, content_type = download_video(url, format_id, audio_only, work_dir,
+                                                      section, progress, audio_format)
+    if captions:
+        offset, length = (section[0], section[1] - section[0]) if section else (0, None)
+        if length == float('inf'):
+            length = None
+        shifted = shift_captions(captions, offset, length)
+        if shifted:
+            path = caption_video(path, shifted, work_dir, progress)
+    return path, filename, content_type
+
+
+def download_scratch_bytes(url, format_id, audio_only, captions='', audio_format=None):
+    """Bytes ``fetch_media`` is expected to write into its ``work_dir``: the
+    separate streams plus their merge unless the media cache downloads them,
+    and the captioned copy. None when the format's size isn't known."""
+    cached = media_cache.enabled
+    if cached and not captions:
+        return 0
+    plan = plan_download(get_video_info(url), None if audio_only else format_id, bool(audio_only),
+                         audio_format)
+    if not plan['estimated_bytes']:
+        return None
+    return plan['estimated_bytes'] * ((0 if cached else 2) + (1 if captions else 0))
+
+
+def link_or_copy(src, dst):
+    """Hardlink ``src`` to ``dst``, copying when they are on different filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        with span('file_io', op='copy', bytes=os.path.getsize(src)):
+            shutil.copyfile(src, dst)
+    return dst
+
+
+def file_digest(path):
+    """SHA-256 of the file at ``path``, read a chunk at a time."""
+    digest = hashlib.sha256()
+    with span('file_io', op='hash') as details, open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+        details['bytes'] = f.tell()
+    return digest.hexdigest()
+
+
+def captions_digest(captions):
+    """Hash of SRT text that ignores line-ending and surrounding whitespace differences."""
+    return hashlib.sha256(captions.replace('\r\n', '\n').strip().encode('utf-8')).hexdigest()
+
+
+def derived_key(operation, digest, params):
+    """Derived cache key of ``operation`` on the input with content hash
+    ``digest``; ``params`` holds everything else the output depends on."""
+    return make_key(operation, digest, params, X264_OPTIONS, ffmpeg_version())
+
+
+def cached_edit(operation, digest, params, work_dir, produce):
+    """Output path of ``produce(out_dir)``, served from the derived cache when
+    the input's ``digest`` is known and the cache is enabled.
+
+    A cached path lives inside the cache and must not be deleted, so like
+    ``fetch_media`` callers only ever clean up ``work_dir``.
+    """
+    if digest is None or not derived_cache.enabled:
+        return produce(work_dir)
+    path, _ = derived_cache.fetch(derived_key(operation, digest, params),
+                                  lambda out_dir: (produce(out_dir), {}), work_dir)
+    return path
+
+
+def _trim_params(start, end, duration):
+    # Any end past the duration cuts at the same place
+    return {'start': round(start, 3), 'end': round(min(end, duration), 3)}
+
+
+def trim_video(input_path, start, end, work_dir, progress=None, digest=None):
+    """Stream-copy ``start``..``end`` of ``input_path``; end is clamped to the duration."""
+    duration = _duration(media_info(input_path, digest))
+
+    def produce(out_dir):
+        output_path = os.path.join(out_dir, 'output.mp4')
+        stream_spec, clip_duration = _trim(input_path, start, end, duration, output_path)
+        run_ffmpeg(stream_spec, progress, stage='trim', duration=clip_duration, priority=COPY)
+        return output_path
+
+    return cached_edit('trim', digest, _trim_params(start, end, duration), work_dir, produce)
+
+
+async def trim_video_async(input_path, start, end, work_dir, progress=None, digest=None):
+    """``trim_video`` with ffprobe and ffmpeg run as asyncio subprocesses."""
+    duration = _duration(await media_info_async(input_path, digest))
+    key = None
+    if digest is not None and derived_cache.enabled:
+        key = derived_key('trim', digest, _trim_params(start, end, duration))
+        entry = derived_cache.get(key)
+        if entry is not None:
+            try:
+                path = derived_cache.pin(entry, work_dir)
+            except FileNotFoundError:
+                # Evicted since the lookup; make it again
+                path = None
+            if path is not None:
+                derived_cache.hits.inc()
+                derived_cache.bytes_saved.inc(entry.size)
+                return path
+
+    output_path = os.path.join(work_dir, 'output.mp4')
+    stream_spec, clip_duration = _trim(input_path, start, end, duration, output_path)
+    await run_ffmpeg_async(stream_spec, progress, stage='trim', duration=clip_duration, priority=COPY)
+    if key is not None:
+        # Stored from a thread: get_or_create blocks while another process writes the entry
+        store = lambda out_dir: (link_or_copy(output_path, os.path.join(out_dir, 'output.mp4')), {})
+        await asyncio.to_thread(derived_cache.get_or_create, key, store)
+    return output_path
+
+
+def _duration(info):
+    if info.duration is None:
+        raise ValueError('Could not read the video duration')
+    return info.duration
+
+
+def _trim(input_path, start, end, video_duration, output_path):
+    import ffmpeg
+    # Clamp the end to the video duration
+    if end > video_duration:
+        end = video_duration
+
+    # Calculate duration of the clip
+    clip_duration = end - start
+
+    # Trim using both start and end positions
+    return ffmpeg.input(input_path, ss=start).output(output_path, t=clip_duration, c='copy'), clip_duration
+
+
+def write_captions(captions, work_dir, name='captions.srt'):
+    """Write SRT text to ``name`` and return the path in FFmpeg-safe form."""
+    srt_path = os.path.join(work_dir, name)
+    with open(srt_path, 'w', encoding='utf-8') as f:
+        f.write(captions)
+
+    # Convert path for FFmpeg compatibility
+    return srt_path.replace('\\', '/')
+
+
+def caption_video(input_path, captions, work_dir, progress=None, input_data=None, digest=None):
+    """Burn ``captions`` (SRT text) into ``input_path`` and keep the audio as is.
+
+    ``input_data``, the bytes of a small streamable upload, is piped to ffmpeg
+    on stdin instead of reading ``input_path``. Given the input's content
+    ``digest``, the output goes through the derived cache.
+
+    When the captions only cover part of an H.264 input, just the GOPs they
+    touch are re-encoded (see ``caption_video_smart``). Otherwise inputs longer
+    than ``CAPTION_SEGMENT_MIN_DURATION`` are encoded in parallel segments
+    when the scheduler has more than one slot.
+    """
+    def produce(out_dir):
+        return _caption_video(input_path, captions, out_dir, progress, input_data, digest)
+
+    return cached_edit('caption', digest, {'captions': captions_digest(captions)}, work_dir, produce)
+
+
+def _caption_video(input_path, captions, work_dir, progress, input_data, digest):
+    import ffmpeg
+    # Smart and segmented rendering need a seekable file
+    if input_data is None:
+        info = media_info(input_path, digest)
+        duration = info.duration or 0
+        video_stream = info.video_stream
+        if settings.SMART_RENDER_MAX_COVERAGE and video_stream.get('codec_name') == 'h264':
+            output_path = caption_video_smart(input_path, captions, work_dir, video_stream,
+                                              duration, progress, digest)
+            if output_path:
+                return output_path
+        if scheduler.slots > 1 and duration >= settings.CAPTION_SEGMENT_MIN_DURATION:
+            return caption_video_segmented(input_path, captions, work_dir, scheduler.slots,
+                                           duration, progress, digest)
+    else:
+        input_path = 'pipe:0'
+        upload_bytes_piped.inc(len(input_data))
+
+    output_path = os.path.join(work_dir, 'output.mp4')
+    srt_escaped = write_captions(captions, work_dir)
+
+    # Updated FFmpeg command to ensure audio is included
+    stream = ffmpeg.input(input_path)
+    video = stream.video.filter('subtitles', filename=srt_escaped)
+    audio = stream.audio
+    run_ffmpeg(
+        ffmpeg
+        .output(video, audio, output_path,
+                **X264_OPTIONS, **{'c:a': 'copy'}),
+        progress, input_data=input_data
+    )
+    return output_path
+
+
+def split_at_keyframes(input_path, work_dir, keyframes, duration, segment_length=None,
+                       segment_times=None, inband_headers=False):
+    """Stream-copy the video of ``input_path`` into pieces that each start on
+    a keyframe: about ``segment_length`` seconds long, or cut at the keyframes
+    at or after each of ``segment_times``.
+
+    ``inband_headers`` repeats the H.264 parameter sets in front of every
+    keyframe, so pieces can be joined with ones from another encoder.
+    Returns ``[(path, start, duration)]`` in order.
+    """
+    import ffmpeg
+    segment_dir = os.path.join(work_dir, 'segments')
+    os.makedirs(segment_dir, exist_ok=True)
+    list_path = os.path.join(segment_dir, 'segments.csv')
+    if segment_times is not None:
+        cut = {'segment_times': ','.join(f'{t:.6f}' for t in segment_times)}
+    else:
+        cut = {'segment_time': segment_length}
+    if inband_headers:
+        cut['bsf:v'] = 'h264_mp4toannexb'
+    run_ffmpeg(
+        ffmpeg
+        .input(input_path)
+        .video
+        .output(os.path.join(segment_dir, 'source_%04d.mp4'), c='copy', f='segment',
+                segment_format='mp4', segment_list=list_path,
+                segment_list_type='csv', reset_timestamps=1, **cut),
+        stage='split', priority=COPY
+    )
+    with open(list_path, newline='') as f:
+        rows = list(csv.reader(f))
+    # The list reports times before the input's edit list and start offset
+    # are applied, a few frames off; snap them to the keyframes they cut at
+    starts = [min(keyframes, key=lambda k: abs(k - float(start)), default=0.0) if index else 0.0
+              for index, (_, start, _) in enumerate(rows)]
+    ends = starts[1:] + [max(duration, starts[-1])]
+    return [(os.path.join(segment_dir, name), start, end - start)
+            for (name, _, _), start, end in zip(rows, starts, ends)]
+
+
+def encode_segments(segments, captions, workers, progress=None, total=None, **encode_opts):
+    """Burn the matching slice of ``captions`` into each ``(path, start, duration)``
+    segment, ``workers`` at a time, and return the encoded paths in order."""
+    import ffmpeg
+    encoded_time = {}
+
+    def report(index):
+        if not progress:
+            return None
+
+        def segment_progress(stage, out_time=None, **fields):
+            if out_time is not None:
+                encoded_time[index] = out_time
+            done = sum(encoded_time.values())
+            progress(stage, out_time=done, segments=len(segments),
+                     percent=min(round(100 * done / total, 1), 100.0) if total else None)
+        return segment_progress
+
+    def encode(index):
+        path, start, length = segments[index]
+        directory = os.path.dirname(path)
+        shifted = shift_captions(captions, start, length)
+        video = ffmpeg.input(path).video
+        if shifted:
+            # Segments in a gap between cues are encoded as they are
+            video = video.filter('subtitles', filename=write_captions(shifted, directory,
+                                                                      f'captions_{index:04d}.srt'))
+        output_path = os.path.join(directory, f'encoded_{index:04d}.mp4')
+        with queue_only():
+            run_ffmpeg(
+                video.output(output_path, **X264_OPTIONS, **encode_opts),
+                report(index), duration=length
+            )
+        return output_path
+
+    # Each worker thread only waits on its own ffmpeg process
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='segment') as pool:
+        futures = [pool.submit(bind(encode, index)) for index in range(len(segments))]
+        return [future.result() for future in futures]
+
+
+def concat_segments(paths, input_path, output_path):
+    """Join video ``paths`` with the concat demuxer and add the audio of
+    ``input_path``, all without re-encoding."""
+    import ffmpeg
+    list_path = os.path.join(os.path.dirname(paths[0]), 'concat.txt')
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for path in paths:
+            f.write("file '{}'\n".format(path.replace("'", "'\\''")))
+    video = ffmpeg.input(list_path, f='concat', safe=0).video
+    audio = ffmpeg.input(input_path).audio
+    with queue_only():
+        run_ffmpeg(ffmpeg.output(video, audio, output_path, c='copy'),
+                   stage='concat', priority=COPY)
+    return output_path
+
+
+def caption_video_segmented(input_path, captions, work_dir, workers, duration=None, progress=None,
+                            digest=None):
+    """Burn in captions by encoding keyframe-aligned segments in parallel.
+
+    Each segment gets its own copy of the captions shifted to its start, the
+    encoded segments are joined with the concat demuxer without re-encoding,
+    and the audio is copied once from the input so there are no seams.
+    """
+    # Admission is decided once for the whole request, segments then queue
+    scheduler.check(ENCODE)
+    if duration is None:
+        duration = _duration(media_info(input_path, digest))
+    # A few segments per worker keeps them busy when segments encode unevenly
+    segment_length = max(duration / (workers * 2), MIN_SEGMENT_LENGTH)
+    segments = split_at_keyframes(input_path, work_dir, keyframe_times(input_path, digest), duration,
+                                  segment_length=segment_length)
+    encoded = encode_segments(segments, captions, workers, progress, duration)
+    output_path = concat_segments(encoded, input_path, os.path.join(work_dir, 'output.mp4'))
+    shutil.rmtree(os.path.join(work_dir, 'segments'), ignore_errors=True)
+    return output_path
+
+
+def caption_spans(captions):
+    """``(start, end)`` seconds of every cue in SRT text."""
+    import pysrt
+    return [(item.start.ordinal / 1000, item.end.ordinal / 1000)
+            for item in pysrt.from_string(captions)]
+
+
+def plan_smart_render(keyframes, spans, duration):
+    """Group the GOPs starting at ``keyframes`` into ``[(start, end, encode)]``
+    runs, where ``encode`` marks runs that overlap a caption span."""
+    bounds = keyframes + [max(duration, keyframes[-1])]
+    runs = []
+    for start, end in zip(bounds, bounds[1:]):
+        encode = any(s < end and e > start for s, e in spans)
+        if runs and runs[-1][2] == encode:
+            runs[-1] = (runs[-1][0], end, encode)
+        else:
+            runs.append((start, end, encode))
+    return runs
+
+
+def caption_video_smart(input_path, captions, work_dir, video_stream, duration, progress=None,
+                        digest=None):
+    """Re-encode only the GOPs that carry captions and stream-copy the rest.
+
+    The input is cut at the keyframes where the plan switches between copy
+    and encode and the captioned runs are encoded with settings matching the
+    source. Every piece carries its encoder's parameter sets in-band, so the
+    joined stream decodes across the switches; the audio is copied back in
+    from the input. Copied frames stay bit-identical to the source. Returns None
+    when the captions cover more than ``SMART_RENDER_MAX_COVERAGE`` of the
+    video, where a full encode is about as fast.
+    """
+    keyframes = keyframe_times(input_path, digest)
+    if not keyframes or not duration:
+        return None
+    runs = plan_smart_render(keyframes, caption_spans(captions), duration)
+    encoded_length = sum(end - start for start, end, encode in runs if encode)
+    if encoded_length / duration > settings.SMART_RENDER_MAX_COVERAGE:
+        return None
+
+    scheduler.check(ENCODE)
+    # The segment muxer sees the packets shifted by the decoder delay and the
+    # input's start offset; cutting halfway back to the previous keyframe
+    # still lands on the planned one
+    cuts = []
+    for start, _, _ in runs[1:]:
+        index = bisect.bisect_left(keyframes, start)
+        cuts.append((start + (keyframes[index - 1] if index else 0)) / 2)
+    segments = split_at_keyframes(input_path, work_dir, keyframes, duration, inband_headers=True,
+                                  segment_times=cuts)
+    if len(segments) != len(runs) or any(abs(segment[1] - run[0]) > 0.001
+                                         for segment, run in zip(segments[1:], runs[1:])):
+        shutil.rmtree(os.path.join(work_dir, 'segments'), ignore_errors=True)
+        return None
+
+    encode_opts = {'pix_fmt': video_stream.get('pix_fmt', 'yuv420p'),
+                   'x264-params': 'repeat-headers=1'}
+    profile = H264_PROFILES.get(video_stream.get('profile'))
+    if profile:
+        encode_opts['profile:v'] = profile
+    to_encode = [segment for segment, run in zip(segments, runs) if run[2]]
+    encoded = iter(encode_segments(to_encode, captions, scheduler.slots, progress,
+                                   encoded_length, **encode_opts))
+    pieces = [next(encoded) if run[2] else segment[0] for segment, run in zip(segments, runs)]
+
+    output_path = concat_segments(pieces, input_path, os.path.join(work_dir, 'output.mp4'))
+    shutil.rmtree(os.path.join(work_dir, 'segments'), ignore_errors=True)
+    return output_path
+
+
+def shift_captions(captions, offset, duration=None):
+    """Move SRT cues ``offset`` seconds earlier so they line up with a clip
+    that starts at ``offset``; cues outside the clip are dropped, so the
+    result is empty when none are left (ffmpeg's subtitles filter can't
+    open an empty file, callers skip it then)."""
+    import pysrt
+    offset_ms = int(round(offset * 1000))
+    end_ms = None if duration is None else int(round(duration * 1000))
+    shifted = pysrt.SubRipFile()
+    for item in pysrt.from_string(captions):
+        start = item.start.ordinal - offset_ms
+        end = item.end.ordinal - offset_ms
+        if end <= 0 or (end_ms is not None and start >= end_ms):
+            continue
+        item.start = pysrt.SubRipTime.from_ordinal(max(start, 0))
+        item.end = pysrt.SubRipTime.from_ordinal(end if end_ms is None else min(end, end_ms))
+        shifted.append(item)
+    shifted.clean_indexes()
+    return '\n'.join(str(item) for item in shifted)
+
+
+def combined_process(input_path, start, end, captions, work_dir, frame_accurate=False,
+                     progress=None, digest=None):
+    """Trim and burn in captions in a single ffmpeg pass with no intermediate file.
+
+    By default the clip starts on the keyframe at or before ``start`` (the cut
+    the old stream-copy trim made); ``frame_accurate`` starts exactly at
+    ``start`` at the cost of decoding from that keyframe. Either way the input
+    is seeked to the real start of the clip and the captions are shifted by
+    the same amount, so video, audio and captions stay in sync.
+    """
+    import ffmpeg
+    clip_start = start if frame_accurate else keyframe_before(input_path, start, digest)
+    clip_duration = end - clip_start
+    shifted = shift_captions(captions, clip_start, clip_duration)
+
+    def produce(out_dir):
+        output_path = os.path.join(out_dir, 'final.mp4')
+
+        # -t past the end of the input simply stops at EOF, so no probe for the duration
+        stream = ffmpeg.input(input_path, ss=clip_start)
+        video = stream.video
+        if shifted:
+            video = video.filter('subtitles', filename=write_captions(shifted, out_dir))
+        audio = stream.audio
+        run_ffmpeg(
+            ffmpeg
+            .output(video, audio, output_path, t=clip_duration,
+                    **X264_OPTIONS, **{'c:a': 'copy'}),
+            progress, duration=clip_duration
+        )
+        return output_path
+
+    # Starts inside one GOP all cut at its keyframe, and cues outside the clip don't matter
+    params = {'start': round(clip_start, 3), 'end': round(end, 3), 'frame_accurate': frame_accurate,
+              'captions': captions_digest(shifted)}
+    return cached_edit('combined', digest, params, work_dir, produce)
@@ -0,0 +1,150 @@
+"""Thumbnails and trim-preview filmstrips, cached on disk.
+
+``thumbnail()`` fetches a video's upstream thumbnail once, scales it and
+keeps the JPEG in the preview cache, so browsers load it from here instead
+of from the video host. ``filmstrip()`` builds a sprite sheet of evenly
+spaced frames for scrubbing: the keyframe index picks the keyframe nearest
+each position, and one ffmpeg pass that decodes keyframes only extracts
+them all, so a long video costs one cheap decode rather than one per frame.
+
+Both are keyed by content (the video ID, or the input's SHA-256) and the
+output parameters, and are served from memory; they are a few KiB each.
+"""
+import bisect
+import math
+import os
+
+from django.conf import settings
+
+from .ffmpeg_runner import run as run_ffmpeg, ffmpeg_version
+from .media_cache import preview_cache, make_key
+from .media_info import media_info, keyframes as keyframe_times
+from .metadata import canonical_video_id, get_video_info
+from .scheduler import COPY
+from .scratch import allocate, release
+from .tracing import span
+
+JPEG_QUALITY = 4  # ffmpeg -q:v, 2 (best) to 31
+
+
+class PreviewUnavailable(Exception):
+    pass
+
+
+def _cached(key, produce, size):
+    """``(image bytes, meta)`` of what ``produce(work_dir)`` writes, which
+    returns ``(path, meta)``. Kept in the preview cache when it is enabled;
+    otherwise produced in a scratch directory reserving ``size`` bytes."""
+    if preview_cache.enabled:
+        return preview_cache.read(key, produce)
+    work_dir = allocate(size)
+    try:
+        path, meta = produce(work_dir)
+        with open(path, 'rb') as f:
+            return f.read(), meta
+    finally:
+        release(work_dir)
+
+
+def thumbnail_candidates(info, width):
+    """Thumbnail URLs of ``info`` to try, best first: the smallest at least
+    ``width`` wide, then the largest ones."""
+    thumbnails = [t for t in info.get('thumbnails') or [] if t.get('url')]
+    by_area = sorted(thumbnails, key=lambda t: (t.get('width') or 0) * (t.get('height') or 0), reverse=True)
+    wide = sorted((t for t in thumbnails if (t.get('width') or 0) >= width), key=lambda t: t['width'])
+    urls = []
+    for url in [t['url'] for t in wide[:1] + by_area] + [info.get('thumbnail')]:
+        if url and url not in urls:
+            urls.append(url)
+    return urls[:3]
+
+
+def _fetch(url):
+    import requests
+    with span('download', op='thumbnail') as details, \
+            requests.get(url, timeout=settings.THUMBNAIL_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        data = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > settings.THUMBNAIL_MAX_BYTES:
+                raise PreviewUnavailable('The thumbnail is too large')
+        details['bytes'] = len(data)
+    return bytes(data)
+
+
+def thumbnail(url, width):
+    """JPEG of the thumbnail of the video at ``url``, ``width`` pixels wide at most."""
+    import ffmpeg
+    import requests
+
+    def produce(work_dir):
+        candidates = thumbnail_candidates(get_video_info(url), width)
+        if not candidates:
+            raise PreviewUnavailable('The video has no thumbnail')
+        for candidate in candidates:
+            try:
+                data = _fetch(candidate)
+                break
+            except requests.RequestException:
+                # Not every listed size exists (e.g. maxresdefault)
+                if candidate == candidates[-1]:
+                    raise PreviewUnavailable('Could not fetch the thumbnail')
+        output_path = os.path.join(work_dir, 'thumbnail.jpg')
+        stream_spec = (ffmpeg.input('pipe:0')
+                       .filter('scale', f'min(iw,{width})', -2)
+                       .output(output_path, vframes=1, update=1, **{'q:v': JPEG_QUALITY}))
+        run_ffmpeg(stream_spec, stage='thumbnail', priority=COPY, input_data=data)
+        return output_path, {}
+
+    key = make_key('thumbnail', canonical_video_id(url), width, ffmpeg_version())
+    image, _ = _cached(key, produce, settings.THUMBNAIL_MAX_BYTES)
+    return image
+
+
+def pick_keyframes(keyframes, duration, count):
+    """Keyframe timestamps nearest ``count`` evenly spaced positions of a
+    ``duration`` long video, each position at the middle of its share."""
+    times = []
+    for i in range(count):
+        target = (i + 0.5) * duration / count
+        index = bisect.bisect_left(keyframes, target)
+        nearest = min(keyframes[max(index - 1, 0):index + 1], key=lambda t: abs(t - target))
+        if nearest not in times:
+            times.append(nearest)
+    return times
+
+
+def filmstrip(input_path, digest, frames, width, columns):
+    """Sprite sheet of up to ``frames`` tiles ``width`` pixels wide, ``columns``
+    to a row, from the video at ``input_path`` with SHA-256 ``digest``.
+
+    Returns ``(jpeg bytes, layout)``; the layout gives the ``tile`` size,
+    the ``grid`` and the timestamp of each tile in ``times``. Short videos
+    or long GOPs give fewer tiles, as frames are taken at keyframes.
+    """
+    import ffmpeg
+
+    def produce(work_dir):
+        info = media_info(input_path, digest)
+        video = next((s for s in info.streams if s.get('codec_type') == 'video'), None)
+        if video is None or not video.get('width') or info.duration is None:
+            raise PreviewUnavailable('The input has no video')
+        keyframes = keyframe_times(input_path, digest)
+        if not keyframes:
+            raise PreviewUnavailable('The video has no keyframes')
+        times = pick_keyframes(keyframes, info.duration, frames)
+        tile = [width, max(2, round(width * video['height'] / video['width'] / 2) * 2)]
+        grid = [min(columns, len(times)), math.ceil(len(times) / min(columns, len(times)))]
+
+        output_path = os.path.join(work_dir, 'filmstrip.jpg')
+        stream_spec = (ffmpeg.input(input_path, skip_frame='nokey')
+                       .filter('select', '+'.join(f'lt(abs(t-{t:.6f}),0.001)' for t in times))
+                       .filter('scale', *tile)
+                       .filter('tile', f'{grid[0]}x{grid[1]}')
+                       .output(output_path, vframes=1, update=1, **{'q:v': JPEG_QUALITY}))
+        run_ffmpeg(stream_spec, stage='filmstrip', priority=COPY)
+        return output_path, {'tile': tile, 'grid': grid, 'times': times}
+
+    key = make_key('filmstrip', digest, frames, width, columns, ffmpeg_version())
+    return _cached(key, produce, frames * width * width)
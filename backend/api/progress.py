@@ -0,0 +1,215 @@
+"""Live progress for downloads and encodes, fanned out to Server-Sent Events.
+
+Workers publish into an in-memory channel per progress key (a client-chosen
+``progress_id`` or a job ID). Publishing only swaps the latest state under a
+short lock, so yt-dlp or ffmpeg can report hundreds of times per second
+without slowing down; subscribers always read the newest state and skip
+anything in between. Job progress is also flushed to the database about
+once a second by a background thread, so an SSE client connected to a
+different worker process still sees it.
+"""
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+KEY_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class Channel:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.event = None
+        self.seq = 0
+        self.done = False
+        self.touched = time.monotonic()
+        # (loop, future) of coroutines in wait_async()
+        self.waiters = set()
+
+    def publish(self, event, done=False):
+        with self.cond:
+            self.event = event
+            self.seq += 1
+            # Progress after the end is a new run reusing the key
+            self.done = done
+            self.touched = time.monotonic()
+            self.cond.notify_all()
+            for loop, future in self.waiters:
+                loop.call_soon_threadsafe(_wake, future)
+
+    def wait(self, seq, timeout):
+        """Block until there is an event newer than ``seq`` or ``timeout`` passes."""
+        with self.cond:
+            if self.seq == seq and not self.done:
+                self.cond.wait(timeout)
+            self.touched = time.monotonic()
+            return self.event, self.seq, self.done
+
+    async def wait_async(self, seq, timeout):
+        """``wait()`` for coroutines, without holding a thread while it waits."""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self.cond:
+            if self.seq == seq and not self.done:
+                self.waiters.add(waiter)
+        if waiter in self.waiters:
+            try:
+                await asyncio.wait([waiter[1]], timeout=timeout)
+            finally:
+                with self.cond:
+                    self.waiters.discard(waiter)
+        with self.cond:
+            self.touched = time.monotonic()
+            return self.event, self.seq, self.done
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ProgressBroker:
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._dirty_jobs = {}
+        self._flusher = None
+
+    def channel(self, key):
+        with self._lock:
+            channel = self._channels.get(key)
+            if channel is None:
+                self._sweep()
+                channel = self._channels[key] = Channel()
+            return channel
+
+    def _sweep(self):
+        cutoff = time.monotonic() - settings.PROGRESS_RETENTION
+        for key in [k for k, c in self._channels.items() if c.touched < cutoff]:
+            del self._channels[key]
+
+    def publish(self, key, event, done=False, job=False):
+        self.channel(key).publish(event, done)
+        if job:
+            with self._lock:
+                self._dirty_jobs[key] = event
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, daemon=True,
+                                                     name='progress-flush')
+                    self._flusher.start()
+
+    def _flush_loop(self):
+        from django.db import close_old_connections, DatabaseError
+        from .models import Job
+
+        while True:
+            time.sleep(settings.PROGRESS_FLUSH_INTERVAL)
+            with self._lock:
+                dirty, self._dirty_jobs = self._dirty_jobs, {}
+            try:
+                for job_id, event in list(dirty.items()):
+                    Job.objects.filter(pk=job_id).update(progress=event)
+                    del dirty[job_id]
+            except DatabaseError:
+                # e.g. SQLite's "database is locked" under load; retry next round
+                logger.warning('Could not save job progress', exc_info=True)
+                with self._lock:
+                    for job_id, event in dirty.items():
+                        self._dirty_jobs.setdefault(job_id, event)
+            close_old_connections()
+
+
+broker = ProgressBroker()
+
+
+class ProgressReporter:
+    """Callable handed to the pipelines; ``reporter(stage, **fields)`` publishes.
+
+    A reporter without a key is a cheap no-op, so pipelines can always call it.
+    """
+
+    def __init__(self, key=None, job=False):
+        self.key = key
+        self.job = job
+
+    def __bool__(self):
+        return self.key is not None
+
+    def __call__(self, stage, **fields):
+        if self.key is not None:
+            fields['stage'] = stage
+            broker.publish(self.key, fields, job=self.job)
+
+    def finish(self, status, **fields):
+        if self.key is not None:
+            fields['status'] = status
+            broker.publish(self.key, fields, done=True, job=self.job)
+
+    def ytdl_hook(self, d):
+        """yt-dlp ``progress_hooks`` entry."""
+        if self.key is None or d.get('status') not in ('downloading', 'finished'):
+            return
+        downloaded = d.get('downloaded_bytes')
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        self('download',
+             downloaded_bytes=downloaded,
+             total_bytes=total,
+             speed=d.get('speed'),
+             eta=d.get('eta'),
+             fragment_index=d.get('fragment_index'),
+             fragment_count=d.get('fragment_count'),
+             percent=round(100 * downloaded / total, 1) if downloaded and total else None)
+
+    def ytdl_postprocessor_hook(self, d):
+        """yt-dlp ``postprocessor_hooks`` entry (merge / audio extraction)."""
+        if self.key is not None and d.get('status') == 'started':
+            self('postprocess', postprocessor=d.get('postprocessor'))
+
+
+def request_key(request):
+    """Progress key a client attached to a request, if any."""
+    key = request.data.get('progress_id') or request.headers.get('X-Progress-Id')
+    return key if key and KEY_RE.match(key) else None
+
+
+def sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class Subscription:
+    """What to send one SSE subscriber; the sync and async stream views share it.
+
+    Each view waits on the channel its own way and passes what it got to
+    ``update()``, which returns the text to send, if any.
+    """
+
+    def __init__(self, poll):
+        self.poll = poll
+        self.seq = 0
+        self.last_event = None
+        self.last_write = time.monotonic()
+        self.deadline = time.monotonic() + settings.PROGRESS_STREAM_TIMEOUT
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.deadline
+
+    def update(self, event, seq, done):
+        self.seq = seq
+        if event and (event != self.last_event or done):
+            self.last_event = event
+            self.last_write = time.monotonic()
+            return sse('done' if done else 'progress', event)
+        if done:
+            return sse('done', {})
+        if time.monotonic() - self.last_write >= settings.PROGRESS_KEEPALIVE:
+            # Keeps proxies from closing an idle connection
+            self.last_write = time.monotonic()
+            return ': keep-alive\n\n'
+        return None
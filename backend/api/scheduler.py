@@ -0,0 +1,191 @@
+"""Process-wide admission control for ffmpeg.
+
+Left alone, every encode uses every core, so a handful of concurrent
+requests thrash the machine and all of them finish later than they would
+have one after another. Every ffmpeg run goes through ``scheduler.slot()``,
+which caps how many run at once, hands each one a thread budget and queues
+the rest by priority: cheap stream copies (trims) ahead of re-encodes.
+
+When the estimated wait is longer than ``ENCODE_MAX_WAIT`` the request is
+turned away with ``SchedulerBusy`` (a 503 with Retry-After) instead of
+queueing. Background jobs are already bounded by their own pool, so they
+run under ``queue_only()`` and always wait their turn.
+
+Audio piped straight into a response runs as fast as the client reads, so
+it holds its process for as long as the client likes. Those runs take a
+slot of ``stream_scheduler`` instead, so slow listeners can't starve edits.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+from django.conf import settings
+
+from .metrics import Counter, Gauge, Histogram
+
+COPY = 0
+ENCODE = 1
+
+_shedding = contextvars.ContextVar('encode_shedding', default=True)
+
+
+class SchedulerBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Server is busy, try again later')
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class EncodeScheduler:
+    # Starting guesses for how long a run takes, refined as runs finish
+    INITIAL_SERVICE_TIME = {COPY: 1.0, ENCODE: 30.0}
+
+    def __init__(self, slots, threads, max_wait, name='encode'):
+        self.slots = slots
+        self.threads = threads
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._queue = []
+        self._order = itertools.count()
+        self._running = {}
+        self._service_time = dict(self.INITIAL_SERVICE_TIME)
+
+        self.admitted = Counter(f'{name}_admitted', 'ffmpeg runs admitted')
+        self.rejected = Counter(f'{name}_rejected', 'ffmpeg runs turned away with 503')
+        self.wait_time = Histogram(f'{name}_wait_seconds', 'Time spent queued for a slot')
+        self.run_time = Histogram(f'{name}_run_seconds', 'Time spent running ffmpeg')
+        Gauge(f'{name}_queue_depth', lambda: len(self._queue), 'ffmpeg runs waiting for a slot')
+        Gauge(f'{name}_running', lambda: len(self._running), 'ffmpeg runs in progress')
+
+    def _estimated_wait(self, priority):
+        """Seconds until a run of ``priority`` queued now would start."""
+        ahead = [p for p, _, _ in self._queue if p <= priority]
+        if len(self._running) < self.slots and not ahead:
+            return 0.0
+        now = time.monotonic()
+        work = sum(self._service_time[p] for p in ahead)
+        work += sum(max(self._service_time[p] - (now - started), 0)
+                    for p, started in self._running.values())
+        return work / self.slots
+
+    def _admit(self, priority):
+        wait = self._estimated_wait(priority)
+        if wait > self.max_wait and _shedding.get():
+            self.rejected.inc()
+            raise SchedulerBusy(wait)
+
+    def check(self, priority=ENCODE):
+        """Raise SchedulerBusy now if a run of ``priority`` would be turned away."""
+        with self._lock:
+            self._admit(priority)
+
+    def _enqueue(self, priority, granted):
+        """Take a free slot (returns None) or queue ``granted`` for the next one."""
+        with self._lock:
+            self._admit(priority)
+            token = next(self._order)
+            if len(self._running) < self.slots and not self._queue:
+                self._running[token] = (priority, time.monotonic())
+                return token, None
+            heapq.heappush(self._queue, (priority, token, granted))
+            return token, granted
+
+    def _release(self, token, priority, started=None):
+        """Free the slot of ``token``; ``started`` is None when nothing ran in it."""
+        finished = time.monotonic()
+        if started is not None:
+            self.run_time.observe(finished - started)
+        with self._lock:
+            del self._running[token]
+            if started is not None:
+                # Moving average, so a burst of odd runs doesn't skew the estimate
+                self._service_time[priority] = (
+                    0.8 * self._service_time[priority] + 0.2 * (finished - started))
+            if self._queue:
+                next_priority, next_token, next_granted = heapq.heappop(self._queue)
+                self._running[next_token] = (next_priority, finished)
+                next_granted.set()
+
+    def _started(self, queued_at):
+        started = time.monotonic()
+        self.admitted.inc()
+        self.wait_time.observe(started - queued_at)
+        return started
+
+    @contextmanager
+    def slot(self, priority=ENCODE):
+        """Hold one of the ffmpeg slots; yields the ``-threads`` budget for the run."""
+        queued_at = time.monotonic()
+        token, granted = self._enqueue(priority, threading.Event())
+        if granted is not None:
+            granted.wait()
+        started = self._started(queued_at)
+        try:
+            yield self.threads
+        finally:
+            self._release(token, priority, started)
+
+    @asynccontextmanager
+    async def aslot(self, priority=ENCODE):
+        """``slot()`` for coroutines: waits for the slot without holding a thread."""
+        queued_at = time.monotonic()
+        token, granted = self._enqueue(priority, _LoopEvent())
+        if granted is not None:
+            try:
+                await granted.future
+            except asyncio.CancelledError:
+                with self._lock:
+                    entry = next((e for e in self._queue if e[1] == token), None)
+                    if entry is not None:
+                        self._queue.remove(entry)
+                        heapq.heapify(self._queue)
+                if entry is None:
+                    # Granted just as the waiter went away; pass the slot on
+                    self._release(token, priority)
+                raise
+        started = self._started(queued_at)
+        try:
+            yield self.threads
+        finally:
+            self._release(token, priority, started)
+
+
+class _LoopEvent:
+    """The part of ``threading.Event`` the queue uses, waking a coroutine instead."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+@contextmanager
+def queue_only():
+    """Never reject ffmpeg runs started inside this block, just queue them."""
+    reset = _shedding.set(False)
+    try:
+        yield
+    finally:
+        _shedding.reset(reset)
+
+
+_slots = settings.ENCODE_SLOTS or max(1, (os.cpu_count() or 1) // 2)
+scheduler = EncodeScheduler(
+    _slots,
+    settings.ENCODE_THREADS or max(1, (os.cpu_count() or 1) // _slots),
+    settings.ENCODE_MAX_WAIT,
+)
+# Piped audio is paced by the source and the client, one thread each is plenty
+stream_scheduler = EncodeScheduler(settings.AUDIO_STREAM_SLOTS, 1, settings.AUDIO_STREAM_MAX_WAIT,
+                                   name='audio_stream')
@@ -0,0 +1,231 @@
+"""Scratch directories for request work, with disk quotas.
+
+Every request that writes files gets its directory from ``allocate()``,
+which first reserves the space the work is expected to need: the upload
+size for edits, the format's estimated size for downloads. When the
+reservation would exceed the area's quota, or leave less than
+``SCRATCH_MIN_FREE_BYTES`` on its filesystem, the request queues for up to
+``SCRATCH_MAX_WAIT`` seconds and is then turned away with ``ScratchFull``,
+a 503 like a full encode queue, instead of failing halfway through.
+
+Work expected to stay under ``SCRATCH_FAST_MAX_BYTES`` goes to
+``SCRATCH_FAST_ROOT`` when one is configured (e.g. a tmpfs), everything
+else to ``SCRATCH_ROOT``. Directories are named after the process that
+owns them and its start time, so ``sweep()`` can remove those left behind
+by dead workers without touching ones whose process ID was reused.
+
+The quota counts reservations of this process; the free-space check is
+what keeps several processes sharing one root from overfilling it.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import Counter, Gauge
+from .scheduler import SchedulerBusy
+
+logger = logging.getLogger(__name__)
+
+refused = Counter('scratch_refused', 'Requests turned away for lack of scratch space')
+swept = Counter('scratch_swept', 'Scratch directories of dead processes removed')
+
+
+class ScratchFull(SchedulerBusy):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.args = ('Not enough scratch space, try again later',)
+
+
+def process_started(pid):
+    """Start time of process ``pid`` in clock ticks since boot, or None where
+    ``/proc`` cannot tell (other platforms, or no such process)."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name in parentheses may contain spaces
+    return int(stat.rpartition(')')[2].split()[19])
+
+
+def pid_alive(pid, started=None):
+    """Whether process ``pid`` is running. With ``started`` (from
+    ``process_started()``), a process that reused the ID does not count."""
+    if started is not None:
+        current = process_started(pid)
+        if current is not None and current != started:
+            return False
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        # os.kill() would terminate the process on Windows
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ScratchArea:
+    """A scratch root and the bytes reserved in it by live directories.
+
+    The root and quota are read from the named settings on each use.
+    """
+
+    def __init__(self, name, root_setting, quota_setting):
+        self.name = name
+        self.root_setting = root_setting
+        self.quota_setting = quota_setting
+        self.reserved = 0
+        self._dirs = {}
+        self._changed = threading.Condition()
+        Gauge(f'scratch_{name}_reserved_bytes', lambda: self.reserved,
+              f'Bytes reserved by request directories in the {name} scratch area')
+
+    @property
+    def root(self):
+        return getattr(settings, self.root_setting)
+
+    @property
+    def quota(self):
+        return getattr(settings, self.quota_setting)
+
+    def _fits(self, size):
+        if self.quota and self.reserved + size > self.quota:
+            return False
+        os.makedirs(self.root, exist_ok=True)
+        return shutil.disk_usage(self.root).free - settings.SCRATCH_MIN_FREE_BYTES >= size
+
+    def _reconcile(self):
+        # Directories removed without release() would otherwise hold their reservation forever
+        for path in [path for path in self._dirs if not os.path.isdir(path)]:
+            self.reserved -= self._dirs.pop(path)
+
+    def try_allocate(self, size):
+        """A new directory reserving ``size`` bytes, or None if it doesn't fit now."""
+        if self.quota:
+            # An estimate above the whole quota could never be granted
+            size = min(size, self.quota)
+        with self._changed:
+            if not self._fits(size):
+                self._reconcile()
+                if not self._fits(size):
+                    return None
+            path = tempfile.mkdtemp(prefix=_owner(), dir=self.root)
+            self._dirs[path] = size
+            self.reserved += size
+            return path
+
+    def allocate(self, size, timeout):
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                path = self.try_allocate(size)
+                if path is not None:
+                    return path
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # Space freed by other processes doesn't notify, so look again every second
+                self._changed.wait(min(remaining, 1))
+
+    def release(self, path):
+        """Remove ``path`` and free its reservation; False if it isn't one of ours."""
+        with self._changed:
+            size = self._dirs.pop(path, None)
+            if size is None:
+                return False
+        shutil.rmtree(path, ignore_errors=True)
+        with self._changed:
+            self.reserved -= size
+            self._changed.notify_all()
+        return True
+
+
+def _owner():
+    pid = os.getpid()
+    started = process_started(pid)
+    return f'{pid}-' if started is None else f'{pid}-{started}-'
+
+
+disk = ScratchArea('disk', 'SCRATCH_ROOT', 'SCRATCH_QUOTA_BYTES')
+fast = ScratchArea('fast', 'SCRATCH_FAST_ROOT', 'SCRATCH_FAST_QUOTA_BYTES')
+
+
+def _areas(size):
+    if fast.root and size is not None and size <= settings.SCRATCH_FAST_MAX_BYTES:
+        return [fast, disk]
+    return [disk]
+
+
+def _size(size):
+    return settings.SCRATCH_DEFAULT_RESERVE if size is None else size
+
+
+def allocate(size=None):
+    """Path of a new scratch directory with ``size`` bytes (None: unknown)
+    reserved. Waits for space and raises ``ScratchFull`` when there is none."""
+    areas = _areas(size)
+    for area in areas:
+        path = area.try_allocate(_size(size))
+        if path is not None:
+            return path
+    # Queue on the area the work belongs in
+    path = areas[-1].allocate(_size(size), settings.SCRATCH_MAX_WAIT)
+    if path is None:
+        refused.inc()
+        raise ScratchFull(settings.SCRATCH_MAX_WAIT)
+    return path
+
+
+async def allocate_async(size=None):
+    """``allocate()`` for coroutines, polling instead of holding a thread while it waits."""
+    deadline = time.monotonic() + settings.SCRATCH_MAX_WAIT
+    areas = _areas(size)
+    while True:
+        for area in areas:
+            path = area.try_allocate(_size(size))
+            if path is not None:
+                return path
+        if time.monotonic() >= deadline:
+            refused.inc()
+            raise ScratchFull(settings.SCRATCH_MAX_WAIT)
+        await asyncio.sleep(0.25)
+
+
+def release(path):
+    """Remove a scratch directory and free its reservation. Other paths are
+    just removed, so this can clean up any work dir."""
+    for area in (fast, disk):
+        if area.release(path):
+            return
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def sweep():
+    """Remove scratch directories whose process has died. Directories of a
+    live process, however old, are left alone. Run when a worker starts."""
+    for area in (fast, disk):
+        if not area.root or not os.path.isdir(area.root):
+            continue
+        for entry in os.scandir(area.root):
+            if not entry.is_dir(follow_symlinks=False) or entry.path in area._dirs:
+                continue
+            parts = entry.name.split('-', 2)
+            if len(parts) < 2 or not parts[0].isdigit():
+                continue
+            # Without a start time (older names, no /proc) only a missing process counts
+            started = int(parts[1]) if len(parts) == 3 and parts[1].isdigit() else None
+            if not pid_alive(int(parts[0]), started):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                swept.inc()
+                logger.info('Removed stale scratch directory %s', entry.path)
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse, HttpResponse
+
+from .scratch import release
+
+logger = logging.getLogger(__name__)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileChunkIterator:
+    """Yields a byte range of a file in fixed-size chunks.
+
+    Django calls ``close()`` once the response has been fully sent (or the
+    client went away), which is where deferred cleanup of the work dir runs.
+    """
+
+    def __init__(self, file, start=0, length=None, chunk_size=None, cleanup=None):
+        # A path, or a file opened in binary mode
+        self.file = open(file, 'rb') if isinstance(file, (str, os.PathLike)) else file
+        self.file.seek(start)
+        self.remaining = length
+        self.chunk_size = chunk_size or settings.STREAM_CHUNK_SIZE
+        self.cleanup = cleanup
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        size = self.chunk_size
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                raise StopIteration
+            size = min(size, self.remaining)
+        chunk = self.file.read(size)
+        if not chunk:
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.file.close()
+        if self.cleanup is not None:
+            cleanup, self.cleanup = self.cleanup, None
+            cleanup()
+
+
+# Runs the next() calls of sync iterators served under ASGI. Iterators that
+# block between chunks (batch ZIPs, event streams) hold a thread while they do
+stream_executor = ThreadPoolExecutor(max_workers=settings.ASGI_STREAM_THREADS, thread_name_prefix='stream')
+
+
+class AsyncChunks:
+    """Async iterator pulling a sync iterator's chunks one at a time in a worker thread.
+
+    Under ASGI, Django reads a sync ``streaming_content`` iterator into a list
+    before sending any of it, which holds whole files (and never-ending event
+    streams) in memory. Wrapped, each chunk is sent as soon as it is read.
+
+    ``close()`` is called on the event loop, possibly while a ``next()`` is
+    still running after the client went away, so the iterator is closed in
+    the executor once that ``next()`` has returned.
+    """
+
+    def __init__(self, iterator):
+        self.iterator = iter(iterator)
+        self._pending = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._pending = stream_executor.submit(next, self.iterator, None)
+        chunk = await asyncio.wrap_future(self._pending)
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        close = getattr(self.iterator, 'close', None)
+        if close is None:
+            return
+        pending = self._pending
+        if pending is None:
+            stream_executor.submit(_close, close)
+        else:
+            # Runs right away when next() is done already
+            pending.add_done_callback(lambda _: stream_executor.submit(_close, close))
+
+
+def _close(close):
+    try:
+        close()
+    except Exception:
+        logger.exception('Closing a streamed response failed')
+
+
+def is_asgi(request):
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+def streaming_content(request, iterator):
+    """``iterator`` in the form the handler serving ``request`` streams without buffering."""
+    if is_asgi(request) and not hasattr(iterator, '__aiter__'):
+        return AsyncChunks(iterator)
+    return iterator
+
+
+def parse_range(header, size):
+    """Parse a single ``bytes=`` Range header into an inclusive (start, end) pair.
+
+    Returns None when there is no usable range and raises ValueError when the
+    range cannot be satisfied.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        # Multi-range and malformed headers are ignored, RFC 9110 allows that
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError('Unsatisfiable range')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Unsatisfiable range')
+    return start, min(end, size - 1)
+
+
+def remove_dir(path):
+    """Return a callable that releases the scratch directory ``path``, for deferred cleanup."""
+    return lambda: release(path)
+
+
+def stream_file(request, path, filename, content_type, cleanup=None):
+    """Build a streaming response for ``path`` honouring HTTP Range requests.
+
+    ``cleanup`` runs after the last byte is sent, or immediately if the range
+    is unsatisfiable and no body is sent at all.
+    """
+    # Opened first: a cache entry evicted from here on keeps streaming
+    file = open(path, 'rb')
+    size = os.fstat(file.fileno()).st_size
+    try:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    except ValueError:
+        file.close()
+        if cleanup is not None:
+            cleanup()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        start, length = 0, size
+        response = StreamingHttpResponse(
+            streaming_content(request, FileChunkIterator(file, cleanup=cleanup)),
+            content_type=content_type)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            streaming_content(request, FileChunkIterator(file, start, length, cleanup=cleanup)),
+            content_type=content_type, status=206)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
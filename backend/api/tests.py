@@ -1,3 +1,486 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from . import jobs, pipelines, scratch, upload_handlers, views
+from .ffmpeg_runner import ffmpeg_path, ffprobe_path
+from .formats import format_table
+from .management.commands._bench import LocalMediaServer
+from .media_cache import DiskCache, media_cache
+from .metadata import canonical_video_id, get_video_info
+from .models import Job
+from .pipelines import _PostprocessorSlots, caption_video, caption_video_segmented, combined_process, shift_captions
+from .progress import Channel
+from .scheduler import COPY, ENCODE, EncodeScheduler, SchedulerBusy, queue_only
+from .streaming import AsyncChunks, parse_range, stream_file
+from .upload_handlers import ScratchUploadHandler, UploadTooLarge, limit_upload
+from .uploads import upload_store
+
+
+def make_clip(path, duration=15, gop=150, box=None, start=0):
+    """Black 320x240 H.264/AAC clip with a keyframe every ``gop`` frames (30 fps)
+    and a white box in the top-left corner from ``box[0]`` to ``box[1]`` seconds.
+    Its timestamps begin at ``start``."""
+    video = f'color=black:size=320x240:rate=30:d={duration}'
+    if box:
+        video += f",drawbox=x=0:y=0:w=80:h=60:color=white:t=fill:enable='between(t,{box[0]},{box[1]})'"
+    subprocess.run([ffmpeg_path(), '-v', 'error', '-y', '-f', 'lavfi', '-i', video,
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:d={duration}',
+                    '-c:v', 'libx264', '-preset', 'veryfast', '-g', str(gop), '-keyint_min', str(gop),
+                    '-sc_threshold', '0', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest',
+                    '-output_ts_offset', str(start), path], check=True)
+    return path
+
+
+def frame_times(path):
+    """Timestamps of every video frame of ``path``."""
+    output = subprocess.run([ffprobe_path(), '-v', 'error', '-select_streams', 'v', '-show_entries',
+                             'frame=pts_time', '-of', 'csv=p=0', path],
+                            capture_output=True, text=True, check=True).stdout
+    return [float(t) for t in output.replace(',', ' ').split()]
+
+
+def stream_durations(path):
+    output = subprocess.run([ffprobe_path(), '-v', 'error', '-show_entries', 'stream=codec_type,duration',
+                             '-of', 'csv=p=0', path], capture_output=True, text=True, check=True).stdout
+    return {kind: float(duration) for kind, duration in (line.split(',') for line in output.split())}
+
+
+def lit_span(path, crop):
+    """First and last timestamp at which something bright shows in the
+    ``crop`` (ffmpeg ``w:h:x:y``) region of ``path``, or None."""
+    frames = subprocess.run([ffmpeg_path(), '-v', 'error', '-i', path, '-vf', f'crop={crop}',
+                             '-fps_mode', 'passthrough', '-f', 'rawvideo', '-pix_fmt', 'gray', 'pipe:1'],
+                            capture_output=True, check=True).stdout
+    times = frame_times(path)
+    size = len(frames) // len(times)
+    lit = [t for i, t in enumerate(times) if max(frames[i * size:(i + 1) * size]) > 100]
+    return (lit[0], lit[-1]) if lit else None
+
+
+BOX = '80:60:0:0'
+CAPTION_AREA = '320:100:0:140'
+
+
+class RangeTests(SimpleTestCase):
+    def test_parse_range(self):
+        self.assertIsNone(parse_range(None, 100))
+        self.assertEqual(parse_range('bytes=10-19', 100), (10, 19))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-30', 100), (70, 99))
+        self.assertEqual(parse_range('bytes=50-500', 100), (50, 99))
+        # Multiple ranges are answered with the whole file
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 100))
+        for header in ('bytes=100-', 'bytes=-0', 'bytes=20-10'):
+            with self.assertRaises(ValueError):
+                parse_range(header, 100)
+
+    def test_stream_file_serves_a_range_and_cleans_up_after_it(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'video.mp4')
+        with open(path, 'wb') as f:
+            f.write(bytes(range(100)))
+        cleanup = mock.Mock()
+        response = stream_file(RequestFactory().get('/', HTTP_RANGE='bytes=10-19'), path, 'video.mp4',
+                               'video/mp4', cleanup)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+        cleanup.assert_not_called()
+        response.close()
+        cleanup.assert_called_once()
+
+        response = stream_file(RequestFactory().get('/', HTTP_RANGE='bytes=200-'), path, 'video.mp4',
+                               'video/mp4', cleanup)
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */100'))
+        self.assertEqual(cleanup.call_count, 2)
+
+
+class SchedulerTests(SimpleTestCase):
+    def test_sheds_runs_that_would_wait_too_long(self):
+        encode = EncodeScheduler(1, 1, max_wait=5)
+        with encode.slot(COPY):
+            # A stream copy is expected to be done soon
+            encode.check(ENCODE)
+        with encode.slot(ENCODE):
+            # An encode isn't
+            with self.assertRaises(SchedulerBusy) as raised:
+                encode.check(COPY)
+            self.assertGreater(raised.exception.retry_after, 5)
+            # Background work always queues
+            with queue_only():
+                encode.check(ENCODE)
+        encode.check(ENCODE)
+        self.assertEqual(encode.rejected.value, 1)
+
+
+class RangedDownloadTests(TestCase):
+    def test_fetches_only_the_requested_window(self):
+        source_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir, ignore_errors=True)
+        clip = make_clip(os.path.join(source_dir, 'source.mp4'), duration=120, gop=60)
+        # Throttled so ffmpeg's abandoned reads don't count the rest of the file as sent
+        with LocalMediaServer(source_dir, rate=256 * 1024) as server, \
+                mock.patch.object(media_cache, 'max_bytes', 0):
+            # Extraction fetches the start of the file, that's not the window
+            get_video_info(server.url('source.mp4'))
+            server.reset()
+            response = self.client.post(reverse('download-video'),
+                                        {'url': server.url('source.mp4'), 'format_id': 'mp4',
+                                         'start': '60', 'end': '65', 'frame_accurate': 'true'}, secure=True)
+            self.assertEqual(response.status_code, 200)
+            output = os.path.join(source_dir, 'output.mp4')
+            with open(output, 'wb') as f:
+                for chunk in response.streaming_content:
+                    f.write(chunk)
+        self.assertLess(server.bytes_sent, os.path.getsize(clip) / 2)
+        durations = stream_durations(output)
+        self.assertAlmostEqual(durations['video'], 5, delta=0.1)
+        self.assertAlmostEqual(durations['audio'], 5, delta=0.1)
+
+
+class JobSubmitTests(TestCase):
+    def setUp(self):
+        self.job_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.job_root, ignore_errors=True)
+        settings_override = override_settings(JOB_ROOT=self.job_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Keep workers from picking the job up and downloading for real
+        enqueue = mock.patch.object(jobs, '_enqueue')
+        enqueue.start()
+        self.addCleanup(enqueue.stop)
+
+    def test_download_with_only_a_start_time(self):
+        response = self.client.post(reverse('job-download'),
+                                    {'url': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'start': '30'},
+                                    secure=True)
+        self.assertEqual(response.status_code, 202)
+        job = Job.objects.get(pk=response.json()['id'])
+        self.assertEqual(job.params['section'], [30.0, None, False])
+
+        with mock.patch.object(jobs, 'fetch_media', return_value=('', 'video.mp4', 'video/mp4')) as fetch, \
+                mock.patch.object(jobs, 'link_or_copy'):
+            jobs._execute(job, None)
+        self.assertEqual(fetch.call_args.args[4], (30.0, float('inf'), False))
+
+    def test_upload_without_scratch_space(self):
+        with override_settings(SCRATCH_ROOT=self.job_root, SCRATCH_QUOTA_BYTES=1, SCRATCH_MAX_WAIT=0,
+                               FILE_UPLOAD_MAX_MEMORY_SIZE=0):
+            # Another request holds the whole quota
+            held = scratch.allocate(1)
+            self.addCleanup(scratch.release, held)
+            response = self.client.post(reverse('job-trim'),
+                                        {'video': SimpleUploadedFile('clip.mp4', b'\0' * 1024), 'end': '5'},
+                                        secure=True)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertFalse(Job.objects.exists())
+
+    def test_a_job_runs_once_however_often_it_is_enqueued(self):
+        job = Job.objects.create(kind=Job.KIND_TRIM, work_dir=self.job_root, params={})
+        with mock.patch.object(jobs, '_execute', return_value=('', 'out.mp4', 'video/mp4')) as execute:
+            # Two workers pick up the same job
+            jobs._run(job.id)
+            jobs._run(job.id)
+        execute.assert_called_once()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker_pid), (Job.STATUS_DONE, os.getpid()))
+
+    def test_recover_requeues_jobs_of_a_reused_pid(self):
+        # A job left running by a previous boot whose worker had this process's PID
+        job = Job.objects.create(kind=Job.KIND_TRIM, status=Job.STATUS_RUNNING, work_dir=self.job_root,
+                                 worker_pid=os.getpid(), worker_started=scratch.process_started(os.getpid()) - 1)
+        ours = Job.objects.create(kind=Job.KIND_TRIM, status=Job.STATUS_RUNNING, work_dir=self.job_root,
+                                  worker_pid=os.getpid(), worker_started=scratch.process_started(os.getpid()))
+        with mock.patch.object(jobs, '_recovered', False):
+            jobs.recover()
+        job.refresh_from_db()
+        ours.refresh_from_db()
+        self.assertEqual(job.status, Job.STATUS_QUEUED)
+        self.assertEqual(ours.status, Job.STATUS_RUNNING)
+
+
+class FormatTableTests(SimpleTestCase):
+    def info(self, epoch, size):
+        return {'id': 'abc', 'extractor_key': 'Generic', 'epoch': epoch, 'duration': 10,
+                'formats': [{'format_id': '18', 'url': 'https://example.com/18', 'vcodec': 'avc1',
+                             'acodec': 'mp4a', 'height': 360, 'filesize': size}]}
+
+    def test_memoized_outside_the_shared_info(self):
+        info = self.info(1, 1000)
+        table = format_table(info)
+        self.assertIs(format_table(info), table)
+        self.assertEqual(info, self.info(1, 1000))
+        # A fresh extraction gets its own table
+        self.assertEqual(format_table(self.info(2, 2000))[0]['bytes'], 2000)
+
+
+class UploadLimitTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(SCRATCH_ROOT=self.root, SCRATCH_FAST_ROOT=None,
+                                              FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_refused_from_the_content_length(self):
+        with mock.patch.object(upload_store, 'max_bytes', 1024), \
+                mock.patch.object(upload_handlers, 'allocate', wraps=scratch.allocate) as allocate, \
+                mock.patch.object(views, 'store_upload') as store:
+            response = self.client.post(reverse('upload'),
+                                        {'video': SimpleUploadedFile('clip.mp4', b'\0' * 2048)}, secure=True)
+        self.assertEqual(response.status_code, 413)
+        # Nothing was spooled
+        allocate.assert_not_called()
+        store.assert_not_called()
+
+    def test_handler_stops_once_the_file_outgrows_the_limit(self):
+        request = RequestFactory().post('/', content_type='application/octet-stream')
+        limit_upload(request, 1024)
+        handler = ScratchUploadHandler(request)
+        handler.new_file('video', 'clip.mp4', 'video/mp4', None)
+        self.assertEqual(os.listdir(self.root), [os.path.basename(request.scratch_dir)])
+        handler.receive_data_chunk(b'\0' * 1000, 0)
+        with self.assertRaises(UploadTooLarge):
+            handler.receive_data_chunk(b'\0' * 1000, 1000)
+        # The spooled part is gone along with its scratch directory
+        self.assertEqual(os.listdir(self.root), [])
+
+
+class ScratchSweepTests(SimpleTestCase):
+    def test_removes_only_directories_of_dead_owners(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        pid, started = os.getpid(), scratch.process_started(os.getpid())
+        finished = subprocess.Popen(['true'])
+        finished.wait()
+        names = {'ours': f'{pid}-{started}-ours', 'reused': f'{pid}-{started - 1}-reused',
+                 'dead': f'{finished.pid}-dead'}
+        for name in names.values():
+            os.mkdir(os.path.join(root, name))
+        # However old, a live owner's directory stays
+        os.utime(os.path.join(root, names['ours']), (0, 0))
+        with override_settings(SCRATCH_ROOT=root, SCRATCH_FAST_ROOT=None), self.assertLogs('api.scratch'):
+            scratch.sweep()
+        self.assertEqual(os.listdir(root), [names['ours']])
+
+
+class DiskCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.cache = DiskCache('test', self.root, 30)
+        self.produced = []
+
+    def produce(self, content):
+        def produce(work_dir):
+            self.produced.append(content)
+            path = os.path.join(work_dir, 'payload.bin')
+            with open(path, 'wb') as f:
+                f.write(content)
+            return path, {'content': content.decode()}
+        return produce
+
+    def test_hit_and_miss(self):
+        entry, hit = self.cache.get_or_create('a', self.produce(b'a' * 12))
+        self.assertFalse(hit)
+        entry, hit = self.cache.get_or_create('a', self.produce(b'b' * 12))
+        self.assertTrue(hit)
+        self.assertEqual(entry.meta['content'], 'a' * 12)
+        self.assertEqual((self.cache.hits.value, self.cache.misses.value), (1, 1))
+
+    def test_evicts_least_recently_used_with_its_lock_file(self):
+        self.cache.get_or_create('a', self.produce(b'a' * 12))
+        self.cache.get_or_create('b', self.produce(b'b' * 12))
+        os.utime(os.path.join(self.root, 'a', 'meta.json'), (1, 1))
+        os.utime(os.path.join(self.root, 'b', 'meta.json'), (2, 2))
+        # Using 'a' makes 'b' the least recently used
+        self.cache.get('a')
+        self.cache.get_or_create('c', self.produce(b'c' * 12))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, '.locks'))), ['a', 'c'])
+
+    def test_fetched_file_outlives_eviction(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        path, meta = self.cache.fetch('a', self.produce(b'a' * 12), work_dir)
+        self.cache._remove('a')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 12)
+
+    def test_entry_evicted_before_use_is_a_miss(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        self.cache.get_or_create('a', self.produce(b'a' * 12))
+        pin = self.cache.pin
+
+        def evicted_first(entry, directory):
+            # Another process evicts the entry between the lookup and the link
+            if len(self.produced) == 1:
+                self.cache._remove('a')
+            return pin(entry, directory)
+
+        with mock.patch.object(self.cache, 'pin', evicted_first):
+            path, _ = self.cache.fetch('a', self.produce(b'b' * 12), work_dir)
+        self.assertEqual(self.produced, [b'a' * 12, b'b' * 12])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'b' * 12)
+
+
+class ProgressChannelTests(TestCase):
+    def test_new_run_reopens_a_finished_key(self):
+        channel = Channel()
+        channel.publish({'status': 'done'}, done=True)
+        channel.publish({'stage': 'download'})
+        event, seq, done = channel.wait(0, timeout=0)
+        self.assertEqual((event, seq, done), ({'stage': 'download'}, 2, False))
+
+
+class AsyncChunksTests(SimpleTestCase):
+    async def test_close_while_a_chunk_is_being_read(self):
+        reading, release, closed = threading.Event(), threading.Event(), threading.Event()
+
+        def chunks():
+            try:
+                reading.set()
+                release.wait(5)
+                yield b'chunk'
+            finally:
+                closed.set()
+
+        stream = AsyncChunks(chunks())
+        read = asyncio.ensure_future(stream.__anext__())
+        await asyncio.to_thread(reading.wait, 5)
+        # The client went away mid-chunk
+        read.cancel()
+        stream.close()
+        self.assertFalse(closed.is_set())
+        release.set()
+        self.assertTrue(await asyncio.to_thread(closed.wait, 5))
+
+
+class PostprocessorSlotTests(SimpleTestCase):
+    def test_holds_one_slot_while_a_postprocessor_runs(self):
+        encode = EncodeScheduler(2, 1, 0)
+        hook = _PostprocessorSlots(ENCODE)
+        with mock.patch.object(pipelines, 'scheduler', encode):
+            # yt-dlp reports the start twice
+            hook({'postprocessor': 'Merger', 'status': 'started'})
+            hook({'postprocessor': 'Merger', 'status': 'started'})
+            self.assertEqual(len(encode._running), 1)
+            hook({'postprocessor': 'Merger', 'status': 'finished'})
+            self.assertEqual(len(encode._running), 0)
+            # A download failing mid-postprocessor frees the slot on close()
+            hook({'postprocessor': 'ExtractAudio', 'status': 'started'})
+            hook.close()
+            hook.close()
+            self.assertEqual(len(encode._running), 0)
+
+
+class CanonicalVideoIdTests(SimpleTestCase):
+    def test_url_forms_of_one_video_share_a_key(self):
+        keys = {canonical_video_id(url) for url in (
+            'https://youtu.be/dQw4w9WgXcQ?t=10', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ&feature=share',
+            'youtube.com/shorts/dQw4w9WgXcQ', 'https://m.youtube.com/embed/dQw4w9WgXcQ')}
+        self.assertEqual(keys, {'youtube:dQw4w9WgXcQ'})
+
+    def test_other_ports_are_other_servers(self):
+        self.assertEqual(canonical_video_id('http://example.com:80/v.mp4?utm_source=x'),
+                         canonical_video_id('https://example.com/v.mp4'))
+        self.assertNotEqual(canonical_video_id('http://127.0.0.1:8001/v.mp4'),
+                            canonical_video_id('http://127.0.0.1:8002/v.mp4'))
+
+
+class CaptionShiftTests(SimpleTestCase):
+    CUES = '1\n00:00:08,000 --> 00:00:09,000\nFirst\n\n2\n00:00:15,000 --> 00:00:16,000\nSecond\n'
+
+    def test_shifts_and_drops_cues_outside_the_clip(self):
+        shifted = shift_captions(self.CUES, 7, 5)
+        self.assertIn('00:00:01,000 --> 00:00:02,000', shifted)
+        self.assertNotIn('Second', shifted)
+
+    def test_no_cues_in_the_clip(self):
+        self.assertEqual(shift_captions(self.CUES, 2, 4), '')
+
+
+class CombinedProcessTests(TestCase):
+    CUE = '1\n00:00:08,000 --> 00:00:09,000\nHELLO HELLO\n'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.source_dir = tempfile.mkdtemp()
+        # Keyframes at 0, 5 and 10 s; the box shows while the cue does
+        cls.clip = make_clip(os.path.join(cls.source_dir, 'input.mp4'), gop=150, box=(8, 9))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.source_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+
+    def assert_in_sync(self, output, box_start):
+        box = lit_span(output, BOX)
+        caption = lit_span(output, CAPTION_AREA)
+        self.assertAlmostEqual(box[0], box_start, delta=0.05)
+        self.assertAlmostEqual(caption[0], box[0], delta=0.05)
+        self.assertAlmostEqual(caption[1], box[1], delta=0.05)
+        durations = stream_durations(output)
+        self.assertAlmostEqual(durations['audio'], durations['video'], delta=0.1)
+
+    def test_keyframe_start_keeps_captions_in_sync(self):
+        # Starts at the keyframe at 5 s, so the box shows 3 s in
+        self.assert_in_sync(combined_process(self.clip, 7, 12, self.CUE, self.work_dir), 3)
+
+    def test_frame_accurate_start_keeps_captions_in_sync(self):
+        self.assert_in_sync(combined_process(self.clip, 7, 12, self.CUE, self.work_dir, frame_accurate=True), 1)
+
+    def test_no_cues_in_the_clip(self):
+        output = combined_process(self.clip, 2, 6, self.CUE, self.work_dir)
+        self.assertIsNone(lit_span(output, CAPTION_AREA))
+
+
+class SegmentedCaptionTests(TestCase):
+    def test_segments_without_cues(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        # Four 10 s segments with two workers; only the second one has a cue
+        clip = make_clip(os.path.join(work_dir, 'input.mp4'), duration=40, box=(12, 13))
+        cue = '1\n00:00:12,000 --> 00:00:13,000\nHELLO HELLO\n'
+        output = caption_video_segmented(clip, cue, work_dir, 2)
+        self.assertEqual(len(frame_times(output)), len(frame_times(clip)))
+        box, caption = lit_span(output, BOX), lit_span(output, CAPTION_AREA)
+        self.assertAlmostEqual(caption[0], box[0], delta=0.05)
+        self.assertAlmostEqual(caption[1], box[1], delta=0.05)
+
+
+class SmartRenderTests(TestCase):
+    def test_keeps_every_frame_of_an_input_not_starting_at_zero(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        # 500 frames with a keyframe every 2 s; only the last GOPs get re-encoded
+        clip = make_clip(os.path.join(work_dir, 'input.mp4'), duration=500 / 30, gop=60, box=(15, 16.6), start=1.5)
+        cue = '1\n00:00:15,000 --> 00:00:16,600\nHELLO HELLO\n'
+        output = caption_video(clip, cue, work_dir)
+        source, rendered = frame_times(clip), frame_times(output)
+        self.assertEqual(len(rendered), len(source))
+        for before, after in zip(source, rendered):
+            self.assertAlmostEqual(after - rendered[0], before - source[0], places=3)
+        box, caption = lit_span(output, BOX), lit_span(output, CAPTION_AREA)
+        self.assertAlmostEqual(caption[0], box[0], delta=0.05)
@@ -0,0 +1,270 @@
+"""Per-stage timing of requests and jobs.
+
+The work behind a request is split into stages with ``span()``: ``extract``
+(yt-dlp metadata), ``download``, ``postprocess`` (yt-dlp's merges and
+conversions), ``probe``, ``encode``, ``file_io`` and ``send``, the response
+body going out. Each stage is observed in ``stage_seconds`` per endpoint;
+stages that move data count it in ``stage_bytes`` (download throughput is
+the rate of one over the other), and encodes record seconds of media
+produced per second in ``encode_realtime_factor``.
+
+``RequestMetricsMiddleware`` starts a trace for every request, which spans
+find through a context variable, and records latency up to the last byte
+sent, response bytes and requests in flight per endpoint. Work run on
+another thread joins the request's trace when it is submitted through
+``bind()``; otherwise it is recorded under the ``background`` endpoint.
+
+A ``PROFILE_SAMPLE_RATE`` share of requests and jobs is profiled: their
+stage breakdown goes out in a ``Server-Timing`` header, is logged once the
+response is sent and, with ``PROFILE_DIR`` set, is written there as JSON.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.urls import Resolver404, resolve
+
+from .metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+stage_seconds = Histogram('stage_seconds', 'Time spent in each stage of a request',
+                          labels=('endpoint', 'stage'))
+stage_bytes = Counter('stage_bytes', 'Bytes downloaded, read, written or sent in each stage of a request',
+                      labels=('endpoint', 'stage'))
+realtime_factor = Histogram('encode_realtime_factor', 'Seconds of media ffmpeg produced per second it ran',
+                            buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128), labels=('endpoint', 'op'))
+request_seconds = Histogram('request_seconds', 'Time from receiving a request to sending the last byte',
+                            labels=('endpoint', 'method', 'status'))
+response_bytes = Counter('response_bytes', 'Response body bytes sent', labels=('endpoint',))
+in_flight = Gauge('requests_in_flight', description='Requests being handled or sent', labels=('endpoint',))
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    """The spans of one request or job.
+
+    Spans are always observed in the metrics; only sampled traces keep them
+    for the breakdown.
+    """
+
+    def __init__(self, endpoint, sampled=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.endpoint = endpoint
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, stage, started, seconds, details):
+        stage_seconds.observe(seconds, endpoint=self.endpoint, stage=stage)
+        if details.get('bytes'):
+            stage_bytes.inc(details['bytes'], endpoint=self.endpoint, stage=stage)
+        if details.get('media_seconds') and seconds > 0:
+            details['realtime'] = round(details['media_seconds'] / seconds, 2)
+            realtime_factor.observe(details['realtime'], endpoint=self.endpoint, op=details.get('op', stage))
+        if self.sampled:
+            self.spans.append(dict(details, stage=stage, start=round(started - self.started, 4),
+                                   seconds=round(seconds, 4)))
+
+    def stages(self):
+        """Total seconds per stage, in order of first appearance."""
+        totals = {}
+        for span in self.spans:
+            totals[span['stage']] = totals.get(span['stage'], 0) + span['seconds']
+        return totals
+
+    def server_timing(self):
+        return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in self.stages().items())
+
+    def breakdown(self, **fields):
+        return dict(fields, id=self.id, endpoint=self.endpoint,
+                    seconds=round(time.perf_counter() - self.started, 4), stages=self.stages(),
+                    spans=self.spans)
+
+    def dump(self, **fields):
+        """Log the breakdown of a sampled trace and write it to ``PROFILE_DIR``."""
+        if not self.sampled:
+            return
+        breakdown = self.breakdown(**fields)
+        parts = []
+        for span in self.spans:
+            part = f"{span['stage']} {span['seconds']:.3f}s"
+            if span.get('bytes'):
+                part += f" {span['bytes'] / 1024 ** 2:.1f} MiB"
+                if span['seconds'] > 0:
+                    part += f" at {span['bytes'] / 1024 ** 2 / span['seconds']:.1f} MiB/s"
+            if span.get('realtime'):
+                part += f" {span['realtime']}x realtime"
+            parts.append(part)
+        logger.info('Profile %s of %s: %.3fs total; %s', self.id, self.endpoint, breakdown['seconds'],
+                    ', '.join(parts) or 'no stages')
+        if settings.PROFILE_DIR:
+            try:
+                os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+                path = os.path.join(settings.PROFILE_DIR, f'{int(time.time())}-{self.endpoint}-{self.id}.json')
+                with open(path, 'w') as f:
+                    json.dump(breakdown, f, indent=2)
+            except OSError:
+                logger.warning('Could not write profile %s', self.id, exc_info=True)
+
+
+# Spans outside any request or job
+_background = Trace('background')
+
+
+def _sampled():
+    return settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE
+
+
+@contextmanager
+def span(stage, **details):
+    """Time the block as ``stage`` of the current request or job.
+
+    Yields a dict of details for the breakdown that the block may add to:
+    ``bytes`` is counted in ``stage_bytes`` and ``media_seconds`` (of output
+    produced) gives the realtime factor.
+    """
+    trace = _current.get() or _background
+    started = time.perf_counter()
+    try:
+        yield details
+    finally:
+        trace.add(stage, started, time.perf_counter() - started, details)
+
+
+def record(stage, seconds, **details):
+    """Add a stage that was timed elsewhere (e.g. by yt-dlp) and just ended."""
+    trace = _current.get() or _background
+    trace.add(stage, time.perf_counter() - seconds, seconds, details)
+
+
+@contextmanager
+def traced(endpoint):
+    """Trace the block, e.g. a job run, as one request to ``endpoint``."""
+    trace = Trace(endpoint, _sampled())
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        trace.dump()
+
+
+def bind(fn, *args, **kwargs):
+    """``fn(*args, **kwargs)`` as a callable for another thread that runs in a
+    copy of the caller's context, so its spans count towards the current request."""
+    return partial(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def endpoint_name(request):
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return 'other'
+    return match.url_name or match.route or 'other'
+
+
+class SentBody:
+    """A streamed response body, passed through to count what is sent.
+
+    Django closes it once the last byte has gone out or the client left,
+    which is when the request's trace ends.
+    """
+
+    def __init__(self, chunks, done):
+        self.chunks = chunks
+        self.done = done
+        self.sent = 0
+
+    def close(self):
+        if self.done is not None:
+            done, self.done = self.done, None
+            done(self.sent)
+
+
+class SentChunks(SentBody):
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self.chunks)
+        self.sent += len(chunk)
+        return chunk
+
+
+class AsyncSentChunks(SentBody):
+    # No __iter__: Django tells sync and async bodies apart by trying iter()
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.chunks.__anext__()
+        self.sent += len(chunk)
+        return chunk
+
+
+class RequestMetricsMiddleware:
+    """Traces each request from arrival until its response has been sent."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        trace, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.respond(request, trace, response)
+
+    async def __acall__(self, request):
+        trace, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.respond(request, trace, response)
+
+    def start(self, request):
+        trace = Trace(endpoint_name(request), _sampled())
+        in_flight.inc(endpoint=trace.endpoint)
+        return trace, _current.set(trace)
+
+    def respond(self, request, trace, response):
+        if trace.sampled:
+            response['Server-Timing'] = trace.server_timing()
+            response['X-Profile-Id'] = trace.id
+
+        def done(sent):
+            if response.streaming:
+                trace.add('send', handed_over, time.perf_counter() - handed_over, {'bytes': sent})
+            response_bytes.inc(sent, endpoint=trace.endpoint)
+            request_seconds.observe(time.perf_counter() - trace.started, endpoint=trace.endpoint,
+                                    method=request.method, status=response.status_code)
+            in_flight.dec(endpoint=trace.endpoint)
+            trace.dump(method=request.method, status=response.status_code)
+
+        handed_over = time.perf_counter()
+        if not response.streaming:
+            done(len(response.content))
+        elif response.is_async:
+            response.streaming_content = AsyncSentChunks(response.streaming_content, done)
+        else:
+            response.streaming_content = SentChunks(response.streaming_content, done)
+        return response
@@ -0,0 +1,77 @@
+"""Spool uploads straight into the request's scratch directory.
+
+Django's default handler spools large uploads into ``FILE_UPLOAD_TEMP_DIR``
+and the views then copied them into their own temp dir. Writing them into
+the request's scratch directory (on the same filesystem as the job and
+upload stores) lets ``save_upload`` hard-link the file instead. The
+directory comes from ``scratch.allocate()``, reserving the request body's
+size. A view can cap the size of a file with ``limit_upload()``; the handler
+then gives up as soon as more has arrived, instead of spooling the rest.
+"""
+import os
+import tempfile
+
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+from .scratch import allocate, release
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes):
+        super().__init__('Upload exceeds the storage quota')
+        self.max_bytes = max_bytes
+
+
+def limit_upload(request, max_bytes):
+    """Make the upload handlers of ``request`` raise ``UploadTooLarge`` once a
+    file grows past ``max_bytes``. Call before the form is parsed."""
+    getattr(request, '_request', request).upload_max_bytes = max_bytes
+
+
+def scratch_dir(request, size=None):
+    """The request's scratch directory, allocated on first use with ``size``
+    bytes reserved (by default the request body, for a spooled upload).
+    Raises ``ScratchFull`` when there is no room."""
+    request = getattr(request, '_request', request)
+    if getattr(request, 'scratch_dir', None) is None:
+        if size is None:
+            size = int(request.META.get('CONTENT_LENGTH') or 0)
+        request.scratch_dir = allocate(size)
+    return request.scratch_dir
+
+
+class ScratchUploadedFile(TemporaryUploadedFile):
+    def __init__(self, directory, name, content_type, size, charset, content_type_extra=None):
+        _, ext = os.path.splitext(name)
+        file = tempfile.NamedTemporaryFile(suffix='.upload' + ext, dir=directory)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+
+    def close(self):
+        super().close()
+        # Django closes uploads once the response is done; drop the scratch
+        # directory too unless the view put something else in it
+        directory = os.path.dirname(self.temporary_file_path())
+        try:
+            empty = not os.listdir(directory)
+        except OSError:
+            return
+        if empty:
+            release(directory)
+
+
+class ScratchUploadHandler(TemporaryFileUploadHandler):
+    """Like Django's TemporaryFileUploadHandler, but spools into ``scratch_dir(request)``."""
+
+    def new_file(self, *args, **kwargs):
+        super(TemporaryFileUploadHandler, self).new_file(*args, **kwargs)
+        self.file = ScratchUploadedFile(scratch_dir(self.request), self.file_name, self.content_type,
+                                        0, self.charset, self.content_type_extra)
+
+    def receive_data_chunk(self, raw_data, start):
+        max_bytes = getattr(self.request, 'upload_max_bytes', None)
+        if max_bytes is not None and start + len(raw_data) > max_bytes:
+            # Deletes what was spooled and frees the scratch directory
+            self.file.close()
+            raise UploadTooLarge(max_bytes)
+        return super().receive_data_chunk(raw_data, start)
@@ -0,0 +1,118 @@
+"""Upload-once media handles for the edit endpoints.
+
+A video is uploaded once to ``/api/uploads/`` and stored under the SHA-256
+of its content, which doubles as the handle. Trim, caption and combined
+requests can then pass ``handle`` instead of re-sending the file.
+"""
+import hashlib
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import InMemoryUploadedFile
+
+from .media_cache import DiskCache, derived_cache
+from .pipelines import save_upload, link_upload, is_streamable_mp4, file_digest
+from .tracing import span
+
+HANDLE_RE = re.compile(r'^[0-9a-f]{64}$')
+
+upload_store = DiskCache('upload', settings.UPLOAD_STORE_DIR,
+                         settings.UPLOAD_STORE_MAX_BYTES, max_age=settings.UPLOAD_TTL)
+
+
+class UploadNotFound(Exception):
+    pass
+
+
+def store_upload(uploaded_file):
+    """Store ``uploaded_file`` by content hash and return ``(entry, duplicate)``."""
+    tmp_root = os.path.join(upload_store.root, '.tmp')
+    os.makedirs(tmp_root, exist_ok=True)
+    tmp_path = os.path.join(tmp_root, f'{uuid.uuid4().hex}.mp4')
+    try:
+        digest = hashlib.sha256()
+        if link_upload(uploaded_file, tmp_path):
+            # Already spooled to disk, it only needs reading to hash it
+            with span('file_io', op='hash', bytes=uploaded_file.size):
+                for chunk in uploaded_file.chunks():
+                    digest.update(chunk)
+        else:
+            # Hash while writing so the file is only read once
+            with span('file_io', op='store_upload', bytes=uploaded_file.size), open(tmp_path, 'wb') as f:
+                for chunk in uploaded_file.chunks():
+                    digest.update(chunk)
+                    f.write(chunk)
+
+        def produce(work_dir):
+            return tmp_path, {'name': uploaded_file.name}
+
+        return upload_store.get_or_create(digest.hexdigest(), produce)
+    finally:
+        if os.path.exists(tmp_path):
+            # Duplicate of an existing upload
+            os.remove(tmp_path)
+
+
+def get_upload(handle):
+    """Return the stored upload entry for ``handle`` or raise UploadNotFound."""
+    entry = upload_store.get(handle) if HANDLE_RE.match(handle) else None
+    if entry is None:
+        raise UploadNotFound('Unknown or expired upload handle')
+    return entry
+
+
+def edit_scratch_bytes(request):
+    """Bytes an edit request is expected to write to its scratch directory:
+    the saved upload plus up to two outputs about its size (a combined edit
+    trims, then captions). None when there is nothing to go by.
+
+    Multipart bodies are not parsed here, as that would spool the upload
+    before the directory exists.
+    """
+    if not request.content_type.startswith('multipart/'):
+        handle = request.data.get('handle')
+        entry = upload_store.get(handle) if handle and HANDLE_RE.match(handle) else None
+        return entry.size * 2 if entry is not None else None
+    length = int(request.META.get('CONTENT_LENGTH') or 0)
+    return length * 3 if length else None
+
+
+def resolve_input(request, work_dir):
+    """Return ``(input_path, name)`` for an edit request.
+
+    Uses the stored upload named by ``handle`` when given; otherwise copies
+    the ``video`` file into ``work_dir`` as before. Stored uploads are read in
+    place and must not be modified.
+    """
+    handle = request.data.get('handle')
+    if handle:
+        entry = get_upload(handle)
+        return entry.path, entry.meta['name']
+    uploaded = request.FILES['video']
+    return save_upload(uploaded, work_dir), uploaded.name
+
+
+def input_digest(request, input_path=None, input_data=None):
+    """Content hash of an edit request's input, which keys its media info and
+    derived outputs. A stored upload's handle already is its hash; other
+    inputs are only hashed while the derived cache is on."""
+    handle = request.data.get('handle')
+    if handle:
+        return handle
+    if not derived_cache.enabled:
+        return None
+    if input_data is not None:
+        return hashlib.sha256(input_data).hexdigest()
+    return file_digest(input_path)
+
+
+def piped_upload(request):
+    """Bytes of a small in-memory ``video`` upload that ffmpeg can read from
+    stdin, so it never has to be written to disk; None otherwise."""
+    uploaded = request.FILES.get('video')
+    if request.data.get('handle') or not isinstance(uploaded, InMemoryUploadedFile):
+        return None
+    data = uploaded.read()
+    return data if is_streamable_mp4(data) else None
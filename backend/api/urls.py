@@ -1,13 +1,40 @@
+from django.conf import settings
 from django.urls import path
 from .views import (DownloadVideoView, VideoInfoView, TrimVideoView, CaptionVideoView, CombinedProcessView)
 from .views import TestFFmpegView
+from .views import JobSubmitView, JobStatusView, JobResultView
+from .views import StatsView, MetricsView, UploadView, UploadInfoView, ProgressStreamView, BatchDownloadView, BulkVideoInfoView
+from .views import ThumbnailView, FilmstripView, UploadFilmstripView
+
+if settings.ASYNC_VIEWS:
+    from .async_views import (AsyncVideoInfoView as VideoInfoView,
+                              AsyncBulkVideoInfoView as BulkVideoInfoView,
+                              AsyncDownloadVideoView as DownloadVideoView,
+                              AsyncTrimVideoView as TrimVideoView,
+                              AsyncProgressStreamView as ProgressStreamView)
 
 urlpatterns = [
     path('info/', VideoInfoView.as_view(), name='video-info'),
+    path('info/bulk/', BulkVideoInfoView.as_view(), name='video-info-bulk'),
     path('download/', DownloadVideoView.as_view(), name='download-video'),
-    path('test-ffmpeg/', TestFFmpegView.as_view()),
+    path('batch/', BatchDownloadView.as_view(), name='batch-download'),
+    path('test-ffmpeg/', TestFFmpegView.as_view(), name='test-ffmpeg'),
     path('trim/', TrimVideoView.as_view(), name='trim-video'),
     path('caption/', CaptionVideoView.as_view(), name='caption-video'),
     path('combined/', CombinedProcessView.as_view(), name='combined-process'),
+    path('uploads/', UploadView.as_view(), name='upload'),
+    path('uploads/<str:handle>/', UploadInfoView.as_view(), name='upload-info'),
+    path('uploads/<str:handle>/filmstrip/', UploadFilmstripView.as_view(), name='upload-filmstrip'),
+    path('thumbnail/', ThumbnailView.as_view(), name='thumbnail'),
+    path('filmstrip/', FilmstripView.as_view(), name='filmstrip'),
+    path('jobs/download/', JobSubmitView.as_view(), {'kind': 'download'}, name='job-download'),
+    path('jobs/trim/', JobSubmitView.as_view(), {'kind': 'trim'}, name='job-trim'),
+    path('jobs/caption/', JobSubmitView.as_view(), {'kind': 'caption'}, name='job-caption'),
+    path('jobs/combined/', JobSubmitView.as_view(), {'kind': 'combined'}, name='job-combined'),
+    path('jobs/<uuid:job_id>/', JobStatusView.as_view(), name='job-status'),
+    path('jobs/<uuid:job_id>/result/', JobResultView.as_view(), name='job-result'),
+    path('stats/', StatsView.as_view(), name='stats'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('progress/<str:key>/', ProgressStreamView.as_view(), name='progress-stream'),
 ]
 
@@ -2,28 +2,155 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.http import StreamingHttpResponse, HttpResponse
-import requests
-import yt_dlp
-import re, os, tempfile, shutil, traceback
+import os, traceback
 import subprocess
 from django.conf import settings
-from ffmpeg import input as ff_input, output as ff_output
-import pysrt
-from django.http import FileResponse
-import traceback
-import ffmpeg
+from django.urls import reverse
+from django.utils.http import urlencode
+from django.views import View
+import logging
+import time
+import uuid
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .streaming import stream_file, remove_dir, streaming_content
+from .pipelines import (fetch_media, trim_video, caption_video, combined_process, download_name,
+                        download_scratch_bytes, file_digest)
+from .audio_stream import AudioStream, plan_stream
+from .uploads import (upload_store, store_upload, get_upload, resolve_input, piped_upload, input_digest,
+                      edit_scratch_bytes, UploadNotFound)
+from .upload_handlers import scratch_dir, limit_upload, UploadTooLarge
+from .batch import expand_urls, stream_batch
+from .models import Job
+from . import jobs
+from .metadata import get_video_info, flat_playlist
+from .metrics import snapshot, render
+from .progress import ProgressReporter, Subscription, broker, request_key, sse, KEY_RE
+from .scheduler import SchedulerBusy
+from .scratch import ScratchFull, allocate, release
+from .formats import format_table, plan_download, plan_cost, AUDIO_FORMATS
+from .ffmpeg_runner import ffmpeg_version
+from .media_info import media_info, keyframes
+from .tracing import bind
+from .previews import PreviewUnavailable, thumbnail, filmstrip
+
+logger = logging.getLogger(__name__)
+
+# Shared by all bulk info requests so concurrent ones can't multiply the threads
+info_pool = ThreadPoolExecutor(max_workers=settings.INFO_WORKERS, thread_name_prefix='info')
+
+
+def is_uuid(value):
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
+
+
+def busy_response(e):
+    """503 telling the client when the encode queue or scratch space should have room again."""
+    response = Response({'error': str(e), 'retry_after': e.retry_after},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def parse_bool(value):
+    """Interpret a JSON boolean or a form field such as 'true'/'1'/'on'."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def parse_urls(data):
+    """URLs from ``urls`` (a list, or a pasted block of links) and ``url``."""
+    if hasattr(data, 'getlist'):
+        values = data.getlist('urls') + data.getlist('url')
+    else:
+        values = data.get('urls') or []
+        if isinstance(values, str):
+            values = [values]
+        if data.get('url'):
+            values = list(values) + [data['url']]
+    return [url for value in values for url in str(value).split()]
+
+
+def parse_audio_format(data):
+    """The ``audio_format`` of an audio-only download (None for the default)."""
+    audio_format = data.get('audio_format') or None
+    if audio_format is not None and audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Audio format must be one of: {', '.join(AUDIO_FORMATS)}")
+    return audio_format
+
+
+def parse_size(data, key, default, maximum):
+    """``data[key]`` as a whole number from 1 to ``maximum``; raises ValueError."""
+    value = data.get(key)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{key} must be a whole number')
+    if not 1 <= value <= maximum:
+        raise ValueError(f'{key} must be between 1 and {maximum}')
+    return value
+
+
+def parse_section(data, force_accurate=False):
+    """Read the optional ``start``/``end`` download window (in seconds).
+
+    Returns None for a full download, otherwise ``(start, end, frame_accurate)``
+    with ``end`` infinite when only ``start`` is given.
+    """
+    start, end = data.get('start'), data.get('end')
+    if start in (None, '') and end in (None, ''):
+        return None
+    try:
+        start = float(start or 0)
+        end = float(end) if end not in (None, '') else float('inf')
+    except (TypeError, ValueError):
+        raise ValueError('Start and end must be numbers')
+    if start < 0 or start >= end:
+        raise ValueError('End time must be after start time')
+    return start, end, force_accurate or parse_bool(data.get('frame_accurate'))
+
+
+def download_params(data):
+    """Validated parameters of a download request; raises ValueError."""
+    url = data.get('url')
+    if not url:
+        raise ValueError('URL is required')
+    params = {
+        'url': url,
+        'format_id': data.get('format_id'),
+        'audio_only': parse_bool(data.get('audio_only', False)),
+        'captions': data.get('captions', ''),
+    }
+    if params['captions'] and params['audio_only']:
+        raise ValueError('Captions can only be burned into video')
+    params['section'] = parse_section(data, force_accurate=bool(params['captions']))
+    params['audio_format'] = parse_audio_format(data)
+    return params
+
+
+def wants_audio_stream(data, params):
+    """Whether an audio download should be converted on the fly (``stream=true``)."""
+    return params['audio_only'] and params['section'] is None and parse_bool(data.get('stream', False))
+
 
 class TrimVideoView(APIView):
     def post(self, request):
-        temp_dir = tempfile.mkdtemp()
         try:
-            input_path = os.path.join(temp_dir, 'input.mp4')
-            output_path = os.path.join(temp_dir, 'output.mp4')
-            
-            # Save uploaded video
-            with open(input_path, 'wb') as f:
-                for chunk in request.FILES['video'].chunks():
-                    f.write(chunk)
+            temp_dir = scratch_dir(request, edit_scratch_bytes(request))
+        except ScratchFull as e:
+            return busy_response(e)
+        handed_off = False
+        progress = ProgressReporter(request_key(request))
+        try:
+            # Use the stored upload or save the uploaded video
+            input_path, name = resolve_input(request, temp_dir)
             
             # Get trim parameters
             start = float(request.data.get('start', 0))
@@ -33,93 +160,106 @@ class TrimVideoView(APIView):
             if start >= end:
                 return Response({'error': 'End time must be after start time'}, status=400)
             
-            # Get video duration for validation
-            probe = ffmpeg.probe(input_path)
-            video_duration = float(probe['format']['duration'])
-            
-            if end > video_duration:
-                end = video_duration
+            output_path = trim_video(input_path, start, end, temp_dir, progress,
+                                     digest=input_digest(request, input_path))
 
-                # Calculate duration of the clip
-            clip_duration = end - start
-            
-            # Trim using both start and end positions
-            (
-                ffmpeg
-                .input(input_path, ss=start)
-                .output(output_path, t=clip_duration, c='copy')
-                .run(overwrite_output=True, quiet=False)
-            )
-            # Return file response
-            with open(output_path, 'rb') as f:
-                content = f.read()
-            
-            response = HttpResponse(content, content_type='video/mp4')
-            response['Content-Disposition'] = f'attachment; filename="trimmed_{request.FILES["video"].name}"'
+            # Stream the file back, the temp dir goes once the last byte is sent
+            response = stream_file(
+                request, output_path, f'trimmed_{name}',
+                'video/mp4', cleanup=remove_dir(temp_dir))
+            handed_off = True
             return response
             
+        except UploadNotFound as e:
+            return Response({'error': str(e)}, status=404)
+        except SchedulerBusy as e:
+            return busy_response(e)
         except Exception as e:
             return Response({'error': str(e)}, status=500)
         finally:
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            progress.finish('done' if handed_off else 'failed')
+            if not handed_off:
+                release(temp_dir)
 
 class CaptionVideoView(APIView):
     def post(self, request):
+        import ffmpeg
         try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Save uploaded video
-                input_path = os.path.join(temp_dir, 'input.mp4')
-                with open(input_path, 'wb') as f:
-                    for chunk in request.FILES['video'].chunks():
-                        f.write(chunk)
-
-                # Write SRT file
-                srt_path = os.path.join(temp_dir, 'captions.srt')
-                captions = request.data.get('captions', '')
-                with open(srt_path, 'w', encoding='utf-8') as f:
-                    f.write(captions)
-
-                # Convert path for FFmpeg compatibility
-                srt_escaped = srt_path.replace('\\', '/')
-
-                # Updated FFmpeg command to ensure audio is included
-                try:
-                    stream = ffmpeg.input(input_path)
-                    video = stream.video.filter('subtitles', filename=srt_escaped)
-                    audio = stream.audio
-                    (
-                        ffmpeg
-                        .output(video, audio, os.path.join(temp_dir, 'output.mp4'),
-                                **{'c:v': 'libx264', 'preset': 'fast', 'crf': '23', 'c:a': 'copy'})
-                        .global_args('-y')
-                        .run(capture_stdout=True, capture_stderr=True)
-                    )
-                except ffmpeg.Error as e:
-                    err = e.stderr.decode('utf-8', errors='ignore')
-                    print("FFmpeg Error:\n", err)
-                    return Response({
-                        'error': 'Failed to burn in captions',
-                        'details': err[:1000]
-                    }, status=500)
-
-                # Send back the captioned video
-                with open(os.path.join(temp_dir, 'output.mp4'), 'rb') as f:
-                    data = f.read()
-                resp = HttpResponse(data, content_type='video/mp4')
-                resp['Content-Disposition'] = (
-                    f'attachment; filename="captioned_{request.FILES["video"].name}"'
-                )
-                return resp
+            temp_dir = scratch_dir(request, edit_scratch_bytes(request))
+        except ScratchFull as e:
+            return busy_response(e)
+        handed_off = False
+        progress = ProgressReporter(request_key(request))
+        try:
+            # Small uploads go to ffmpeg on stdin, otherwise use the stored
+            # upload or save the uploaded video
+            input_data = piped_upload(request)
+            if input_data is not None:
+                input_path, name = None, request.FILES['video'].name
+            else:
+                input_path, name = resolve_input(request, temp_dir)
+            captions = request.data.get('captions', '')
+
+            try:
+                output_path = caption_video(input_path, captions, temp_dir, progress,
+                                            input_data=input_data,
+                                            digest=input_digest(request, input_path, input_data))
+            except ffmpeg.Error as e:
+                err = e.stderr.decode('utf-8', errors='ignore')
+                logger.error('FFmpeg error while captioning:\n%s', err)
+                return Response({
+                    'error': 'Failed to burn in captions',
+                    'details': err[:1000]
+                }, status=500)
 
+            # Stream back the captioned video
+            resp = stream_file(
+                request, output_path, f'captioned_{name}',
+                'video/mp4', cleanup=remove_dir(temp_dir))
+            handed_off = True
+            return resp
+
+        except UploadNotFound as e:
+            return Response({'error': str(e)}, status=404)
+        except SchedulerBusy as e:
+            return busy_response(e)
         except Exception:
             tb = traceback.format_exc()
-            print(tb)
+            logger.error('Captioning failed:\n%s', tb)
             return Response({
                 'error': 'Internal server error',
                 'details': tb.splitlines()[-1]
             }, status=500)
+        finally:
+            progress.finish('done' if handed_off else 'failed')
+            if not handed_off:
+                release(temp_dir)
 
             
+def video_summary(info):
+    """Title, thumbnail, duration and downloadable formats of an extracted video,
+    each with the plan (and its estimated cost) a download of it would follow."""
+    table = format_table(info)
+    # Only list formats that have video and audio, or all of them if there are none
+    formats = [f for f in table if f['has_video'] and f['has_audio']] or table
+    formats = [dict(f, plan=plan_cost(plan_download(info, f['format_id'], False))) for f in formats]
+    audio_plans = {name: plan_cost(plan_download(info, None, True, name)) for name in AUDIO_FORMATS}
+
+    # Browsers load the thumbnail through the preview cache, not from the video host
+    url = info.get('webpage_url') or info.get('original_url')
+    thumbnail_url = ''
+    if url and (info.get('thumbnails') or info.get('thumbnail')):
+        thumbnail_url = f"{reverse('thumbnail')}?{urlencode({'url': url})}"
+
+    return {
+        'title': info.get('title', 'Untitled'),
+        'thumbnail': thumbnail_url,
+        'duration': info.get('duration', 0),
+        'formats': formats,
+        'audio_plans': audio_plans,
+    }
+
+
 class VideoInfoView(APIView):
     """Endpoint to get video metadata and available formats"""
     def post(self, request):
@@ -127,130 +267,123 @@ class VideoInfoView(APIView):
         if not url:
             return Response({'error': 'URL is required'}, status=status.HTTP_400_BAD_REQUEST)
         
-        ydl_opts = {
-            'noplaylist': True,
-            'skip_download': True,
-            'quiet': True,
-        }
-
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                # Extract available formats
-                formats = []
-                for f in info.get('formats', []):
-                    if not f.get('url'):
-                        continue
-                    
-                    # Only include formats that have video and audio, or audio-only for audio formats
-                    if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                        formats.append({
-                            'format_id': f['format_id'],
-                            'ext': f.get('ext', 'mp4'),
-                            'resolution': f.get('resolution', 'unknown'),
-                            'filesize': f.get('filesize'),
-                            'note': f.get('format_note', ''),
-                            'vcodec': f.get('vcodec'),
-                            'acodec': f.get('acodec'),
-                            'has_audio': f.get('acodec') != 'none',
-                        })
-                
-                # If no combined formats found, include all formats
-                if not formats:
-                    for f in info.get('formats', []):
-                        if f.get('url'):
-                            formats.append({
-                                'format_id': f['format_id'],
-                                'ext': f.get('ext', 'mp4'),
-                                'resolution': f.get('resolution', 'unknown'),
-                                'filesize': f.get('filesize'),
-                                'note': f.get('format_note', ''),
-                                'vcodec': f.get('vcodec'),
-                                'acodec': f.get('acodec'),
-                                'has_audio': f.get('acodec') != 'none',
-                            })
-                
-                # Get best thumbnail
-                thumbnails = info.get('thumbnails', [])
-                thumbnail = max(
-                    thumbnails, 
-                    key=lambda t: t.get('width', 0) * t.get('height', 0), 
-                    default={}
-                ).get('url', '')
-                
-                return Response({
-                    'title': info.get('title', 'Untitled'),
-                    'thumbnail': thumbnail,
-                    'duration': info.get('duration', 0),
-                    'formats': formats,
-                })
-                
+            return Response(video_summary(get_video_info(url)))
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+def describe_url(url):
+    """Bulk info result for one URL: a video summary, or the flat entry list
+    of a playlist whose formats the client can look up when it needs them."""
+    try:
+        playlist = flat_playlist(url, settings.INFO_MAX_PLAYLIST_ENTRIES)
+        if playlist is None:
+            return dict(url=url, **video_summary(get_video_info(url)))
+        return {
+            'url': url,
+            'playlist': {
+                'title': playlist.get('title', 'Untitled'),
+                'entries': [{
+                    'url': entry.get('webpage_url') or entry.get('url'),
+                    'title': entry.get('title'),
+                    'duration': entry.get('duration'),
+                } for entry in playlist.get('entries') or [] if entry],
+            },
+        }
+    except Exception as e:
+        return {'url': url, 'error': str(e)}
+
+
+class BulkVideoInfoView(APIView):
+    """Look up many URLs concurrently; results come back in request order, or
+    as NDJSON lines (tagged with their index) as soon as each is ready"""
+    def post(self, request):
+        urls = parse_urls(request.data)
+        if not urls:
+            return Response({'error': 'At least one URL is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(urls) > settings.INFO_MAX_URLS:
+            return Response({'error': f'At most {settings.INFO_MAX_URLS} URLs can be looked up at once'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        futures = [info_pool.submit(bind(describe_url, url)) for url in urls]
+        if not parse_bool(request.data.get('stream', False)):
+            return Response({'results': [future.result() for future in futures]})
+
+        def lines():
+            index = {future: i for i, future in enumerate(futures)}
+            try:
+                for future in as_completed(futures):
+                    yield json.dumps(dict(index=index[future], **future.result())) + '\n'
+            finally:
+                # Lookups that haven't started are not needed by a client that left
+                for future in futures:
+                    future.cancel()
+
+        response = StreamingHttpResponse(streaming_content(request, lines()),
+                                         content_type='application/x-ndjson')
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+def stream_audio(request, url, audio_format, progress):
+    """Chunked response converting audio on the fly, or None when the source
+    can't be piped and the download has to go through a temp dir."""
+    try:
+        info = get_video_info(url)
+        planned = plan_stream(info, audio_format)
+        if planned is None:
+            return None
+        stream = AudioStream(*planned, progress=progress)
+    except SchedulerBusy:
+        raise
+    except Exception:
+        logger.warning('Could not stream audio of %s, downloading it instead', url, exc_info=True)
+        return None
+    response = StreamingHttpResponse(streaming_content(request, stream), content_type=stream.content_type)
+    response['Content-Disposition'] = f'attachment; filename="{download_name(info, stream.ext)}"'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 class DownloadVideoView(APIView):
     """Endpoint to download video in selected format"""
     def post(self, request):
-        url = request.data.get('url')
-        format_id = request.data.get('format_id')
-        audio_only = request.data.get('audio_only', False)
+        import yt_dlp
+        try:
+            params = download_params(request.data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not url:
-            return Response({'error': 'URL is required'}, status=status.HTTP_400_BAD_REQUEST)
+        progress = ProgressReporter(request_key(request))
+        if wants_audio_stream(request.data, params):
+            try:
+                response = stream_audio(request, params['url'], params['audio_format'], progress)
+            except SchedulerBusy as e:
+                progress.finish('failed')
+                return busy_response(e)
+            if response is not None:
+                return response
 
-        # Use a temporary directory for processing
-        temp_dir = tempfile.mkdtemp()
+        # Use a scratch directory for processing; cached downloads are
+        # streamed straight from the cache and leave it empty
+        temp_dir = None
+        handed_off = False
         try:
-            ydl_opts = {
-                'noplaylist': True,
-                'socket_timeout': 30,
-                'ffmpeg_location': settings.FFMPEG_PATH,
-                'outtmpl': os.path.join(temp_dir, '%(title)s.%(ext)s'),
-                'verbose': True,
-            }
-
-            if audio_only:
-                # Audio-only configuration
-                ydl_opts['format'] = 'bestaudio/best'
-                ydl_opts['postprocessors'] = [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }]
-            else:
-                # Video with audio configuration - ensure we get both streams
-                ydl_opts['format'] = f'{format_id}+bestaudio'
-                ydl_opts['merge_output_format'] = 'mp4'
+            temp_dir = allocate(download_scratch_bytes(
+                params['url'], params['format_id'], params['audio_only'], params['captions'],
+                params['audio_format']))
+            filename, safe_filename, content_type = fetch_media(
+                params['url'], params['format_id'], params['audio_only'], temp_dir, params['section'],
+                params['captions'], progress, params['audio_format'])
 
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
-                # Get the downloaded file path
-                filename = ydl.prepare_filename(info)
-                
-                # For audio-only, the extension is changed to mp3
-                if audio_only:
-                    filename = filename.replace('.webm', '.mp3').replace('.m4a', '.mp3')
-                # For video, ensure we get the merged file
-                elif not filename.endswith('.mp4'):
-                    filename = os.path.splitext(filename)[0] + '.mp4'
-                
-                # Read the file content
-                with open(filename, 'rb') as f:
-                    content = f.read()
-                
-                # Get safe filename
-                title = re.sub(r'[^\w\-_\. ]', '', info.get('title', 'video'))
-                ext = 'mp3' if audio_only else 'mp4'
-                safe_filename = f"{title[:50]}.{ext}"
-                
-                # Create response
-                content_type = 'audio/mpeg' if audio_only else 'video/mp4'
-                response = HttpResponse(content, content_type=content_type)
-                response['Content-Disposition'] = f'attachment; filename="{safe_filename}"'
-                return response
+            # Create response
+            response = stream_file(request, filename, safe_filename, content_type,
+                                   cleanup=remove_dir(temp_dir))
+            handed_off = True
+            return response
                 
+        except SchedulerBusy as e:
+            return busy_response(e)
         except yt_dlp.utils.DownloadError as e:
             if "Requested format is not available" in str(e):
                 return Response({'error': 'This format is unavailable. Try another format.'}, status=400)
@@ -258,98 +391,69 @@ class DownloadVideoView(APIView):
         except Exception as e:
             return Response({'error': f"Server error: {str(e)}"}, status=500)
         finally:
-            # Clean up temporary directory
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            progress.finish('done' if handed_off else 'failed')
+            # Clean up the scratch directory unless the response still streams from it
+            if temp_dir is not None and not handed_off:
+                release(temp_dir)
 
             # Add new view for combined operation
 class CombinedProcessView(APIView):
     def post(self, request):
         try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Save uploaded video
-                input_path = os.path.join(temp_dir, 'input.mp4')
-                with open(input_path, 'wb') as f:
-                    for chunk in request.FILES['video'].chunks():
-                        f.write(chunk)
-                
-                # Get parameters
-                start = float(request.data.get('start', 0))
-                end = float(request.data.get('end', 10))
-                captions = request.data.get('captions', '')
-                
-                # Step 1: Trim video
-                trimmed_path = os.path.join(temp_dir, 'trimmed.mp4')
-                probe = ffmpeg.probe(input_path)
-                video_duration = float(probe['format']['duration'])
-                end = min(end, video_duration)
-                clip_duration = end - start
-                
-                (
-                    ffmpeg
-                    .input(input_path, ss=start)
-                    .output(trimmed_path, t=clip_duration, c='copy')
-                    .run(overwrite_output=True, quiet=True)
-                )
-                
-                # Step 2: Add captions
-                srt_path = os.path.join(temp_dir, 'captions.srt')
-                with open(srt_path, 'w', encoding='utf-8') as f:
-                    f.write(captions)
-                
-                output_path = os.path.join(temp_dir, 'final.mp4')
-                srt_escaped = srt_path.replace('\\', '/')
-                
-                stream = ffmpeg.input(trimmed_path)
-                video = stream.video.filter('subtitles', filename=srt_escaped)
-                audio = stream.audio
-                (
-                    ffmpeg
-                    .output(video, audio, output_path,
-                            **{'c:v': 'libx264', 'preset': 'fast', 'crf': '23', 'c:a': 'copy'})
-                    .global_args('-y')
-                    .run(quiet=True)
-                )
-                
-                # Return processed video
-                with open(output_path, 'rb') as f:
-                    data = f.read()
-                resp = HttpResponse(data, content_type='video/mp4')
-                resp['Content-Disposition'] = (
-                    f'attachment; filename="edited_{request.FILES["video"].name}"'
-                )
-                return resp
-                
+            temp_dir = scratch_dir(request, edit_scratch_bytes(request))
+        except ScratchFull as e:
+            return busy_response(e)
+        handed_off = False
+        progress = ProgressReporter(request_key(request))
+        try:
+            # Use the stored upload or save the uploaded video
+            input_path, name = resolve_input(request, temp_dir)
+            
+            # Get parameters
+            start = float(request.data.get('start', 0))
+            end = float(request.data.get('end', 10))
+            captions = request.data.get('captions', '')
+            frame_accurate = parse_bool(request.data.get('frame_accurate'))
+            
+            output_path = combined_process(input_path, start, end, captions, temp_dir,
+                                           frame_accurate=frame_accurate, progress=progress,
+                                           digest=input_digest(request, input_path))
+            
+            # Stream processed video
+            resp = stream_file(
+                request, output_path, f'edited_{name}',
+                'video/mp4', cleanup=remove_dir(temp_dir))
+            handed_off = True
+            return resp
+            
+        except UploadNotFound as e:
+            return Response({'error': str(e)}, status=404)
+        except SchedulerBusy as e:
+            return busy_response(e)
         except Exception:
             tb = traceback.format_exc()
             return Response({
                 'error': 'Combined processing failed',
                 'details': tb.splitlines()[-1]
             }, status=500)
+        finally:
+            progress.finish('done' if handed_off else 'failed')
+            if not handed_off:
+                release(temp_dir)
 
 class TestFFmpegView(APIView):
     def get(self, request):
         try:
-            # Try using the configured binary
-            ffmpeg_binary = settings.FFMPEG_PATH if hasattr(settings, 'FFMPEG_PATH') else 'ffmpeg'
-            
-            result = subprocess.run(
-                [ffmpeg_binary, '-version'],
-                capture_output=True,
-                text=True,
-                timeout=5
-            )
-            
-            if result.returncode == 0:
-                return Response({
-                    'status': 'success',
-                    'version': result.stdout.split('\n')[0]
-                })
-            else:
-                return Response({
-                    'error': f"FFmpeg exited with code {result.returncode}",
-                    'stderr': result.stderr
-                }, status=500)
-                
+            # Found and run once per process; later checks are answered from memory
+            return Response({
+                'status': 'success',
+                'version': ffmpeg_version()
+            })
+        except subprocess.CalledProcessError as e:
+            return Response({
+                'error': f"FFmpeg exited with code {e.returncode}",
+                'stderr': e.stderr
+            }, status=500)
         except FileNotFoundError:
             return Response({
                 'error': "FFmpeg not found in PATH",
@@ -359,4 +463,343 @@ class TestFFmpegView(APIView):
             return Response({
                 'error': f"FFmpeg test failed: {str(e)}",
                 'type': type(e).__name__
-            }, status=500)
\ No newline at end of file
+            }, status=500)
+
+
+class BatchDownloadView(APIView):
+    """Download several URLs or a playlist at once and stream them back as a ZIP"""
+    def post(self, request):
+        urls = parse_urls(request.data)
+        if not urls:
+            return Response({'error': 'At least one URL is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            audio_format = parse_audio_format(request.data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        urls = expand_urls(urls, settings.BATCH_MAX_ITEMS)
+        if len(urls) > settings.BATCH_MAX_ITEMS:
+            return Response({'error': f'A batch can hold at most {settings.BATCH_MAX_ITEMS} videos'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            work_dir = allocate()
+        except ScratchFull as e:
+            return busy_response(e)
+        response = StreamingHttpResponse(
+            streaming_content(request, stream_batch(
+                urls, request.data.get('format_id'), parse_bool(request.data.get('audio_only', False)),
+                work_dir, ProgressReporter(request_key(request)), audio_format)),
+            content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="download.zip"'
+        return response
+
+
+class UploadView(APIView):
+    """Store a video once and return a handle the edit endpoints accept instead of a file"""
+    def post(self, request):
+        try:
+            if int(request.META.get('CONTENT_LENGTH') or 0) > upload_store.max_bytes:
+                # Refused before any of the body is spooled
+                raise UploadTooLarge(upload_store.max_bytes)
+            # Bodies without a length are cut off once the file outgrows the quota
+            limit_upload(request, upload_store.max_bytes)
+            upload = request.FILES.get('video')
+        except ScratchFull as e:
+            return busy_response(e)
+        except UploadTooLarge as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if upload is None:
+            return Response({'error': 'Video file is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if upload.size > upload_store.max_bytes:
+            # Small uploads are kept in memory, past the handler's check
+            return Response({'error': 'Upload exceeds the storage quota'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        entry, duplicate = store_upload(upload)
+        return Response({
+            'handle': os.path.basename(entry.directory),
+            'name': entry.meta['name'],
+            'size': entry.size,
+            'duplicate': duplicate,
+            'expires_in': settings.UPLOAD_TTL,
+        }, status=status.HTTP_200_OK if duplicate else status.HTTP_201_CREATED)
+
+
+# Stream fields worth showing to clients; ffprobe reports many more
+STREAM_FIELDS = ('index', 'codec_type', 'codec_name', 'profile', 'width', 'height', 'pix_fmt',
+                 'avg_frame_rate', 'sample_rate', 'channels', 'bit_rate')
+
+
+class UploadInfoView(APIView):
+    """Duration, streams and keyframe timestamps of a stored upload, so clients
+    can snap trim points to where a stream copy will actually cut"""
+    def get(self, request, handle):
+        try:
+            entry = get_upload(handle)
+        except UploadNotFound as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            info = media_info(entry.path, handle)
+            index = keyframes(entry.path, handle)
+        except Exception as e:
+            return Response({'error': f'Could not read the video: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'handle': handle,
+            'name': entry.meta['name'],
+            'size': entry.size,
+            'duration': info.duration,
+            'format': info.format.get('format_name'),
+            'streams': [{key: stream[key] for key in STREAM_FIELDS if key in stream} for stream in info.streams],
+            'keyframes': index,
+        })
+
+
+def image_response(image, **headers):
+    """JPEG response browsers may keep; previews are keyed by content."""
+    response = HttpResponse(image, content_type='image/jpeg')
+    response['Cache-Control'] = f'public, max-age={settings.PREVIEW_MAX_AGE}'
+    for name, value in headers.items():
+        response[name] = value
+    return response
+
+
+class ThumbnailView(APIView):
+    """A video's thumbnail, fetched and scaled once and then served from the preview cache"""
+    def get(self, request):
+        url = request.query_params.get('url')
+        if not url:
+            return Response({'error': 'URL is required'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            width = parse_size(request.query_params, 'width', settings.THUMBNAIL_WIDTH,
+                               settings.THUMBNAIL_MAX_WIDTH)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            return image_response(thumbnail(url, width))
+        except SchedulerBusy as e:
+            return busy_response(e)
+        except PreviewUnavailable as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def filmstrip_params(data):
+    """Validated ``(frames, width, columns)`` of a filmstrip request; raises ValueError."""
+    frames = parse_size(data, 'frames', 10, settings.FILMSTRIP_MAX_FRAMES)
+    width = parse_size(data, 'width', 160, settings.FILMSTRIP_MAX_WIDTH)
+    return frames, width, parse_size(data, 'columns', frames, frames)
+
+
+def filmstrip_response(input_path, digest, params):
+    """The sprite sheet, with the tile size, grid and tile timestamps in headers."""
+    try:
+        image, layout = filmstrip(input_path, digest, *params)
+    except (SchedulerBusy, PreviewUnavailable):
+        raise
+    except Exception as e:
+        raise PreviewUnavailable(f'Could not read the video: {e}')
+    return image_response(image, **{
+        'X-Filmstrip-Tile': '{}x{}'.format(*layout['tile']),
+        'X-Filmstrip-Grid': '{}x{}'.format(*layout['grid']),
+        'X-Filmstrip-Times': ','.join(f'{t:.3f}' for t in layout['times']),
+    })
+
+
+class FilmstripView(APIView):
+    """Sprite sheet of evenly spaced frames of an uploaded or stored video, for scrubbing
+    in the trim UI; ``frames`` tiles ``width`` pixels wide, ``columns`` to a row"""
+    def post(self, request):
+        try:
+            temp_dir = scratch_dir(request)
+        except ScratchFull as e:
+            return busy_response(e)
+        try:
+            params = filmstrip_params(request.data)
+            input_path, _ = resolve_input(request, temp_dir)
+            # Stored uploads are keyed by their hash already
+            digest = request.data.get('handle') or file_digest(input_path)
+            return filmstrip_response(input_path, digest, params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except UploadNotFound as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except PreviewUnavailable as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except SchedulerBusy as e:
+            return busy_response(e)
+        except KeyError:
+            return Response({'error': 'Video file or upload handle is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            release(temp_dir)
+
+
+class UploadFilmstripView(APIView):
+    """``FilmstripView`` of a stored upload as a GET, so browsers can cache it"""
+    def get(self, request, handle):
+        try:
+            entry = get_upload(handle)
+            return filmstrip_response(entry.path, handle, filmstrip_params(request.query_params))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except UploadNotFound as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except PreviewUnavailable as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except SchedulerBusy as e:
+            return busy_response(e)
+
+
+class JobSubmitView(APIView):
+    """Queue a download or edit and return its job ID right away"""
+    def post(self, request, kind):
+        params = {}
+        upload = None
+        # Parsing the form spools uploaded files into scratch space
+        try:
+            request.data
+        except ScratchFull as e:
+            return busy_response(e)
+        if kind == Job.KIND_DOWNLOAD:
+            try:
+                params = download_params(request.data)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            if params['section'] and params['section'][1] == float('inf'):
+                # JSON has no infinity; an open end is stored as null
+                start, _, frame_accurate = params['section']
+                params['section'] = (start, None, frame_accurate)
+        else:
+            handle = request.data.get('handle')
+            if handle:
+                try:
+                    upload = get_upload(handle)
+                except UploadNotFound as e:
+                    return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+                params['name'] = upload.meta['name']
+                params['digest'] = handle
+            else:
+                upload = request.FILES.get('video')
+                if upload is None:
+                    return Response({'error': 'Video file or upload handle is required'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                params['name'] = upload.name
+            try:
+                if kind in (Job.KIND_TRIM, Job.KIND_COMBINED):
+                    params['start'] = float(request.data.get('start', 0))
+                    params['end'] = float(request.data.get('end', 10))
+            except (TypeError, ValueError):
+                return Response({'error': 'Start and end must be numbers'}, status=400)
+            if kind in (Job.KIND_TRIM, Job.KIND_COMBINED) and params['start'] >= params['end']:
+                return Response({'error': 'End time must be after start time'}, status=400)
+            if kind in (Job.KIND_CAPTION, Job.KIND_COMBINED):
+                params['captions'] = request.data.get('captions', '')
+            if kind == Job.KIND_COMBINED:
+                params['frame_accurate'] = parse_bool(request.data.get('frame_accurate'))
+
+        job = jobs.submit(kind, params, upload)
+        return Response(job_status(request, job), status=status.HTTP_202_ACCEPTED)
+
+
+def job_status(request, job):
+    data = {
+        'id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+        'progress': job.progress,
+        'progress_url': request.build_absolute_uri(
+            reverse('progress-stream', kwargs={'key': str(job.id)})),
+    }
+    if job.status == Job.STATUS_FAILED:
+        data['error'] = job.error
+    if job.status == Job.STATUS_DONE:
+        data['result_url'] = request.build_absolute_uri(
+            reverse('job-result', kwargs={'job_id': job.id}))
+    return data
+
+
+class JobStatusView(APIView):
+    """Poll the state of a queued job"""
+    def get(self, request, job_id):
+        jobs.recover()
+        job = Job.objects.filter(pk=job_id).first()
+        if job is None:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job_status(request, job))
+
+
+class JobResultView(APIView):
+    """Fetch the output file of a finished job"""
+    def get(self, request, job_id):
+        job = Job.objects.filter(pk=job_id).first()
+        if job is None:
+            return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+        if job.status != Job.STATUS_DONE:
+            return Response({'error': f'Job is {job.status}'}, status=status.HTTP_409_CONFLICT)
+        if not os.path.exists(job.result_path):
+            return Response({'error': 'Job result has expired'}, status=status.HTTP_410_GONE)
+        return stream_file(request, job.result_path, job.result_name, job.content_type)
+
+
+class StatsView(APIView):
+    """Cache hit/miss counters and other process-wide stats"""
+    def get(self, request):
+        return Response(snapshot())
+
+
+class MetricsView(APIView):
+    """The same metrics in the Prometheus text format, for scraping"""
+    def get(self, request):
+        return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def stream_poll(job):
+    """How long a progress stream waits on its channel before looking again.
+
+    A job may be running in another process, whose progress only reaches us
+    through the database.
+    """
+    return settings.PROGRESS_FLUSH_INTERVAL if job is not None else settings.PROGRESS_KEEPALIVE
+
+
+def job_event(job):
+    """``(event, done)`` from a job's stored progress."""
+    done = job.status in (Job.STATUS_DONE, Job.STATUS_FAILED)
+    return (dict(job.progress, status=job.status) if done else job.progress), done
+
+
+class ProgressStreamView(View):
+    """Server-Sent Events stream of download/encode progress for a job ID or progress_id"""
+    def get(self, request, key):
+        if not KEY_RE.match(key):
+            return HttpResponse(status=404)
+        response = StreamingHttpResponse(streaming_content(request, self.events(key)),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def events(self, key):
+        channel = broker.channel(key)
+        job = Job.objects.filter(pk=key).first() if is_uuid(key) else None
+        subscription = Subscription(stream_poll(job))
+        yield 'retry: 2000\n\n'
+        while not subscription.expired:
+            event, seq, done = channel.wait(subscription.seq, subscription.poll)
+            if seq == subscription.seq and job is not None:
+                job.refresh_from_db(fields=['status', 'progress'])
+                event, done = job_event(job)
+            text = subscription.update(event, seq, done)
+            if text:
+                yield text
+            if done:
+                return
+            # Coalesce bursts of updates into a few events per second
+            time.sleep(settings.PROGRESS_MIN_INTERVAL)
+        yield sse('timeout', {})
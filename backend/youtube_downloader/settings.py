@@ -1,62 +1,16 @@
 from pathlib import Path
 from dotenv import load_dotenv
 import os
-import sys
 
 load_dotenv()  # Load environment variables from .env file
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-# Determine FFmpeg path
-FFMPEG_PATH = None
-
-if os.name == 'nt':  # Windows
-    # Check common locations
-    possible_paths = [
-        BASE_DIR / 'ffmpeg' / 'bin' / 'ffmpeg.exe',
-        Path('C:\\ffmpeg\\bin\\ffmpeg.exe'),
-        Path('C:\\Program Files\\ffmpeg\\bin\\ffmpeg.exe'),
-        Path('C:\\Program Files (x86)\\ffmpeg\\bin\\ffmpeg.exe')
-    ]
-    
-    for path in possible_paths:
-        if path.exists():
-            FFMPEG_PATH = str(path)
-            break
-    
-    if not FFMPEG_PATH:
-        FFMPEG_PATH = 'ffmpeg.exe'
-        print("WARNING: Using ffmpeg.exe from system PATH", file=sys.stderr)
-else:  # Linux/Mac
-    # Standard Linux/Mac paths
-    possible_paths = [
-        '/usr/bin/ffmpeg',
-        '/usr/local/bin/ffmpeg',
-        '/opt/homebrew/bin/ffmpeg',
-        BASE_DIR / 'ffmpeg' / 'ffmpeg'
-    ]
-    
-    for path in possible_paths:
-        if os.path.exists(path):
-            FFMPEG_PATH = path
-            break
-    
-    if not FFMPEG_PATH:
-        FFMPEG_PATH = 'ffmpeg'
-        print("WARNING: Using ffmpeg from system PATH", file=sys.stderr)
+# FFmpeg binary; when unset, api/ffmpeg_runner.py looks in the usual install
+# locations and then on PATH, once, on first use
+FFMPEG_PATH = os.getenv('FFMPEG_PATH') or None
 
-# Set environment variables
-os.environ['FFMPEG_BINARY'] = FFMPEG_PATH
-# Add to system PATH
-os.environ['PATH'] = os.pathsep.join([
-    os.environ['PATH'],
-    os.path.dirname(FFMPEG_PATH)
-])
-
-print(f"Using FFmpeg at: {FFMPEG_PATH}")
-
-    
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
 
@@ -83,6 +37,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.tracing.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Add for static file serving
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -170,6 +125,170 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Media streaming
+# Files are sent to clients in chunks of this many bytes instead of being read into memory
+
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 1024 * 1024))
+# Streamed audio (stream=true) is converted on the fly from a source fetched in ranges of this size
+AUDIO_STREAM_RANGE_SIZE = int(os.getenv('AUDIO_STREAM_RANGE_SIZE', 10 * 1024 * 1024))
+AUDIO_STREAM_BITRATE = os.getenv('AUDIO_STREAM_BITRATE', '192k')
+# Streams at once, apart from ENCODE_SLOTS as clients set their pace, and seconds to queue before 503
+AUDIO_STREAM_SLOTS = int(os.getenv('AUDIO_STREAM_SLOTS', 16))
+AUDIO_STREAM_MAX_WAIT = float(os.getenv('AUDIO_STREAM_MAX_WAIT', 10))
+
+# ASGI
+# asgi.py turns on the native async views for info, download, trim and progress. Under ASGI,
+# yt-dlp runs on YTDL_WORKERS threads and sync iterators of the remaining views are streamed
+# from ASGI_STREAM_THREADS threads
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+YTDL_WORKERS = int(os.getenv('YTDL_WORKERS', 16))
+ASGI_STREAM_THREADS = int(os.getenv('ASGI_STREAM_THREADS', 64))
+
+# Background jobs
+# Downloads are network-bound and encodes are CPU-bound, so they get separate pools
+
+JOB_ROOT = os.getenv('JOB_ROOT', str(BASE_DIR / 'jobs'))
+JOB_DOWNLOAD_WORKERS = int(os.getenv('JOB_DOWNLOAD_WORKERS', 4))
+JOB_ENCODE_WORKERS = int(os.getenv('JOB_ENCODE_WORKERS', 1))
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', 60 * 60))  # seconds
+
+# Batch downloads
+# Items of a batch or playlist download in parallel and stream back as one ZIP
+
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 4))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 100))
+
+# Video metadata cache
+# Entries never outlive the signed format URLs inside them (minus the margin)
+
+VIDEO_INFO_CACHE_SIZE = int(os.getenv('VIDEO_INFO_CACHE_SIZE', 512))
+VIDEO_INFO_CACHE_TTL = int(os.getenv('VIDEO_INFO_CACHE_TTL', 30 * 60))  # seconds
+VIDEO_INFO_EXPIRY_MARGIN = int(os.getenv('VIDEO_INFO_EXPIRY_MARGIN', 10 * 60))  # seconds
+INFO_WORKERS = int(os.getenv('INFO_WORKERS', 8))  # concurrent extractions for bulk lookups
+INFO_MAX_URLS = int(os.getenv('INFO_MAX_URLS', 100))
+INFO_MAX_PLAYLIST_ENTRIES = int(os.getenv('INFO_MAX_PLAYLIST_ENTRIES', 500))
+
+# yt-dlp instances
+# Metadata lookups reuse up to YTDL_POOL_SIZE idle YoutubeDL instances. With WARM_UP, wsgi.py
+# and asgi.py load yt-dlp, build YTDL_WARM_INSTANCES of them and compile the extractor URL
+# patterns when a worker starts instead of on its first request
+YTDL_POOL_SIZE = int(os.getenv('YTDL_POOL_SIZE', 16))
+YTDL_WARM_INSTANCES = int(os.getenv('YTDL_WARM_INSTANCES', 2))
+WARM_UP = os.getenv('WARM_UP', 'True') == 'True'
+
+# Downloads
+# yt-dlp fetches up to YTDL_CONCURRENT_FRAGMENTS fragments of a DASH/HLS format at once and plain
+# HTTP formats in YTDL_HTTP_CHUNK_SIZE ranges (0: one request), retrying failed requests and
+# fragments YTDL_RETRIES times with exponential backoff. With YTDL_PARALLEL_STREAMS the video and
+# audio of a merged format download side by side. Downloads of one process hold at most
+# DOWNLOAD_HOST_CONNECTIONS connections to a host (0: no limit)
+YTDL_CONCURRENT_FRAGMENTS = int(os.getenv('YTDL_CONCURRENT_FRAGMENTS', 4))
+YTDL_HTTP_CHUNK_SIZE = int(os.getenv('YTDL_HTTP_CHUNK_SIZE', 10 * 1024 ** 2))
+YTDL_RETRIES = int(os.getenv('YTDL_RETRIES', 5))
+YTDL_RETRY_BACKOFF = float(os.getenv('YTDL_RETRY_BACKOFF', 1))  # seconds before the first retry, doubling
+YTDL_RETRY_MAX_SLEEP = float(os.getenv('YTDL_RETRY_MAX_SLEEP', 30))  # seconds
+YTDL_PARALLEL_STREAMS = os.getenv('YTDL_PARALLEL_STREAMS', 'True') == 'True'
+DOWNLOAD_HOST_CONNECTIONS = int(os.getenv('DOWNLOAD_HOST_CONNECTIONS', 8))
+
+# Downloaded media cache
+# Finished downloads are kept on disk, least recently used first out; 0 disables it
+
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', str(BASE_DIR / 'cache' / 'media'))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+
+# Edit result cache
+# Trim, caption and combined outputs are kept on disk keyed by the input's content hash and
+# the edit, least recently used first out, so repeated exports skip ffmpeg; 0 disables it
+DERIVED_CACHE_DIR = os.getenv('DERIVED_CACHE_DIR', str(BASE_DIR / 'cache' / 'derived'))
+DERIVED_CACHE_MAX_BYTES = int(os.getenv('DERIVED_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# Previews
+# Proxied video thumbnails and trim-preview filmstrips are kept on disk by content and size,
+# least recently used first out; 0 disables it. Browsers may reuse them for PREVIEW_MAX_AGE
+PREVIEW_CACHE_DIR = os.getenv('PREVIEW_CACHE_DIR', str(BASE_DIR / 'cache' / 'previews'))
+PREVIEW_CACHE_MAX_BYTES = int(os.getenv('PREVIEW_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+PREVIEW_MAX_AGE = int(os.getenv('PREVIEW_MAX_AGE', 24 * 60 * 60))  # seconds
+THUMBNAIL_WIDTH = int(os.getenv('THUMBNAIL_WIDTH', 480))  # of the thumbnail /api/info/ links to
+THUMBNAIL_MAX_WIDTH = int(os.getenv('THUMBNAIL_MAX_WIDTH', 1280))
+THUMBNAIL_MAX_BYTES = int(os.getenv('THUMBNAIL_MAX_BYTES', 5 * 1024 ** 2))  # fetched from upstream
+THUMBNAIL_TIMEOUT = float(os.getenv('THUMBNAIL_TIMEOUT', 10))  # seconds
+FILMSTRIP_MAX_FRAMES = int(os.getenv('FILMSTRIP_MAX_FRAMES', 100))
+FILMSTRIP_MAX_WIDTH = int(os.getenv('FILMSTRIP_MAX_WIDTH', 480))  # of one tile
+
+# Media info
+# ffprobe results (duration, streams, keyframe index) are kept per file content in memory and,
+# for hashed inputs, in the database; rows are dropped MEDIA_INFO_TTL after they were last loaded
+MEDIA_INFO_CACHE_SIZE = int(os.getenv('MEDIA_INFO_CACHE_SIZE', 256))
+MEDIA_INFO_TTL = int(os.getenv('MEDIA_INFO_TTL', 7 * 24 * 60 * 60))  # seconds
+
+# Stored uploads
+# Edit requests can reference a stored upload by handle instead of re-sending the file
+
+UPLOAD_STORE_DIR = os.getenv('UPLOAD_STORE_DIR', str(BASE_DIR / 'cache' / 'uploads'))
+UPLOAD_STORE_MAX_BYTES = int(os.getenv('UPLOAD_STORE_MAX_BYTES', 5 * 1024 ** 3))
+UPLOAD_TTL = int(os.getenv('UPLOAD_TTL', 2 * 60 * 60))  # seconds since last use
+
+# Request scratch space
+# Large uploads are spooled straight into the request's scratch directory, which should
+# be on the same filesystem as JOB_ROOT and UPLOAD_STORE_DIR so they can be hard-linked.
+# Each directory reserves the space its work is expected to need; requests that don't fit
+# wait up to SCRATCH_MAX_WAIT seconds, then get a 503. Small work can go to a faster
+# SCRATCH_FAST_ROOT (e.g. a tmpfs). Directories of dead workers are swept at startup.
+
+SCRATCH_ROOT = os.getenv('SCRATCH_ROOT', str(BASE_DIR / 'scratch'))
+SCRATCH_QUOTA_BYTES = int(os.getenv('SCRATCH_QUOTA_BYTES', 10 * 1024 ** 3))  # per process, 0 for none
+SCRATCH_MIN_FREE_BYTES = int(os.getenv('SCRATCH_MIN_FREE_BYTES', 1024 ** 3))  # left free on the filesystem
+SCRATCH_DEFAULT_RESERVE = int(os.getenv('SCRATCH_DEFAULT_RESERVE', 1024 ** 3))  # when the size is unknown
+SCRATCH_FAST_ROOT = os.getenv('SCRATCH_FAST_ROOT') or None
+SCRATCH_FAST_MAX_BYTES = int(os.getenv('SCRATCH_FAST_MAX_BYTES', 256 * 1024 ** 2))
+SCRATCH_FAST_QUOTA_BYTES = int(os.getenv('SCRATCH_FAST_QUOTA_BYTES', 1024 ** 3))
+SCRATCH_MAX_WAIT = float(os.getenv('SCRATCH_MAX_WAIT', 30))  # seconds
+FILE_UPLOAD_HANDLERS = [
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'api.upload_handlers.ScratchUploadHandler',
+]
+
+# Live progress
+# Clients follow /api/progress/<key>/ (a job ID or their own progress_id) as Server-Sent Events
+
+PROGRESS_MIN_INTERVAL = float(os.getenv('PROGRESS_MIN_INTERVAL', 0.25))  # seconds between events
+PROGRESS_KEEPALIVE = float(os.getenv('PROGRESS_KEEPALIVE', 15))  # seconds
+PROGRESS_STREAM_TIMEOUT = int(os.getenv('PROGRESS_STREAM_TIMEOUT', 60 * 60))  # seconds
+PROGRESS_FLUSH_INTERVAL = float(os.getenv('PROGRESS_FLUSH_INTERVAL', 1.0))  # job progress to the database
+PROGRESS_RETENTION = int(os.getenv('PROGRESS_RETENTION', 5 * 60))  # seconds idle before a channel is dropped
+
+# ffmpeg scheduling
+# At most ENCODE_SLOTS ffmpeg runs at once (0: half the cores), each limited to
+# ENCODE_THREADS threads (0: an equal share of the cores)
+
+ENCODE_SLOTS = int(os.getenv('ENCODE_SLOTS', 0))
+ENCODE_THREADS = int(os.getenv('ENCODE_THREADS', 0))
+ENCODE_MAX_WAIT = float(os.getenv('ENCODE_MAX_WAIT', 120))  # seconds of queueing before 503
+CAPTION_SEGMENT_MIN_DURATION = float(os.getenv('CAPTION_SEGMENT_MIN_DURATION', 5 * 60))  # seconds; encode longer inputs in parallel segments
+SMART_RENDER_MAX_COVERAGE = float(os.getenv('SMART_RENDER_MAX_COVERAGE', 0.5))  # re-encode only captioned GOPs below this share; 0 disables
+
+# Instrumentation
+# /api/metrics/ exports per-stage timings, latency, bytes and in-flight requests for Prometheus.
+# A PROFILE_SAMPLE_RATE share of requests (0 to 1) gets a Server-Timing header and its stage
+# breakdown logged, and written as JSON to PROFILE_DIR when set
+
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR') or None
+
+# Logging
+# Messages of the api app (warm-up, profiles, failures) go to the console
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api': {'handlers': ['console'], 'level': os.getenv('API_LOG_LEVEL', 'INFO')},
+    },
+}
+
 # Add to the bottom of settings.py
 if not DEBUG:
     # Security settings
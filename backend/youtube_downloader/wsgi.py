@@ -14,3 +14,25 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'youtube_downloader.settings')
 
 application = get_wsgi_application()
+
+# Resume jobs that were queued or running when the previous process stopped
+from django.db import DatabaseError  # noqa: E402
+from api import jobs  # noqa: E402
+
+try:
+    jobs.recover()
+except DatabaseError:
+    # Not migrated yet; the job endpoints retry on first use
+    pass
+
+# Remove scratch directories left behind by workers that died mid-request
+from api import scratch  # noqa: E402
+
+scratch.sweep()
+
+# Load yt-dlp and build YoutubeDL instances now rather than on the first request
+from django.conf import settings  # noqa: E402
+
+if settings.WARM_UP:
+    from api.ytdl import warm_up
+    warm_up()